@@ -4,9 +4,12 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/
 
+import base64
 import datetime
+import hashlib
 import json
 import logging
+import multiprocessing
 import optparse
 import os
 import time
@@ -16,10 +19,17 @@ import zipfile
 import zope.interface
 from twisted.internet import protocol
 from twisted.internet import reactor
+from twisted.internet.defer import Deferred, succeed
 from twisted.internet.error import ProcessDone, ProcessTerminated
+from twisted.internet.threads import deferToThread
 
 from minion.plugin_api import AbstractPlugin
 
+
+PLUGIN_SERVICE_API = "http://127.0.0.1:8181"
+PLUGIN_SERVICE_MAX_EVENTS = 10000
+PLUGIN_SERVICE_SUBSCRIBER_TIMEOUT = 3600.0
+
 class PluginRunnerProcessProtocol(protocol.ProcessProtocol):
 
     def __init__(self, plugin_session):
@@ -37,6 +47,11 @@ class PluginRunnerProcessProtocol(protocol.ProcessProtocol):
     def errReceived(self, data):
         logging.debug("PluginRunnerProcessProtocol.errReceived: " + data)
 
+    # The plugin-runner reports how it finished through /session/id/report/finish
+    # before it exits. We only move the session to that state here, once the
+    # process has ended and the artifacts have been zipped up, so that nobody
+    # asks for the artifacts of a FINISHED session before they exist.
+
     def processEnded(self, reason):
         #logging.debug("PluginRunnerProcessProtocol.processEnded %s" % str(reason))
         self.plugin_session.duration = int(time.time()) - self.plugin_session.started
@@ -60,11 +75,97 @@ class PluginRunnerProcessProtocol(protocol.ProcessProtocol):
                                             zip.write(fn, fn, zipfile.ZIP_DEFLATED)
                 except Exception as e:
                     logging.exception("Failed to create artifacts zip file: " + str(e))
-            # TODO Is this the right thing to do now that we set the state from /session/id/report/finish ?
-            self.plugin_session.state = 'FINISHED'
+            self.plugin_session.set_state(self.plugin_session.reported_state or 'FINISHED')
         elif isinstance(reason.value, ProcessTerminated):
-            # TODO Is this the right thing to do now that we set the state from /session/id/report/finish ?
-            self.plugin_session.state = 'FAILED'
+            self.plugin_session.set_state(self.plugin_session.reported_state or 'FAILED')
+
+class PluginSessionEvents:
+
+    """
+    Everything that happens to the plugin sessions, in order: state
+    changes, progress and issues. Every event has a sequence number, so
+    a subscriber that reconnects can ask for the events it has missed.
+    Events are kept until all subscribers have acknowledged them, but
+    never more than max_events of them. Subscribers that have not been
+    connected for subscriber_timeout seconds are forgotten.
+    """
+
+    def __init__(self, max_events=PLUGIN_SERVICE_MAX_EVENTS, subscriber_timeout=PLUGIN_SERVICE_SUBSCRIBER_TIMEOUT):
+        self.max_events = max_events
+        self.subscriber_timeout = subscriber_timeout
+        self.sequence = 0
+        self._events = []
+        self._acknowledged = {}
+        self._connected = {}
+        self._seen = {}
+        self._waiters = []
+        self._notifier = None
+
+    def add(self, session_id, type, **data):
+        self.sequence += 1
+        data.update(sequence=self.sequence, session=session_id, type=type)
+        self._events.append(data)
+        if len(self._events) > self.max_events:
+            del self._events[:len(self._events) - self.max_events]
+        # Wake up the waiters in the next reactor turn, so that they get
+        # everything that happens in this one as a single batch.
+        if self._notifier is None:
+            self._notifier = reactor.callLater(0, self._notify)
+
+    def _notify(self):
+        self._notifier = None
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    #
+    # Return the events after the given sequence number. Returns None if
+    # some of those events have already been discarded, or if we never
+    # got that far because we were restarted since.
+    #
+
+    def since(self, sequence):
+        first = self._events[0]['sequence'] if self._events else self.sequence + 1
+        if sequence < first - 1 or sequence > self.sequence:
+            return None
+        return self._events[sequence - first + 1:]
+
+    def wait(self):
+        d = Deferred(lambda d: self._waiters.remove(d))
+        self._waiters.append(d)
+        return d
+
+    #
+    # Remember that a subscriber has processed all events up to sequence
+    # and discard the events that every subscriber has seen.
+    #
+
+    def acknowledge(self, subscriber, sequence):
+        self._acknowledged[subscriber] = max(sequence, self._acknowledged.get(subscriber, 0))
+        self._seen[subscriber] = time.time()
+        self._expire()
+        if self._events:
+            acknowledged = min(self._acknowledged.values())
+            del self._events[:max(0, acknowledged - self._events[0]['sequence'] + 1)]
+
+    # Keep track of which subscribers are connected
+
+    def connect(self, subscriber):
+        self._connected[subscriber] = self._connected.get(subscriber, 0) + 1
+        self._seen[subscriber] = time.time()
+
+    def disconnect(self, subscriber):
+        self._connected[subscriber] -= 1
+        if not self._connected[subscriber]:
+            del self._connected[subscriber]
+        self._seen[subscriber] = time.time()
+
+    def _expire(self):
+        expired = time.time() - self.subscriber_timeout
+        for subscriber,seen in self._seen.items():
+            if subscriber not in self._connected and seen < expired:
+                del self._seen[subscriber]
+                self._acknowledged.pop(subscriber, None)
 
 class PluginSession:
 
@@ -73,21 +174,27 @@ class PluginSession:
     collecting from the plugin, etc.
     """
 
-    def __init__(self, plugin_name, plugin_class, configuration, work_directory_root, debug = False):
+    def __init__(self, plugin_name, plugin_class, configuration, work_directory_root, debug = False, events = None,
+                 plugin_service_api = PLUGIN_SERVICE_API):
         self.plugin_name = plugin_name
         self.plugin_class = plugin_class
         self.configuration = configuration
         self.work_directory_root = work_directory_root
         self.debug = debug
+        self.events = events
+        self.plugin_service_api = plugin_service_api
         
         self.id = str(uuid.uuid4())
         self.state = 'CREATED'
+        self.reported_state = None
         self.started = int(time.time())
         self.duration = None
         self.results = []
+        self.sequence = 0
         self.errors = []
         self.progress = None
         self.artifacts = {}
+        self.artifacts_digest = None
         self.work_directory = os.path.join(self.work_directory_root, self.id)
         
     def start(self):
@@ -102,10 +209,26 @@ class PluginSession:
         arguments += ["--work-root", self.work_directory_root]
         arguments += ["--session-id", self.id]
         arguments += ["--mode", "plugin-service"]
-        arguments += ["--plugin-service-api", "http://127.0.0.1:8181"]
+        arguments += ["--plugin-service-api", self.plugin_service_api]
         environment = { 'PATH': os.getenv('PATH') }
         self.process = reactor.spawnProcess(protocol, "minion-plugin-runner", arguments, environment, path=self.work_directory)
-        self.state = 'STARTED'
+        self.set_state('STARTED')
+
+    #
+    # Let subscribers know about something that happened to this session.
+    #
+
+    def _event(self, type, **data):
+        if self.events is not None:
+            self.events.add(self.id, type, **data)
+
+    def set_state(self, state):
+        self.state = state
+        self._event('state', state=state)
+
+    def set_progress(self, progress):
+        self.progress = progress
+        self._event('progress', progress=progress)
 
     #
     # This is called by the user of the plugin-service by setting the state of
@@ -119,14 +242,16 @@ class PluginSession:
 
     def stop(self):
         if self.state == 'CREATED':
-            self.state = 'STOPPED'
+            self.set_state('STOPPED')
         elif self.state == 'STARTED':
             self.process.signalProcess(30) # USR1
-            self.state = 'STOPPING'
+            self.set_state('STOPPING')
 
     #
     # This is called by the plugin-runner through the /session/ID/report/results api. It
-    # simply collects the reported issues.
+    # simply collects the reported issues. Every issue is stamped with a sequence number
+    # that increases by one for every issue in this session, so that clients can ask for
+    # just the issues they have not seen yet.
     #
     # TODO I just realized that the ID generation should actually
     #      happen in the plugin-runner and not here. Otherwise it
@@ -141,12 +266,25 @@ class PluginSession:
             result['Date'] = date.isoformat() + 'Z'
         for result in results:
             result['Id'] = str(uuid.uuid4())
+        for result in results:
+            self.sequence += 1
+            result['Sequence'] = self.sequence
         self.results += results
+        self._event('issues', issues=results)
+
+    #
+    # Return the issues that were added after the given sequence number. Since
+    # sequence numbers start at 1 and have no gaps, issue N is at index N-1.
+    #
+
+    def results_after(self, sequence):
+        return self.results[max(sequence, 0):]
 
     #
     # This is called by the plugin-runner through the /session/ID/finish api. It
     # is used to tell the plugin-service that a session has finished with a
-    # specific status. After this is received, the session is done and even if
+    # specific status. The session moves to that state when the plugin-runner
+    # process has ended. After this is received, the session is done and even if
     # the plugin makes calls, we reject them. TODO That last bit is not yet
     # implemented.
     #
@@ -154,7 +292,7 @@ class PluginSession:
     def finish(self, result):
         state = result['state']
         if state in ('FINISHED', 'STOPPED', 'FAILED'):
-            self.state = state            
+            self.reported_state = state
 
     #
     # Add artifacts to this session. The format is an array that
@@ -182,6 +320,26 @@ class PluginSession:
     def artifacts_path(self):
         return os.path.join(self.work_directory_root, self.id + ".zip")
 
+    #
+    # Return the base64 encoded SHA-256 digest of the artifacts zip file.
+    # The zip file does not change once it has been written, so the digest
+    # is calculated once, in a thread, and then remembered.
+    #
+
+    def get_artifacts_digest(self):
+        if self.artifacts_digest is not None:
+            return succeed(self.artifacts_digest)
+        def _digest(path):
+            hash = hashlib.sha256()
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(64 * 1024), ''):
+                    hash.update(chunk)
+            return base64.b64encode(hash.digest())
+        def _remember(digest):
+            self.artifacts_digest = digest
+            return digest
+        return deferToThread(_digest, self.artifacts_path()).addCallback(_remember)
+
     def summary(self):
         return { 'id': self.id,
                  'state': self.state,
@@ -204,10 +362,12 @@ def _plugin_descriptor(plugin):
 
 class PluginService:
     
-    def __init__(self, work_directory_root):
+    def __init__(self, work_directory_root, plugin_service_api=PLUGIN_SERVICE_API):
         self.work_directory_root = work_directory_root
+        self.plugin_service_api = plugin_service_api
         self.sessions = {}
         self.plugins = {}
+        self.events = PluginSessionEvents()
 
     def get_session(self, session_id):
         return self.sessions.get(session_id)
@@ -215,7 +375,8 @@ class PluginService:
     def create_session(self, plugin_name, configuration, debug):
         plugin_class = self.plugins.get(plugin_name)
         if plugin_class:
-            session = PluginSession(plugin_name, plugin_class, configuration, self.work_directory_root, debug)
+            session = PluginSession(plugin_name, plugin_class, configuration, self.work_directory_root, debug,
+                                    self.events, self.plugin_service_api)
             self.sessions[session.id] = session
             return session
 
@@ -233,3 +394,15 @@ class PluginService:
     def plugin_descriptors(self):
         return map(_plugin_descriptor, self.plugins.values())
 
+    # Health and capacity of this plugin service, so that a task engine
+    # can decide where to run new plugin sessions.
+
+    def status(self):
+        running = [s for s in self.sessions.values() if s.state in ('STARTED', 'STOPPING')]
+        created = [s for s in self.sessions.values() if s.state == 'CREATED']
+        return { 'sessions': len(self.sessions),
+                 'running': len(running),
+                 'created': len(created),
+                 'cpus': multiprocessing.cpu_count(),
+                 'load': os.getloadavg()[0] }
+
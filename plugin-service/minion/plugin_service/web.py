@@ -9,15 +9,20 @@ import time
 import uuid
 
 import cyclone.web
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError, inlineCallbacks
+from twisted.protocols.basic import FileSender
 from twisted.python import log
 
-from minion.plugin_service.service import PluginService
+from minion.plugin_service.service import PluginService, PLUGIN_SERVICE_API
 
 
 PLUGIN_SERVICE_SYSTEM_SETTINGS_PATH = "/etc/minion/plugin-service.conf"
 PLUGIN_SERVICE_USER_SETTINGS_PATH = "~/.minion/plugin-service.conf"
 
+PLUGIN_SERVICE_EVENTS_BATCH_SIZE = 500
+PLUGIN_SERVICE_EVENTS_HEARTBEAT_INTERVAL = 15.0
+
 
 class PluginsHandler(cyclone.web.RequestHandler):
     def get(self):
@@ -33,6 +38,11 @@ class PluginHandler(cyclone.web.RequestHandler):
             return
         self.finish({'success':True,'plugin':plugin})
 
+class StatusHandler(cyclone.web.RequestHandler):
+    def get(self):
+        plugin_service = self.application.plugin_service
+        self.finish({'success': True, 'status': plugin_service.status()})
+
 class CreatePluginSessionHandler(cyclone.web.RequestHandler):
     def put(self, plugin_name):
         plugin_service = self.application.plugin_service
@@ -45,6 +55,40 @@ class CreatePluginSessionHandler(cyclone.web.RequestHandler):
         if session:
             self.finish({'success': True, 'session': session.summary()})
 
+class CreatePluginSessionsHandler(cyclone.web.RequestHandler):
+    def put(self):
+        plugin_service = self.application.plugin_service
+        requests = json.loads(self.request.body)
+        # Check all plugins first so that we create all sessions or none
+        for request in requests:
+            if not plugin_service.get_plugin_descriptor(request['plugin']):
+                self.finish({'success': False, 'error': 'no-such-plugin'})
+                return
+        sessions = [plugin_service.create_session(request['plugin'], request['configuration'], self.settings.debug)
+                    for request in requests]
+        self.finish({'success': True, 'sessions': [session.summary() for session in sessions]})
+
+#
+# These change the state of a session or delete it. They return an error
+# code if that is not possible or None if it was done. They are shared by
+# the handlers for single sessions and the batch handlers.
+#
+
+def _change_session_state(session, state):
+    if state == 'START':
+        if session.state != 'CREATED':
+            return 'unknown-state-transition'
+        session.start()
+    elif state == 'STOP':
+        if session.state not in ('STARTED', 'CREATED'):
+            return 'unknown-state-transition'
+        session.stop()
+
+def _delete_session(plugin_service, session):
+    if session.state not in ('CREATED', 'STOPPED', 'FINISHED', 'FAILED'):
+        return 'invalid-state'
+    plugin_service.delete_session(session)
+
 class PutPluginSessionStateHandler(cyclone.web.RequestHandler):
     def put(self, session_id):
         state = self.request.body
@@ -57,16 +101,10 @@ class PutPluginSessionStateHandler(cyclone.web.RequestHandler):
         if not session:
             self.finish({'success': False, 'error': 'no-such-session'})
             return
-        if state == 'START':
-            if session.state != 'CREATED':
-                self.finish({'success': False, 'error': 'unknown-state-transition'})
-                return
-            session.start()
-        elif state == 'STOP':
-            if session.state not in ('STARTED', 'CREATED'):
-                self.finish({'success': False, 'error': 'unknown-state-transition'})
-                return
-            session.stop()
+        error = _change_session_state(session, state)
+        if error:
+            self.finish({'success': False, 'error': error})
+            return
         self.finish({'success': True})
 
 class PluginSessionHandler(cyclone.web.RequestHandler):
@@ -83,12 +121,66 @@ class PluginSessionHandler(cyclone.web.RequestHandler):
         if not session:
             self.finish({'success': False, 'error': 'no-such-session'})
             return
-        if session.state not in ('CREATED', 'STOPPED', 'FINISHED', 'FAILED'):
-            self.finish({'success': False, 'error': 'invalid-state'})
+        error = _delete_session(plugin_service, session)
+        if error:
+            self.finish({'success': False, 'error': error})
             return
-        plugin_service.delete_session(session)
         self.finish({'success': True})
 
+#
+# Batch versions of the above. These take a list of session ids so that a
+# client that tracks many sessions can handle all of them in one request.
+# Errors are reported per session id, sessions that are not mentioned in
+# errors were handled successfully.
+#
+
+class PluginSessionsSummaryHandler(cyclone.web.RequestHandler):
+    def post(self):
+        plugin_service = self.application.plugin_service
+        sessions = {}
+        errors = {}
+        for session_id in json.loads(self.request.body):
+            session = plugin_service.get_session(session_id)
+            if not session:
+                errors[session_id] = 'no-such-session'
+            else:
+                sessions[session_id] = session.summary()
+        self.finish({'success': True, 'sessions': sessions, 'errors': errors})
+
+class PutPluginSessionsStateHandler(cyclone.web.RequestHandler):
+    def put(self):
+        request = json.loads(self.request.body)
+        state = request['state']
+        logging.debug("Putting state %s on %d sessions" % (state, len(request['sessions'])))
+        if state not in ('START', 'STOP'):
+            self.finish({'success': False, 'error': 'unknown-state'})
+            return
+        plugin_service = self.application.plugin_service
+        errors = {}
+        for session_id in request['sessions']:
+            session = plugin_service.get_session(session_id)
+            if not session:
+                errors[session_id] = 'no-such-session'
+                continue
+            error = _change_session_state(session, state)
+            if error:
+                errors[session_id] = error
+        self.finish({'success': True, 'errors': errors})
+
+class DeletePluginSessionsHandler(cyclone.web.RequestHandler):
+    def post(self):
+        plugin_service = self.application.plugin_service
+        errors = {}
+        for session_id in json.loads(self.request.body):
+            session = plugin_service.get_session(session_id)
+            if not session:
+                errors[session_id] = 'no-such-session'
+                continue
+            error = _delete_session(plugin_service, session)
+            if error:
+                errors[session_id] = error
+        self.finish({'success': True, 'errors': errors})
+
 class GetPluginSessionResultsHandler(cyclone.web.RequestHandler):
     def get(self, session_id):
         plugin_service = self.application.plugin_service
@@ -96,25 +188,130 @@ class GetPluginSessionResultsHandler(cyclone.web.RequestHandler):
         if not session:
             self.finish({'success': False, 'error': 'no-such-session'})
             return
-        self.finish({'success': True, 'session': session.summary(), 'issues': session.results})
+        try:
+            after = int(self.get_argument('after', 0))
+        except ValueError:
+            self.finish({'success': False, 'error': 'invalid-sequence'})
+            return
+        self.finish({'success': True, 'session': session.summary(), 'issues': session.results_after(after),
+                     'sequence': session.sequence})
 
 class GetPluginSessionArtifactsHandler(cyclone.web.RequestHandler):
+
+    # The zip file is streamed to the client with a FileSender, which reads
+    # the next chunk only when the transport wants more data. The Digest
+    # header lets the client verify that it received the complete file.
+
+    @inlineCallbacks
     def get(self, session_id):
         plugin_service = self.application.plugin_service
         session = plugin_service.get_session(session_id)
         if not session:
             self.finish({'success': False, 'error': 'no-such-session'})
             return
-        # TODO This blocks the server. What is the right way to serve files?
         artifacts_path = session.artifacts_path()
-        if not os.path.exists(artifacts_path):
+        try:
+            f = open(artifacts_path, 'rb')
+        except IOError:
             raise cyclone.web.HTTPError(404)
-        with open(artifacts_path) as f:
-            data = f.read()
+        try:
+            digest = yield session.get_artifacts_digest()
             self.set_header("Content-Type", "application/zip")
             filename = session_id + ".zip"
             self.set_header("Content-Disposition", "inline; filename=\"%s\"" % filename)
-            self.finish(data)
+            self.set_header("Content-Length", str(os.fstat(f.fileno()).st_size))
+            self.set_header("Digest", "SHA-256=%s" % digest)
+            self.flush()
+            try:
+                yield FileSender().beginFileTransfer(f, self.request.connection.transport)
+            except Exception as e:
+                logging.info("Failed to send artifacts of session %s: %s" % (session_id, str(e)))
+                return
+            self.finish()
+        finally:
+            f.close()
+
+#
+# Subscribers, like the Task Engine, can follow everything that happens
+# to the plugin sessions as a stream of Server-Sent Events instead of
+# polling every session. Events come in batches, with the sequence number
+# of the last event in the batch as the event id. A subscriber that
+# reconnects passes the last sequence number it has seen as after to get
+# the events that it missed. It acknowledges the events that it has
+# processed so that we can discard them.
+#
+
+class EventsHandler(cyclone.web.RequestHandler):
+
+    _closed = False
+    _waiting = None
+    _subscriber = None
+
+    def _event(self, event, data, id=None):
+        lines = []
+        if id is not None:
+            lines.append("id: %d" % id)
+        lines.append("event: %s" % event)
+        lines.append("data: %s" % json.dumps(data))
+        self.write("\n".join(lines) + "\n\n")
+        self.flush()
+
+    def on_connection_close(self, *args):
+        self._closed = True
+        if self._subscriber is not None:
+            self.application.plugin_service.events.disconnect(self._subscriber)
+            self._subscriber = None
+        if self._waiting is not None:
+            reactor.callLater(0, self._waiting.cancel)
+
+    @inlineCallbacks
+    def get(self):
+        events = self.application.plugin_service.events
+        try:
+            sequence = int(self.get_argument('after', events.sequence))
+        except ValueError:
+            self.finish({'success': False, 'error': 'invalid-sequence'})
+            return
+
+        self._subscriber = self.get_argument('subscriber', None)
+        if self._subscriber is not None:
+            events.connect(self._subscriber)
+
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        self._event('subscribed', {'sequence': events.sequence})
+
+        while not self._closed:
+            batch = events.since(sequence)
+            if batch is None:
+                # We no longer have all the events that the subscriber
+                # missed. Tell it so that it can catch up by itself.
+                sequence = events.sequence
+                self._event('reset', {'sequence': sequence})
+                continue
+            while batch:
+                chunk, batch = batch[:PLUGIN_SERVICE_EVENTS_BATCH_SIZE], batch[PLUGIN_SERVICE_EVENTS_BATCH_SIZE:]
+                sequence = chunk[-1]['sequence']
+                self._event('events', chunk, sequence)
+            self._waiting = events.wait()
+            heartbeat = reactor.callLater(PLUGIN_SERVICE_EVENTS_HEARTBEAT_INTERVAL, self._waiting.cancel)
+            try:
+                yield self._waiting
+            except CancelledError:
+                if not self._closed:
+                    self.write(": heartbeat\n\n")
+                    self.flush()
+            finally:
+                self._waiting = None
+                if heartbeat.active():
+                    heartbeat.cancel()
+
+class AcknowledgeEventsHandler(cyclone.web.RequestHandler):
+
+    def post(self):
+        request = json.loads(self.request.body)
+        self.application.plugin_service.events.acknowledge(request['subscriber'], request['sequence'])
+        self.finish({'success': True})
 
 #
 
@@ -138,7 +335,7 @@ class PluginRunnerReportProgressHandler(cyclone.web.RequestHandler):
             return
         progress = json.loads(self.request.body)
         logging.debug("Received progress from plugin session %s: " + str(progress))
-        session.progress = progress
+        session.set_progress(progress)
         self.finish({'success':True})
 
 class PluginRunnerReportIssuesHandler(cyclone.web.RequestHandler):
@@ -223,7 +420,11 @@ class PluginServiceApplication(cyclone.web.Application):
         
         # Create the Plugin Service and register plugins
 
-        self.plugin_service = PluginService(plugin_service_settings['work_directory_root'])
+        # Plugin runners report back to plugin_service_api, which has to
+        # be changed when the plugin service does not listen on 8181
+
+        plugin_service_api = plugin_service_settings.get('plugin_service_api', PLUGIN_SERVICE_API)
+        self.plugin_service = PluginService(plugin_service_settings['work_directory_root'], plugin_service_api)
 
         from minion.plugins.basic import ExceptionPlugin
         from minion.plugins.basic import FailedPlugin
@@ -280,11 +481,18 @@ class PluginServiceApplication(cyclone.web.Application):
             # Public API
             (r"/plugins", PluginsHandler),
             (r"/plugin/(.+)", PluginHandler),
+            (r"/status", StatusHandler),
             (r"/session/create/(.+)", CreatePluginSessionHandler),
             (r"/session/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/state", PutPluginSessionStateHandler),
             (r"/session/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})", PluginSessionHandler),
             (r"/session/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/results", GetPluginSessionResultsHandler),
             (r"/session/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/artifacts", GetPluginSessionArtifactsHandler),
+            (r"/sessions/create", CreatePluginSessionsHandler),
+            (r"/sessions/summary", PluginSessionsSummaryHandler),
+            (r"/sessions/state", PutPluginSessionsStateHandler),
+            (r"/sessions/delete", DeletePluginSessionsHandler),
+            (r"/events", EventsHandler),
+            (r"/events/ack", AcknowledgeEventsHandler),
             # Plugin Runner API
             (r"/session/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/configuration", PluginRunnerGetConfigurationHandler),
             (r"/session/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/report/progress", PluginRunnerReportProgressHandler),
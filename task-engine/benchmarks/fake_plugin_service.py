@@ -0,0 +1,318 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# A stand-in for the plugin service that runs in the same process as the
+# task engine, for benchmarks. It has the same HTTP API as far as the
+# task engine uses it, but its plugin sessions do not run anything: a
+# session runs for a random duration and reports issues at a fixed rate
+# while it does. Every response is delayed by the configured latency.
+#
+
+import json
+import random
+import time
+import uuid
+
+import cyclone.web
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError, Deferred, inlineCallbacks
+from twisted.internet.task import deferLater
+
+FAKE_PLUGIN_SERVICE_MAX_EVENTS = 100000
+FAKE_PLUGIN_SERVICE_HEARTBEAT_INTERVAL = 15.0
+
+
+class FakePluginSession:
+
+    def __init__(self, service, plugin, configuration):
+        self.service = service
+        self.plugin = plugin
+        self.configuration = configuration
+        self.id = str(uuid.uuid4())
+        self.state = 'CREATED'
+        self.started = None
+        self.ended = None
+        self.duration = max(0.0, random.uniform(service.duration * (1 - service.jitter),
+                                                service.duration * (1 + service.jitter)))
+        self._finisher = None
+
+    def start(self):
+        self.state = 'STARTED'
+        self.started = time.time()
+        self._finisher = reactor.callLater(self.duration, self._finish)
+        self.service.add_event(self.id, 'state', state=self.state)
+
+    def stop(self):
+        if self._finisher is not None and self._finisher.active():
+            self._finisher.cancel()
+        self.state = 'STOPPED'
+        self.ended = time.time()
+        self.service.add_event(self.id, 'state', state=self.state)
+
+    def _finish(self):
+        self.state = 'FINISHED'
+        self.ended = self.started + self.duration
+        self.service.add_event(self.id, 'state', state=self.state)
+
+    # Issues are made up when they are asked for. The session has reported
+    # as many as its issue rate allows for the time that it has been running.
+
+    def sequence(self):
+        if self.started is None:
+            return 0
+        elapsed = min((self.ended or time.time()) - self.started, self.duration)
+        if self.state == 'FINISHED':
+            elapsed = self.duration
+        return int(elapsed * self.service.issue_rate)
+
+    def results_after(self, after):
+        return [{'Sequence': n,
+                 'Summary': 'Fake issue %d' % n,
+                 'Severity': 'Info',
+                 'Description': 'Issue %d reported by %s' % (n, self.plugin['name']),
+                 'URLs': [self.configuration.get('target')]} for n in range(after + 1, self.sequence() + 1)]
+
+    def summary(self):
+        return { 'id': self.id,
+                 'state': self.state,
+                 'configuration': self.configuration,
+                 'plugin': self.plugin,
+                 'progress': None,
+                 'started': int(self.started or time.time()),
+                 'issues': [],
+                 'artifacts': {},
+                 'duration': int((self.ended or time.time()) - (self.started or time.time())) }
+
+
+class FakePluginService:
+
+    """
+    The plugins, sessions and events of the fake plugin service. The
+    planned duration of every session that was ever created is kept, so
+    that a benchmark can tell how long a scan should have taken.
+    """
+
+    def __init__(self, plugins, latency=0.0, duration=10.0, jitter=0.5, issue_rate=1.0):
+        self.plugins = dict((plugin['class'], plugin) for plugin in plugins)
+        self.latency = latency
+        self.duration = duration
+        self.jitter = jitter
+        self.issue_rate = issue_rate
+        self.sessions = {}
+        self.durations = {}
+        self.sequence = 0
+        self._events = []
+        self._waiters = []
+        self._notifier = None
+
+    def create_session(self, plugin_name, configuration):
+        session = FakePluginSession(self, self.plugins[plugin_name], configuration)
+        self.sessions[session.id] = session
+        self.durations[session.id] = session.duration
+        return session
+
+    def add_event(self, session_id, type, **data):
+        self.sequence += 1
+        data.update(sequence=self.sequence, session=session_id, type=type)
+        self._events.append(data)
+        if len(self._events) > FAKE_PLUGIN_SERVICE_MAX_EVENTS:
+            del self._events[:len(self._events) - FAKE_PLUGIN_SERVICE_MAX_EVENTS]
+        # Like the real plugin service, send what happens in a reactor turn as one batch
+        if self._notifier is None:
+            self._notifier = reactor.callLater(0, self._notify)
+
+    def _notify(self):
+        self._notifier = None
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    def events_since(self, sequence):
+        first = self._events[0]['sequence'] if self._events else self.sequence + 1
+        if sequence < first - 1:
+            return None
+        return self._events[sequence - first + 1:]
+
+    def wait(self):
+        d = Deferred(lambda d: self._waiters.remove(d))
+        self._waiters.append(d)
+        return d
+
+    def delay(self):
+        return deferLater(reactor, self.latency, lambda: None)
+
+
+class FakeHandler(cyclone.web.RequestHandler):
+
+    @property
+    def service(self):
+        return self.application.plugin_service
+
+class PluginsHandler(FakeHandler):
+    @inlineCallbacks
+    def get(self):
+        yield self.service.delay()
+        self.finish({'success': True, 'plugins': self.service.plugins.values()})
+
+class StatusHandler(FakeHandler):
+    @inlineCallbacks
+    def get(self):
+        yield self.service.delay()
+        running = len([s for s in self.service.sessions.values() if s.state == 'STARTED'])
+        created = len([s for s in self.service.sessions.values() if s.state == 'CREATED'])
+        self.finish({'success': True, 'status': {'sessions': len(self.service.sessions), 'running': running,
+                                                 'created': created, 'cpus': 1, 'load': 0.0}})
+
+class CreatePluginSessionsHandler(FakeHandler):
+    @inlineCallbacks
+    def put(self):
+        yield self.service.delay()
+        requests = json.loads(self.request.body)
+        if [r for r in requests if r['plugin'] not in self.service.plugins]:
+            self.finish({'success': False, 'error': 'no-such-plugin'})
+            return
+        sessions = [self.service.create_session(r['plugin'], r['configuration']) for r in requests]
+        self.finish({'success': True, 'sessions': [session.summary() for session in sessions]})
+
+class PluginSessionsSummaryHandler(FakeHandler):
+    @inlineCallbacks
+    def post(self):
+        yield self.service.delay()
+        sessions, errors = {}, {}
+        for session_id in json.loads(self.request.body):
+            session = self.service.sessions.get(session_id)
+            if session is None:
+                errors[session_id] = 'no-such-session'
+            else:
+                sessions[session_id] = session.summary()
+        self.finish({'success': True, 'sessions': sessions, 'errors': errors})
+
+class PutPluginSessionsStateHandler(FakeHandler):
+    @inlineCallbacks
+    def put(self):
+        yield self.service.delay()
+        request = json.loads(self.request.body)
+        errors = {}
+        for session_id in request['sessions']:
+            session = self.service.sessions.get(session_id)
+            if session is None:
+                errors[session_id] = 'no-such-session'
+            elif request['state'] == 'START' and session.state == 'CREATED':
+                session.start()
+            elif request['state'] == 'STOP' and session.state in ('CREATED', 'STARTED'):
+                session.stop()
+            else:
+                errors[session_id] = 'unknown-state-transition'
+        self.finish({'success': True, 'errors': errors})
+
+class DeletePluginSessionsHandler(FakeHandler):
+    @inlineCallbacks
+    def post(self):
+        yield self.service.delay()
+        errors = {}
+        for session_id in json.loads(self.request.body):
+            session = self.service.sessions.get(session_id)
+            if session is None:
+                errors[session_id] = 'no-such-session'
+            elif session.state == 'STARTED':
+                errors[session_id] = 'invalid-state'
+            else:
+                del self.service.sessions[session_id]
+        self.finish({'success': True, 'errors': errors})
+
+class GetPluginSessionResultsHandler(FakeHandler):
+    @inlineCallbacks
+    def get(self, session_id):
+        yield self.service.delay()
+        session = self.service.sessions.get(session_id)
+        if session is None:
+            self.finish({'success': False, 'error': 'no-such-session'})
+            return
+        self.finish({'success': True, 'session': session.summary(),
+                     'issues': session.results_after(int(self.get_argument('after', 0))),
+                     'sequence': session.sequence()})
+
+class EventsHandler(FakeHandler):
+
+    _closed = False
+    _waiting = None
+
+    def _event(self, event, data, id=None):
+        lines = []
+        if id is not None:
+            lines.append("id: %d" % id)
+        lines.append("event: %s" % event)
+        lines.append("data: %s" % json.dumps(data))
+        self.write("\n".join(lines) + "\n\n")
+        self.flush()
+
+    def on_connection_close(self, *args):
+        self._closed = True
+        if self._waiting is not None:
+            reactor.callLater(0, self._waiting.cancel)
+
+    @inlineCallbacks
+    def get(self):
+        sequence = int(self.get_argument('after', self.service.sequence))
+        self.set_header("Content-Type", "text/event-stream")
+        self._event('subscribed', {'sequence': self.service.sequence})
+        while not self._closed:
+            events = self.service.events_since(sequence)
+            if events is None:
+                sequence = self.service.sequence
+                self._event('reset', {'sequence': sequence})
+                continue
+            if events:
+                sequence = events[-1]['sequence']
+                self._event('events', events, sequence)
+            self._waiting = self.service.wait()
+            heartbeat = reactor.callLater(FAKE_PLUGIN_SERVICE_HEARTBEAT_INTERVAL, self._waiting.cancel)
+            try:
+                yield self._waiting
+            except CancelledError:
+                if not self._closed:
+                    self.write(": heartbeat\n\n")
+                    self.flush()
+            finally:
+                self._waiting = None
+                if heartbeat.active():
+                    heartbeat.cancel()
+
+class AcknowledgeEventsHandler(FakeHandler):
+    def post(self):
+        self.finish({'success': True})
+
+
+class FakePluginServiceApplication(cyclone.web.Application):
+
+    def __init__(self, plugin_service):
+        self.plugin_service = plugin_service
+        handlers = [
+            (r"/plugins", PluginsHandler),
+            (r"/status", StatusHandler),
+            (r"/session/([a-f0-9-]{36})/results", GetPluginSessionResultsHandler),
+            (r"/sessions/create", CreatePluginSessionsHandler),
+            (r"/sessions/summary", PluginSessionsSummaryHandler),
+            (r"/sessions/state", PutPluginSessionsStateHandler),
+            (r"/sessions/delete", DeletePluginSessionsHandler),
+            (r"/events", EventsHandler),
+            (r"/events/ack", AcknowledgeEventsHandler),
+        ]
+        cyclone.web.Application.__init__(self, handlers)
+
+    # Requests are not logged
+
+    def log_request(self, handler):
+        pass
+
+
+#
+# Start a fake plugin service on a free port on localhost. Returns its
+# API url.
+#
+
+def listen(plugin_service):
+    port = reactor.listenTCP(0, FakePluginServiceApplication(plugin_service), interface='127.0.0.1')
+    return "http://127.0.0.1:%d" % port.getHost().port
@@ -0,0 +1,78 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Compare the scan database backends on storing, loading and finding
+# scans. The scans are shaped like the summaries that the task engine
+# stores: a handful of sessions with a number of issues each.
+#
+#   python benchmarks/scan_database.py -n 1000 -i 50
+#
+
+import optparse
+import shutil
+import tempfile
+import time
+import uuid
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import react
+
+from minion.task_engine.database import FileScanDatabase, SQLiteScanDatabase
+
+TARGETS = ['http://www%d.example.com' % n for n in range(10)]
+PLANS = ['tickle', 'scratch', 'stomp']
+
+def make_scan(n, issues_per_session):
+    sessions = []
+    for s in range(4):
+        issues = [{'Id': str(uuid.uuid4()), 'Summary': 'Issue %d' % i, 'Severity': 'High',
+                   'Description': 'x' * 200, 'URLs': [TARGETS[n % len(TARGETS)] + '/%d' % i]}
+                  for i in range(issues_per_session)]
+        sessions.append({'id': str(uuid.uuid4()), 'state': 'FINISHED', 'plugin': {'name': 'Plugin%d' % s},
+                         'configuration': {'target': TARGETS[n % len(TARGETS)]}, 'issues': issues,
+                         'artifacts': {}})
+    return {'id': str(uuid.uuid4()), 'state': 'FINISHED', 'created': 1000000 + n, 'finished': 1000060 + n,
+            'plan': {'name': PLANS[n % len(PLANS)]}, 'configuration': {'target': TARGETS[n % len(TARGETS)]},
+            'sessions': sessions}
+
+@inlineCallbacks
+def measure(name, database, scans, finds):
+    start = time.time()
+    for scan in scans:
+        yield database.store(scan)
+    store_time = time.time() - start
+
+    start = time.time()
+    for scan in scans:
+        yield database.load(scan['id'])
+    load_time = time.time() - start
+
+    start = time.time()
+    for n in range(finds):
+        yield database.find(target=TARGETS[n % len(TARGETS)], limit=25)
+    find_time = time.time() - start
+
+    print "%-8s store %8.2f/s   load %8.2f/s   find %8.2f/s" % (name, len(scans) / store_time,
+                                                                 len(scans) / load_time, finds / find_time)
+
+@inlineCallbacks
+def main(reactor, options):
+    scans = [make_scan(n, options.issues) for n in range(options.scans)]
+    directory = tempfile.mkdtemp()
+    try:
+        yield measure('files', FileScanDatabase(directory + '/files'), scans, options.finds)
+        yield measure('sqlite', SQLiteScanDatabase(directory + '/scans.sqlite'), scans, options.finds)
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--scans", type="int", default=500)
+    parser.add_option("-i", "--issues", type="int", default=25)
+    parser.add_option("-f", "--finds", type="int", default=50)
+    (options, args) = parser.parse_args()
+    react(main, [options])
@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+#
+# Measure how many scans a task engine handles. A task engine and one or
+# more fake plugin services run in this process, nothing goes over the
+# network. Scans are created, started and followed through their event
+# stream until they are done, through the HTTP API of the task engine,
+# with a number of them in flight at any time. The overhead of a scan
+# is how much longer it took than its slowest plugin session ran.
+#
+#   python benchmarks/scan_engine.py -n 2000 -c 500 --duration 5 --issue-rate 2
+#
+
+import json
+import logging
+import optparse
+import resource
+import shutil
+import tempfile
+import time
+
+from twisted.internet.defer import DeferredList, DeferredSemaphore, inlineCallbacks
+from twisted.internet.task import LoopingCall, deferLater, react
+
+from minion.task_engine import engine
+from minion.task_engine.client import PluginServiceClient
+from minion.task_engine.web import TaskEngineApplication
+
+from fake_plugin_service import FakePluginService, listen
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100.0))]
+
+class Benchmark:
+
+    def __init__(self, options, api, plugin_services):
+        self.options = options
+        self.api = api
+        self.plugin_services = plugin_services
+        self.client = PluginServiceClient(timeout=options.timeout, max_connections_per_host=options.concurrency)
+        self.overheads = []
+        self.issues = 0
+        self.expected_issues = 0
+        self.failed = 0
+        self.peak_scans = 0
+        self.peak_issue_memory = 0
+
+    def _planned_duration(self, session_id):
+        for plugin_service in self.plugin_services:
+            if session_id in plugin_service.durations:
+                return plugin_service.durations[session_id]
+
+    @inlineCallbacks
+    def run_scan(self, n):
+        response = yield self.client.request('PUT', self.api + "/scan/create/benchmark",
+                                             json.dumps({'target': 'http://www%d.example.com' % n}))
+        scan = response['scan']
+        started = time.time()
+        response = yield self.client.request('POST', self.api + "/scan/%s/state" % scan['id'], 'START')
+        if not response['success']:
+            self.failed += 1
+            return
+        end = []
+        def _received(event, id, data):
+            data = json.loads(data)
+            if event == 'issues':
+                self.issues += sum(len(session['issues']) for session in data['sessions'])
+            elif event == 'end':
+                end.append(data['state'])
+        yield self.client.stream(self.api + "/scan/%s/events" % scan['id'], _received, self.options.timeout)
+        if end != ['FINISHED']:
+            self.failed += 1
+            return
+        durations = [self._planned_duration(session['id']) for session in scan['sessions']]
+        self.overheads.append(time.time() - started - max(durations))
+        self.expected_issues += sum(int(duration * self.options.issue_rate) for duration in durations)
+
+    @inlineCallbacks
+    def sample_memory(self):
+        memory = yield self.client.request('GET', self.api + "/scans/memory")
+        self.peak_scans = max(self.peak_scans, len(memory['scans']))
+        self.peak_issue_memory = max(self.peak_issue_memory, memory['size'])
+
+    @inlineCallbacks
+    def run(self):
+        semaphore = DeferredSemaphore(self.options.concurrency)
+        sampler = LoopingCall(self.sample_memory)
+        sampler.start(1.0)
+        start = time.time()
+        results = yield DeferredList([semaphore.run(self.run_scan, n) for n in range(self.options.scans)],
+                                     consumeErrors=True)
+        elapsed = time.time() - start
+        sampler.stop()
+        for success,result in results:
+            if not success:
+                self.failed += 1
+                logging.error("Scan failed: %s" % result.getErrorMessage())
+        self.report(elapsed)
+
+    def report(self, elapsed):
+        print "scans      %d finished, %d failed in %.1fs" % (len(self.overheads), self.failed, elapsed)
+        print "throughput %.2f scans/s, %.1f issues/s" % (len(self.overheads) / elapsed, self.issues / elapsed)
+        print "issues     %d received of %d reported" % (self.issues, self.expected_issues)
+        if self.overheads:
+            print "overhead   p50 %.3fs  p99 %.3fs  max %.3fs" % (percentile(self.overheads, 50),
+                                                                 percentile(self.overheads, 99),
+                                                                 max(self.overheads))
+        print "memory     peak rss %.1f MB, peak %d scans in memory with %.1f MB of issues" % (
+            resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0, self.peak_scans,
+            self.peak_issue_memory / 1024.0 / 1024.0)
+
+@inlineCallbacks
+def main(reactor, options):
+    plugins = [{'class': 'benchmark.FakePlugin%d' % n, 'name': 'FakePlugin%d' % n, 'version': '0.0'}
+               for n in range(options.plugins)]
+    engine.PLANS['benchmark'] = {
+        'name': 'benchmark',
+        'description': 'Runs fake plugins in parallel.',
+        'workflow': [{'plugin_name': plugin['class'], 'description': '', 'configuration': {}} for plugin in plugins]
+    }
+    plugin_services = [FakePluginService(plugins, options.latency, options.duration, options.jitter,
+                                         options.issue_rate) for n in range(options.plugin_services)]
+
+    directory = tempfile.mkdtemp()
+    try:
+        settings = { 'plugin_service_apis': [listen(plugin_service) for plugin_service in plugin_services],
+                     'scan_database_type': options.database,
+                     'scan_database_location': None if options.database == 'memory' else directory + '/scans',
+                     'artifacts_path': directory + '/artifacts',
+                     'scan_journal_path': None if options.no_journal else directory + '/journal',
+                     'scan_schedules_path': None,
+                     'scan_max_parallel_sessions': options.plugins,
+                     'scan_admission_budget': options.concurrency }
+        application = TaskEngineApplication(settings)
+        port = reactor.listenTCP(0, application, interface='127.0.0.1')
+        # Give the task engine time to load the plugins and follow the events
+        yield deferLater(reactor, 1.0, lambda: None)
+        benchmark = Benchmark(options, "http://127.0.0.1:%d" % port.getHost().port, plugin_services)
+        yield benchmark.run()
+    finally:
+        shutil.rmtree(directory)
+
+if __name__ == "__main__":
+    parser = optparse.OptionParser()
+    parser.add_option("-n", "--scans", type="int", default=1000)
+    parser.add_option("-c", "--concurrency", type="int", default=250, help="scans in flight")
+    parser.add_option("-p", "--plugins", type="int", default=3, help="plugins per scan, they run in parallel")
+    parser.add_option("-s", "--plugin-services", type="int", default=1)
+    parser.add_option("-l", "--latency", type="float", default=0.005, help="plugin service response time")
+    parser.add_option("-d", "--duration", type="float", default=5.0, help="mean plugin session duration")
+    parser.add_option("-j", "--jitter", type="float", default=0.5, help="relative spread of the duration")
+    parser.add_option("-i", "--issue-rate", type="float", default=1.0, help="issues per second per session")
+    parser.add_option("-t", "--timeout", type="float", default=60.0)
+    parser.add_option("--database", default="memory", help="memory, files or sqlite")
+    parser.add_option("--no-journal", action="store_true", default=False)
+    (options, args) = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    react(main, [options])
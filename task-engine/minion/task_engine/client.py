@@ -0,0 +1,412 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import base64
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import time
+import urlparse
+
+import zope.interface
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError, Deferred, DeferredSemaphore
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+from twisted.internet.error import ConnectError, TimeoutError
+from twisted.internet.protocol import Protocol
+from twisted.internet.task import deferLater
+from twisted.python.failure import Failure
+from twisted.web.client import Agent, HTTPConnectionPool, ResponseDone, readBody
+from twisted.web.client import RequestTransmissionFailed, ResponseNeverReceived
+from twisted.web.http_headers import Headers
+from twisted.web.iweb import IBodyProducer
+
+
+PLUGIN_SERVICE_CLIENT_TIMEOUT = 10.0
+PLUGIN_SERVICE_CLIENT_CONNECT_TIMEOUT = 5.0
+PLUGIN_SERVICE_CLIENT_MAX_CONNECTIONS_PER_HOST = 32
+PLUGIN_SERVICE_CLIENT_IDLE_CONNECTION_TIMEOUT = 60
+PLUGIN_SERVICE_CLIENT_RETRIES = 2
+PLUGIN_SERVICE_CLIENT_RETRY_DELAY = 0.5
+
+# Failures where we know the request never reached the plugin service or
+# where we never got an answer. Idempotent requests are retried when they
+# fail like this, which also covers a pooled connection that was closed
+# by the other side while it was idle.
+
+RETRYABLE_ERRORS = (ConnectError, RequestTransmissionFailed, ResponseNeverReceived)
+IDEMPOTENT_METHODS = ('GET', 'HEAD', 'DELETE')
+
+# What a request to the plugin service does, by method and path. The
+# first match wins. Used to label the metrics of the requests.
+
+PLUGIN_SERVICE_OPERATIONS = (
+    (None, re.compile(r'^/sessions?/create(/|$)'), 'create'),
+    (None, re.compile(r'^/sessions/delete$'), 'delete'),
+    ('DELETE', re.compile(r'^/session/[^/]+$'), 'delete'),
+    (None, re.compile(r'^/sessions/summary$'), 'status'),
+    ('GET', re.compile(r'^/session/[^/]+$'), 'status'),
+    (None, re.compile(r'^/sessions?(/[^/]+)?/state$'), 'state'),
+    (None, re.compile(r'^/session/[^/]+/results$'), 'results'),
+    (None, re.compile(r'^/session/[^/]+/artifacts$'), 'artifacts'),
+    (None, re.compile(r'^/events(/|$)'), 'events'),
+    (None, re.compile(r'^/plugins?(/|$)'), 'plugins'),
+    (None, re.compile(r'^/status$'), 'health'),
+)
+
+
+def _operation(method, url):
+    path = urlparse.urlparse(url).path
+    for operation_method,pattern,operation in PLUGIN_SERVICE_OPERATIONS:
+        if operation_method in (None, method) and pattern.match(path):
+            return operation
+    return 'other'
+
+
+class PluginServiceError(Exception):
+    pass
+
+
+class StringProducer(object):
+
+    """
+    Body producer for the small JSON bodies we send. The body is written
+    at once so that it goes out together with the request headers.
+    """
+
+    zope.interface.implements(IBodyProducer)
+
+    def __init__(self, body):
+        self.body = body
+        self.length = len(body)
+
+    def startProducing(self, consumer):
+        consumer.write(self.body)
+        return succeed(None)
+
+    def pauseProducing(self):
+        pass
+
+    def stopProducing(self):
+        pass
+
+
+class FileWriter(Protocol):
+
+    """
+    Writes a response body to a file as it comes in and keeps a SHA-256
+    digest of it. The finished deferred fires with the base64 encoded
+    digest when the whole body has been received. Cancelling it aborts
+    the response.
+    """
+
+    def __init__(self, file, received):
+        self.finished = Deferred(self._cancel)
+        self._file = file
+        self._received = received
+        self._hash = hashlib.sha256()
+
+    def dataReceived(self, data):
+        if self.finished.called:
+            return
+        self._hash.update(data)
+        self._file.write(data)
+        self._received()
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        if reason.check(ResponseDone):
+            self.finished.callback(base64.b64encode(self._hash.digest()))
+        else:
+            self.finished.errback(reason)
+
+    def _cancel(self, _):
+        self.transport.stopProducing()
+
+
+class EventStreamReader(Protocol):
+
+    """
+    Parses a text/event-stream response body as it comes in and calls
+    received(event, id, data) for every complete event. The finished
+    deferred fires when the stream ends. Cancelling it closes the
+    stream.
+    """
+
+    def __init__(self, received, activity):
+        self.finished = Deferred(self._cancel)
+        self._received = received
+        self._activity = activity
+        self._buffer = ''
+        self._fields = {}
+
+    def dataReceived(self, data):
+        if self.finished.called:
+            return
+        self._activity()
+        lines = (self._buffer + data).split('\n')
+        self._buffer = lines.pop()
+        for line in lines:
+            self._line(line.rstrip('\r'))
+
+    def _line(self, line):
+        if not line:
+            fields, self._fields = self._fields, {}
+            if 'data' in fields:
+                try:
+                    self._received(fields.get('event', 'message'), fields.get('id'), fields['data'])
+                except Exception as e:
+                    logging.exception("Failed to handle event: %s" % str(e))
+        elif not line.startswith(':'):
+            name, _, value = line.partition(':')
+            if value.startswith(' '):
+                value = value[1:]
+            if name == 'data' and 'data' in self._fields:
+                value = self._fields['data'] + '\n' + value
+            self._fields[name] = value
+
+    def connectionLost(self, reason):
+        if self.finished.called:
+            return
+        if reason.check(ResponseDone):
+            self.finished.callback(None)
+        else:
+            self.finished.errback(reason)
+
+    def _cancel(self, _):
+        self.transport.stopProducing()
+
+
+class PluginServiceClient:
+
+    """
+    HTTP client that the task engine uses for all its calls to the
+    plugin service. Connections are kept alive in a shared pool so that
+    we do not set up a new TCP connection for every request. The number
+    of requests in flight to one host is limited, every request has a
+    timeout and idempotent requests are retried on connection failures.
+    """
+
+    def __init__(self, timeout=PLUGIN_SERVICE_CLIENT_TIMEOUT,
+                 connect_timeout=PLUGIN_SERVICE_CLIENT_CONNECT_TIMEOUT,
+                 max_connections_per_host=PLUGIN_SERVICE_CLIENT_MAX_CONNECTIONS_PER_HOST,
+                 retries=PLUGIN_SERVICE_CLIENT_RETRIES,
+                 retry_delay=PLUGIN_SERVICE_CLIENT_RETRY_DELAY,
+                 metrics=None):
+        self._timeout = timeout
+        self._max_connections_per_host = max_connections_per_host
+        self._retries = retries
+        self._retry_delay = retry_delay
+        self._pool = HTTPConnectionPool(reactor, persistent=True)
+        self._pool.maxPersistentPerHost = max_connections_per_host
+        self._pool.cachedConnectionTimeout = PLUGIN_SERVICE_CLIENT_IDLE_CONNECTION_TIMEOUT
+        self._agent = Agent(reactor, connectTimeout=connect_timeout, pool=self._pool)
+        self._semaphores = {}
+        self._durations = None
+        self._errors = None
+        if metrics is not None:
+            self._durations = metrics.histogram("minion_task_engine_plugin_service_request_duration_seconds",
+                                                "Time until a request to a plugin service completed, including retries.",
+                                                ('operation',))
+            self._errors = metrics.counter("minion_task_engine_plugin_service_request_errors_total",
+                                           "Requests to a plugin service that failed.", ('operation',))
+
+    def _semaphore(self, url):
+        host = urlparse.urlparse(url).netloc
+        semaphore = self._semaphores.get(host)
+        if semaphore is None:
+            semaphore = self._semaphores[host] = DeferredSemaphore(self._max_connections_per_host)
+        return semaphore
+
+    #
+    # Cancel d if it has not fired within timeout seconds and turn the
+    # cancellation into a TimeoutError. Returns a function that starts
+    # the timeout again, for requests that should only time out when
+    # they make no progress.
+    #
+
+    def _apply_timeout(self, d, timeout, message):
+        timed_out = []
+        def _timeout():
+            timed_out.append(True)
+            d.cancel()
+        timer = reactor.callLater(timeout, _timeout)
+
+        def _finished(result):
+            if timer.active():
+                timer.cancel()
+            if timed_out and isinstance(result, Failure) and result.check(CancelledError):
+                raise TimeoutError(message)
+            return result
+        d.addBoth(_finished)
+
+        def _restart():
+            if timer.active():
+                timer.reset(timeout)
+        return _restart
+
+    #
+    # Do a single request and read the response body. If the complete
+    # response has not been received within the timeout then the
+    # request is cancelled and fails with a TimeoutError.
+    #
+
+    def _request(self, method, url, body):
+        headers = Headers({'User-Agent': ['Minion TaskEngine']})
+        producer = None
+        if body is not None:
+            producer = StringProducer(body)
+
+        def _read_response(response):
+            body = readBody(response)
+            if response.code != 200:
+                def _error(_):
+                    raise PluginServiceError("%s %s returned HTTP %d" % (method, url, response.code))
+                body.addCallback(_error)
+            return body
+
+        d = self._agent.request(method, url.encode('ascii'), headers, producer)
+        d.addCallback(_read_response)
+        self._apply_timeout(d, self._timeout, "%s %s timed out after %d seconds" % (method, url, self._timeout))
+        return d
+
+    #
+    # Download a response body into a file. The body is written to a
+    # temporary file next to the destination as it comes in, checked
+    # against the Digest header if the plugin service sent one and then
+    # renamed into place. The timeout is reset whenever data comes in,
+    # so that large downloads can take as long as they need.
+    #
+
+    def _download(self, url, path):
+        headers = Headers({'User-Agent': ['Minion TaskEngine']})
+        fd, temporary_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.', suffix='.tmp')
+        file = os.fdopen(fd, 'wb')
+        expected = []
+
+        def _read_response(response):
+            if response.code != 200:
+                def _error(_):
+                    raise PluginServiceError("GET %s returned HTTP %d" % (url, response.code))
+                return readBody(response).addCallback(_error)
+            for value in response.headers.getRawHeaders('Digest', []):
+                for digest in value.split(','):
+                    algorithm, _, digest = digest.strip().partition('=')
+                    if algorithm.upper() == 'SHA-256':
+                        expected.append(digest)
+            writer = FileWriter(file, lambda: restart_timeout())
+            response.deliverBody(writer)
+            return writer.finished
+
+        def _verify(digest):
+            file.close()
+            if expected and expected[0] != digest:
+                raise PluginServiceError("GET %s failed checksum verification" % url)
+            # mkstemp creates the file only readable by us
+            os.chmod(temporary_path, 0644)
+            os.rename(temporary_path, path)
+
+        def _cleanup(failure):
+            file.close()
+            os.remove(temporary_path)
+            return failure
+
+        d = self._agent.request('GET', url.encode('ascii'), headers, None)
+        d.addCallback(_read_response)
+        d.addCallback(_verify)
+        d.addErrback(_cleanup)
+        restart_timeout = self._apply_timeout(d, self._timeout,
+                                              "GET %s stalled for more than %d seconds" % (url, self._timeout))
+        return d
+
+    #
+    # Follow a Server-Sent Events stream. Calls received(event, id, data)
+    # for every event until the stream ends, which is when the returned
+    # deferred fires. The stream fails with a TimeoutError when nothing,
+    # not even a heartbeat, came in for idle_timeout seconds. Streams
+    # are long lived, so they do not count against the per host limit.
+    #
+
+    def stream(self, url, received, idle_timeout):
+        headers = Headers({'User-Agent': ['Minion TaskEngine'], 'Accept': ['text/event-stream']})
+
+        def _read_response(response):
+            if response.code != 200:
+                def _error(_):
+                    raise PluginServiceError("GET %s returned HTTP %d" % (url, response.code))
+                return readBody(response).addCallback(_error)
+            reader = EventStreamReader(received, lambda: restart_timeout())
+            response.deliverBody(reader)
+            return reader.finished
+
+        d = self._agent.request('GET', url.encode('ascii'), headers, None)
+        d.addCallback(_read_response)
+        restart_timeout = self._apply_timeout(d, idle_timeout,
+                                              "GET %s was idle for more than %d seconds" % (url, idle_timeout))
+        return d
+
+    #
+    # Run a request through the per host limit. Idempotent requests
+    # are retried a few times when the connection failed.
+    #
+
+    @inlineCallbacks
+    def _run(self, method, url, function, *args):
+        attempt = 0
+        while True:
+            try:
+                result = yield self._semaphore(url).run(function, *args)
+                returnValue(result)
+            except RETRYABLE_ERRORS as e:
+                if method not in IDEMPOTENT_METHODS or attempt >= self._retries:
+                    raise
+                attempt += 1
+                logging.warning("Retrying %s %s after failure: %s" % (method, url, str(e)))
+                yield deferLater(reactor, self._retry_delay * attempt, lambda: None)
+
+    # Run a request and record how long it took and whether it failed.
+
+    def _measure(self, method, url, function, *args):
+        d = self._run(method, url, function, *args)
+        if self._durations is None:
+            return d
+        operation = _operation(method, url)
+        started = time.time()
+        def _done(result):
+            self._durations.observe(time.time() - started, operation=operation)
+            if isinstance(result, Failure) and not result.check(CancelledError):
+                self._errors.inc(operation=operation)
+            return result
+        return d.addBoth(_done)
+
+    #
+    # Do a request and return the response body.
+    #
+
+    def request_body(self, method, url, body=None):
+        return self._measure(method, url, self._request, method, url, body)
+
+    #
+    # Download the response body of a GET request into the file at path.
+    # The file is only created once the complete body was received and
+    # verified.
+    #
+
+    def download(self, url, path):
+        return self._measure('GET', url, self._download, url, path)
+
+    #
+    # Do a request and return the decoded JSON response.
+    #
+
+    def request(self, method, url, body=None):
+        return self.request_body(method, url, body).addCallback(json.loads)
+
+    def close(self):
+        return self._pool.closeCachedConnections()
+
@@ -0,0 +1,517 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import logging
+import os
+import sqlite3
+from collections import OrderedDict
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks, returnValue
+from twisted.internet.task import deferLater
+from twisted.internet.threads import deferToThread, deferToThreadPool
+from twisted.python.threadpool import ThreadPool
+
+
+#
+# Scans are stored as the summary that TaskEngineSession.summary()
+# returns. Besides loading, storing and deleting a scan by id, a scan
+# database can find scans by target, plan and state. find() returns
+# small descriptions of the matching scans, most recently finished
+# first.
+#
+# While a scan runs, the oldest entries of its issue log can be moved
+# out of memory into the database with store_issues(). The entries are
+# [session_index, issue] lists, stored by their position in the log,
+# and load_issues() returns those with start <= position < end.
+#
+
+def _scan_description(scan):
+    return { 'id': scan['id'],
+             'state': scan['state'],
+             'plan': scan['plan']['name'],
+             'target': scan['configuration'].get('target'),
+             'created': scan.get('created'),
+             'finished': scan.get('finished') }
+
+def _find_scans(descriptions, target, plan, state, limit):
+    found = []
+    for description in descriptions:
+        if target is not None and description['target'] != target:
+            continue
+        if plan is not None and description['plan'] != plan:
+            continue
+        if state is not None and description['state'] != state:
+            continue
+        found.append(description)
+    found.sort(key=lambda d: d['finished'], reverse=True)
+    return found[:limit]
+
+
+class ScanDatabase:
+    def load(self, scan_id):
+        pass
+    def store(self, scan):
+        pass
+    def delete(self, scan_id):
+        pass
+    def find(self, target=None, plan=None, state=None, limit=None):
+        pass
+    def store_issues(self, scan_id, position, entries):
+        pass
+    def load_issues(self, scan_id, start, end):
+        pass
+    def delete_issues(self, scan_id):
+        pass
+
+class MemoryScanDatabase(ScanDatabase):
+
+    def __init__(self, path):
+        self._scans = {}
+        self._issues = {}
+
+    def load(self, scan_id):
+        def _main():
+            return self._scans.get(scan_id)
+        return deferLater(reactor, 0, _main)
+
+    def store(self, scan):
+        def _main():
+            self._scans[scan['id']] = scan
+        return deferLater(reactor, 0, _main)
+
+    def delete(self, scan_id):
+        def _main():
+            if scan_id in self._scans:
+                del self._scans[scan_id]
+        return deferLater(reactor, 0, _main)
+
+    def find(self, target=None, plan=None, state=None, limit=None):
+        def _main():
+            return _find_scans([_scan_description(scan) for scan in self._scans.values()], target, plan, state, limit)
+        return deferLater(reactor, 0, _main)
+
+    def store_issues(self, scan_id, position, entries):
+        def _main():
+            issues = self._issues.setdefault(scan_id, [])
+            del issues[position:]
+            issues.extend(entries)
+        return deferLater(reactor, 0, _main)
+
+    def load_issues(self, scan_id, start, end):
+        def _main():
+            return self._issues.get(scan_id, [])[start:end]
+        return deferLater(reactor, 0, _main)
+
+    def delete_issues(self, scan_id):
+        def _main():
+            self._issues.pop(scan_id, None)
+        return deferLater(reactor, 0, _main)
+
+class FileScanDatabase(ScanDatabase):
+
+    """
+    Scans stored as JSON files in a directory. There is no index on
+    disk, so the descriptions of all scans are read once, the first
+    time that scans are searched, and kept up to date in memory as
+    scans are stored and deleted. They are indexed by target, which
+    is what scans are searched on when a new scan is created.
+    """
+
+    def __init__(self, path):
+        self._path = os.path.expanduser(path)
+        if not os.path.exists(self._path):
+            logging.info("Creating scan database directory %s" % self._path)
+            os.mkdir(self._path)
+        self._descriptions = None
+        self._targets = {}
+        self._reading = None
+        self._changes = {}
+
+    def _describe(self, scan_id, description):
+        previous = self._descriptions.pop(scan_id, None)
+        if previous is not None:
+            self._targets[previous['target']].discard(scan_id)
+            if not self._targets[previous['target']]:
+                del self._targets[previous['target']]
+        if description is not None:
+            self._descriptions[scan_id] = description
+            self._targets.setdefault(description['target'], set()).add(scan_id)
+
+    # Record a change in the descriptions. When they are being read we
+    # do not know if the read sees the change, so it is applied after.
+
+    def _changed(self, scan_id, description):
+        if self._descriptions is not None:
+            self._describe(scan_id, description)
+        elif self._reading is not None:
+            self._changes[scan_id] = description
+
+    def load(self, scan_id):
+        def _main():
+            path = os.path.join(self._path, scan_id)
+            if os.path.isfile(path):
+                with open(path) as file:
+                    return json.load(file)
+        return deferToThread(_main)
+
+    def store(self, scan):
+        def _main():
+            path = os.path.join(self._path, scan['id'])
+            with open(path, "w") as file:
+                json.dump(scan, file, indent=4)
+        description = _scan_description(scan)
+        return deferToThread(_main).addCallback(lambda _: self._changed(scan['id'], description))
+
+    def delete(self, scan_id):
+        def _main():
+            path = os.path.join(self._path, scan_id)
+            if os.path.isfile(path):
+                os.remove(path)
+        return deferToThread(_main).addCallback(lambda _: self._changed(scan_id, None))
+
+    # Read the descriptions of all scans in a thread and let everyone who
+    # was waiting for them know
+
+    @inlineCallbacks
+    def _read_descriptions(self):
+        def _main():
+            descriptions = {}
+            for name in os.listdir(self._path):
+                # Skip the issue logs of running scans
+                if '.' in name:
+                    continue
+                with open(os.path.join(self._path, name)) as file:
+                    descriptions[name] = _scan_description(json.load(file))
+            return descriptions
+        try:
+            descriptions = yield deferToThread(_main)
+        except Exception as e:
+            waiting, self._reading, self._changes = self._reading, None, {}
+            for d in waiting:
+                d.errback(e)
+            return
+        self._descriptions = {}
+        for scan_id,description in descriptions.items() + self._changes.items():
+            self._describe(scan_id, description)
+        waiting, self._reading, self._changes = self._reading, None, {}
+        for d in waiting:
+            d.callback(None)
+
+    def _find(self, target, plan, state, limit):
+        if target is None:
+            descriptions = self._descriptions.values()
+        else:
+            descriptions = [self._descriptions[scan_id] for scan_id in self._targets.get(target, ())]
+        return _find_scans(descriptions, target, plan, state, limit)
+
+    def find(self, target=None, plan=None, state=None, limit=None):
+        if self._descriptions is not None:
+            return deferLater(reactor, 0, lambda: self._find(target, plan, state, limit))
+        d = Deferred()
+        if self._reading is None:
+            self._reading = [d]
+            self._read_descriptions()
+        else:
+            self._reading.append(d)
+        return d.addCallback(lambda _: self._find(target, plan, state, limit))
+
+    # The issue log of a scan is a file next to it with one entry per
+    # line. Entries are only ever added to the end of the log.
+
+    def store_issues(self, scan_id, position, entries):
+        def _main():
+            with open(os.path.join(self._path, scan_id + ".issues"), "a") as file:
+                for index,entry in enumerate(entries):
+                    file.write(json.dumps([position + index] + list(entry)) + "\n")
+        return deferToThread(_main)
+
+    def load_issues(self, scan_id, start, end):
+        def _main():
+            path = os.path.join(self._path, scan_id + ".issues")
+            entries = {}
+            if os.path.isfile(path):
+                with open(path) as file:
+                    for line in file:
+                        entry = json.loads(line)
+                        if start <= entry[0] < end:
+                            entries[entry[0]] = entry[1:]
+            return [entries[position] for position in sorted(entries)]
+        return deferToThread(_main)
+
+    def delete_issues(self, scan_id):
+        def _main():
+            path = os.path.join(self._path, scan_id + ".issues")
+            if os.path.isfile(path):
+                os.remove(path)
+        return deferToThread(_main)
+
+
+class SQLiteScanStore:
+
+    """
+    Synchronous storage of scans in an SQLite database. The scan itself
+    is stored as a JSON document without its issues, the issues are
+    stored in their own table. The columns that scans are searched on
+    are indexed. This is used by SQLiteScanDatabase from its own thread
+    and directly by tools like the migration script.
+    """
+
+    SCHEMA = [
+        """CREATE TABLE IF NOT EXISTS scans (id TEXT PRIMARY KEY, state TEXT, plan TEXT, target TEXT,
+                                             created INTEGER, finished INTEGER, document TEXT)""",
+        "CREATE INDEX IF NOT EXISTS scans_target ON scans (target)",
+        "CREATE INDEX IF NOT EXISTS scans_plan ON scans (plan)",
+        "CREATE INDEX IF NOT EXISTS scans_state ON scans (state)",
+        "CREATE INDEX IF NOT EXISTS scans_finished ON scans (finished)",
+        """CREATE TABLE IF NOT EXISTS issues (scan_id TEXT, session_id TEXT, position INTEGER, issue TEXT,
+                                              PRIMARY KEY (scan_id, session_id, position))""",
+        """CREATE TABLE IF NOT EXISTS issue_log (scan_id TEXT, position INTEGER, session_index INTEGER, issue TEXT,
+                                                 PRIMARY KEY (scan_id, position))""",
+    ]
+
+    def __init__(self, path, check_same_thread=True):
+        self._connection = sqlite3.connect(path, check_same_thread=check_same_thread)
+        self._connection.execute("PRAGMA journal_mode=WAL")
+        self._connection.execute("PRAGMA synchronous=NORMAL")
+        with self._connection:
+            for statement in self.SCHEMA:
+                self._connection.execute(statement)
+
+    def load(self, scan_id):
+        row = self._connection.execute("SELECT document FROM scans WHERE id = ?", (scan_id,)).fetchone()
+        if row is None:
+            return None
+        scan = json.loads(row[0])
+        issues = {}
+        cursor = self._connection.execute("SELECT session_id, issue FROM issues WHERE scan_id = ? ORDER BY session_id, position",
+                                          (scan_id,))
+        for session_id,issue in cursor:
+            issues.setdefault(session_id, []).append(json.loads(issue))
+        for session in scan['sessions']:
+            session['issues'] = issues.get(session['id'], [])
+        return scan
+
+    def store(self, scan):
+        description = _scan_description(scan)
+        sessions = []
+        rows = []
+        for session in scan['sessions']:
+            session = dict(session)
+            for position,issue in enumerate(session.pop('issues', [])):
+                rows.append((scan['id'], session['id'], position, json.dumps(issue)))
+            sessions.append(session)
+        document = dict(scan, sessions=sessions)
+        with self._connection:
+            self._connection.execute("INSERT OR REPLACE INTO scans VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                     (scan['id'], description['state'], description['plan'], description['target'],
+                                      description['created'], description['finished'], json.dumps(document)))
+            self._connection.execute("DELETE FROM issues WHERE scan_id = ?", (scan['id'],))
+            self._connection.executemany("INSERT INTO issues VALUES (?, ?, ?, ?)", rows)
+
+    def delete(self, scan_id):
+        with self._connection:
+            self._connection.execute("DELETE FROM scans WHERE id = ?", (scan_id,))
+            self._connection.execute("DELETE FROM issues WHERE scan_id = ?", (scan_id,))
+
+    def find(self, target=None, plan=None, state=None, limit=None):
+        conditions = []
+        parameters = []
+        for column,value in (('target', target), ('plan', plan), ('state', state)):
+            if value is not None:
+                conditions.append("%s = ?" % column)
+                parameters.append(value)
+        query = "SELECT id, state, plan, target, created, finished FROM scans"
+        if conditions:
+            query += " WHERE " + " AND ".join(conditions)
+        query += " ORDER BY finished DESC"
+        if limit is not None:
+            query += " LIMIT ?"
+            parameters.append(limit)
+        columns = ('id', 'state', 'plan', 'target', 'created', 'finished')
+        return [dict(zip(columns, row)) for row in self._connection.execute(query, parameters)]
+
+    def store_issues(self, scan_id, position, entries):
+        rows = [(scan_id, position + index, session_index, json.dumps(issue))
+                for index,(session_index,issue) in enumerate(entries)]
+        with self._connection:
+            self._connection.executemany("INSERT OR REPLACE INTO issue_log VALUES (?, ?, ?, ?)", rows)
+
+    def load_issues(self, scan_id, start, end):
+        cursor = self._connection.execute("""SELECT session_index, issue FROM issue_log
+                                             WHERE scan_id = ? AND position >= ? AND position < ?
+                                             ORDER BY position""", (scan_id, start, end))
+        return [[session_index, json.loads(issue)] for session_index,issue in cursor]
+
+    def delete_issues(self, scan_id):
+        with self._connection:
+            self._connection.execute("DELETE FROM issue_log WHERE scan_id = ?", (scan_id,))
+
+    def close(self):
+        self._connection.close()
+
+
+class SQLiteScanDatabase(ScanDatabase):
+
+    """
+    Scan database on top of SQLiteScanStore. All database I/O happens on
+    one dedicated thread, which owns the SQLite connection, so that it
+    never blocks the reactor and never competes with other work for the
+    shared reactor thread pool.
+    """
+
+    def __init__(self, path):
+        self._path = os.path.expanduser(path)
+        # The connection is opened here so that a bad database fails at
+        # startup. From now on it is only used from our own thread.
+        logging.info("Opening scan database %s" % self._path)
+        self._store = SQLiteScanStore(self._path, check_same_thread=False)
+        self._pool = ThreadPool(minthreads=1, maxthreads=1, name="SQLiteScanDatabase")
+        self._pool.start()
+        reactor.addSystemEventTrigger('during', 'shutdown', self._shutdown)
+
+    # Stopping the pool waits for the queued work to finish, after that
+    # nothing uses the connection anymore and it can be closed here.
+
+    def _shutdown(self):
+        self._pool.stop()
+        self._store.close()
+
+    def _run(self, function, *args, **kwargs):
+        return deferToThreadPool(reactor, self._pool, function, *args, **kwargs)
+
+    def load(self, scan_id):
+        return self._run(lambda: self._store.load(scan_id))
+
+    def store(self, scan):
+        return self._run(lambda: self._store.store(scan))
+
+    def delete(self, scan_id):
+        return self._run(lambda: self._store.delete(scan_id))
+
+    def find(self, target=None, plan=None, state=None, limit=None):
+        return self._run(lambda: self._store.find(target, plan, state, limit))
+
+    def store_issues(self, scan_id, position, entries):
+        return self._run(lambda: self._store.store_issues(scan_id, position, entries))
+
+    def load_issues(self, scan_id, start, end):
+        return self._run(lambda: self._store.load_issues(scan_id, start, end))
+
+    def delete_issues(self, scan_id):
+        return self._run(lambda: self._store.delete_issues(scan_id))
+
+
+SCAN_DATABASE_CACHE_SIZE = 64 * 1024 * 1024
+
+class CachingScanDatabase(ScanDatabase):
+
+    """
+    Read-through cache in front of another scan database. Scans only end
+    up in the database when they are done, so a loaded scan does not
+    change until it is stored again or deleted, which both invalidate
+    it. The cache keeps the parsed scan and its JSON serialization and
+    evicts the least recently used scans when the serialized scans take
+    more than max_size bytes.
+    """
+
+    def __init__(self, database, max_size=SCAN_DATABASE_CACHE_SIZE):
+        self._database = database
+        self._max_size = max_size
+        self._entries = OrderedDict()
+        self._size = 0
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _invalidate(self, scan_id):
+        self._generation += 1
+        entry = self._entries.pop(scan_id, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+
+    def _insert(self, scan_id, scan, serialized):
+        if len(serialized) > self._max_size:
+            return
+        self._entries[scan_id] = (scan, serialized)
+        self._size += len(serialized)
+        while self._size > self._max_size:
+            _,(_,evicted) = self._entries.popitem(last=False)
+            self._size -= len(evicted)
+            self.evictions += 1
+
+    #
+    # Return the cached (scan, serialized) entry, loading it from the
+    # database on a miss. A load that raced with a store or delete of
+    # any scan is returned but not cached.
+    #
+
+    @inlineCallbacks
+    def _load(self, scan_id):
+        entry = self._entries.pop(scan_id, None)
+        if entry is not None:
+            self.hits += 1
+            self._entries[scan_id] = entry
+            returnValue(entry)
+        self.misses += 1
+        generation = self._generation
+        scan = yield self._database.load(scan_id)
+        if scan is None:
+            returnValue(None)
+        entry = (scan, json.dumps(scan))
+        if generation == self._generation and scan_id not in self._entries:
+            self._insert(scan_id, *entry)
+        returnValue(entry)
+
+    def load(self, scan_id):
+        return self._load(scan_id).addCallback(lambda entry: entry[0] if entry else None)
+
+    # Like load() but returns the scan as a JSON string
+
+    def load_serialized(self, scan_id):
+        return self._load(scan_id).addCallback(lambda entry: entry[1] if entry else None)
+
+    # Invalidate both before and after the change so that a load that
+    # ran while the change was in progress does not get cached.
+
+    def _change(self, scan_id, d):
+        def _changed(result):
+            self._invalidate(scan_id)
+            return result
+        return d.addBoth(_changed)
+
+    def store(self, scan):
+        self._invalidate(scan['id'])
+        return self._change(scan['id'], self._database.store(scan))
+
+    def delete(self, scan_id):
+        self._invalidate(scan_id)
+        return self._change(scan_id, self._database.delete(scan_id))
+
+    def find(self, target=None, plan=None, state=None, limit=None):
+        return self._database.find(target, plan, state, limit)
+
+    # The issue logs of running scans are not cached
+
+    def store_issues(self, scan_id, position, entries):
+        return self._database.store_issues(scan_id, position, entries)
+
+    def load_issues(self, scan_id, start, end):
+        return self._database.load_issues(scan_id, start, end)
+
+    def delete_issues(self, scan_id):
+        return self._database.delete_issues(scan_id)
+
+    def stats(self):
+        return { 'hits': self.hits,
+                 'misses': self.misses,
+                 'evictions': self.evictions,
+                 'entries': len(self._entries),
+                 'size': self._size,
+                 'max_size': self._max_size }
+
+
+SCAN_DATABASE_CLASSES = { 'files': FileScanDatabase, 'memory': MemoryScanDatabase, 'sqlite': SQLiteScanDatabase }
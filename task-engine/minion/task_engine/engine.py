@@ -3,21 +3,42 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import copy
+import hashlib
+import heapq
 import json
 import logging
+import math
 import os
+import socket
+import time
+import urlparse
 import uuid
-
-import cyclone.web
+from collections import OrderedDict
 
 from twisted.internet import reactor
-from twisted.internet.defer import DeferredSemaphore
-from twisted.internet.defer import inlineCallbacks, returnValue
-from twisted.internet.task import deferLater, LoopingCall
-from twisted.internet.threads import deferToThread
-from twisted.web.client import getPage
+from twisted.internet.defer import CancelledError, Deferred, DeferredList
+from twisted.internet.defer import inlineCallbacks, maybeDeferred, returnValue, succeed
+from twisted.internet.error import TimeoutError
+from twisted.internet.task import LoopingCall, deferLater
+from twisted.python.failure import Failure
+
+from minion.task_engine.client import PluginServiceClient, PluginServiceError
+from minion.task_engine.journal import ScanJournal
+from minion.task_engine.metrics import MetricsRegistry
+from minion.task_engine.schedule import RecurringScans
 
-import cyclone.httpclient
+#
+# A plan is a workflow of plugins. Steps of a workflow run in parallel
+# unless a step lists earlier steps in depends_on, in which case it only
+# starts when those steps have finished. A step is referred to by its
+# index in the workflow, by its id if it has one or by its plugin name,
+# which refers to all earlier steps with that plugin. A step of which a
+# dependency failed or was stopped does not run, it is STOPPED. A plan
+# can limit how many of its plugins run at the same time with
+# max_parallel.
+# The cost of a plan is how much of the scan admission budget a scan
+# with that plan takes while it runs; plans without one cost 1.
+#
 
 PLANS = {}
 
@@ -73,6 +94,7 @@ PLANS['scratch'] = {
 PLANS['stomp'] = {
     'name': 'stomp',
     'description': 'Run Garmr and do a full port scan using NMAP, then run ZAP.',
+    'cost': 3,
     'workflow': [
         {
             'plugin_name': 'minion.plugins.garmr.GarmrPlugin',
@@ -91,6 +113,7 @@ PLANS['stomp'] = {
         {
             'plugin_name': 'minion.plugins.zap_plugin.ZAPPlugin',
             'description': "Spider",
+            'depends_on': ['minion.plugins.garmr.GarmrPlugin', 'minion.plugins.nmap.NMAPPlugin'],
             'configuration': {
                 'scan': True
             }
@@ -101,6 +124,7 @@ PLANS['stomp'] = {
 PLANS['punch'] = {
     'name': 'punch',
     'description': 'Run Garmr, NMAP, ZAP and Skipfish.',
+    'cost': 4,
     'workflow': [
         {
             'plugin_name': 'minion.plugins.garmr.GarmrPlugin',
@@ -136,6 +160,7 @@ PLANS['punch'] = {
 PLANS['zapspider'] = {
     'name': 'zapspider',
     'description': 'Run the ZAP Spider',
+    'cost': 2,
     'workflow': [
         {
             'plugin_name': 'minion.plugins.zap_plugin.ZAPPlugin',
@@ -150,6 +175,7 @@ PLANS['zapspider'] = {
 PLANS['zapfull'] = {
     'name': 'zapfull',
     'description': 'Run the ZAP Spider and Scanner',
+    'cost': 3,
     'workflow': [
         {
             'plugin_name': 'minion.plugins.zap_plugin.ZAPPlugin',
@@ -164,84 +190,1221 @@ PLANS['zapfull'] = {
 
 PLUGIN_SERVICE_API = "http://localhost:8181"
 PLUGIN_SERVICE_POLL_INTERVAL = 1.0
+PLUGIN_SERVICE_TIMEOUT = 10.0
+PLUGIN_SERVICE_MAX_CONCURRENCY = 32
+
+PLUGIN_SERVICE_BATCH_SIZE = 250
+
+PLUGIN_SERVICE_EVENTS_POLL_INTERVAL = 15.0
+PLUGIN_SERVICE_EVENTS_IDLE_TIMEOUT = 60.0
+PLUGIN_SERVICE_EVENTS_RECONNECT_DELAY = 1.0
+PLUGIN_SERVICE_EVENTS_MAX_RECONNECT_DELAY = 30.0
+PLUGIN_SERVICE_EVENTS_ACK_INTERVAL = 1.0
+
+PLUGIN_SERVICE_HEALTH_CHECK_INTERVAL = 10.0
+
+PLUGIN_CATALOG_TTL = 300.0
+PLUGIN_CATALOG_MIN_REFRESH_INTERVAL = 10.0
+
+SCAN_IDLE_DEADLINE = 30.0
+SCAN_MAX_PARALLEL_SESSIONS = 4
+
+SCAN_STATES = ('CREATED', 'QUEUED', 'STARTED', 'STOPPING', 'FINISHED', 'FAILED', 'STOPPED')
+SCAN_PRIORITIES = ('high', 'normal', 'low')
+SCAN_DEFAULT_PRIORITY = 'normal'
+SCAN_DEFAULT_COST = 1
+SCAN_ADMISSION_BUDGET = 8
+SCAN_DURATION_SMOOTHING = 0.3
+
+SCAN_MAX_ISSUE_MEMORY = 4 * 1024 * 1024
+SCAN_DISTINCT_ISSUE_MAX_URLS = 100
+SCAN_BASELINE_CACHE_SIZE = 1000
+SCAN_RECOVERY_RETRIES = 4
+SCAN_RECOVERY_RETRY_DELAY = 1.0
+
+PLUGIN_RESULT_CACHE_TTL = 3600.0
+PLUGIN_RESULT_CACHE_SIZE = 10000
+
+
+class TaskEngineScheduler:
+
+    """
+    Decides when TaskEngineSession.idle() runs for a scan. Instead of
+    idling all scans on a fixed tick, a scan is only idled when it has
+    been woken up: when its state was changed, when one of its plugin
+    sessions made progress or when a timer that it asked for is due.
+    Scans that have nothing to do have no timer and cost nothing.
+
+    Every scan is idled independently, so a scan that is waiting on a
+    slow plugin service response does not hold up any other scan. If
+    idling a scan takes longer than the deadline then it is cancelled
+    and retried later.
+
+    Timers are aligned to multiples of their delay. Scans that poll
+    with the same interval are therefore idled in the same reactor
+    turn, which lets their plugin service requests be batched.
+    """
+
+    def __init__(self, finished_callback, deadline=SCAN_IDLE_DEADLINE, metrics=None):
+        self._finished_callback = finished_callback
+        self._deadline = deadline
+        self._timers = {}
+        self._running = {}
+        self._durations = None
+        self._lags = None
+        if metrics is not None:
+            self._durations = metrics.histogram("minion_task_engine_scan_idle_duration_seconds",
+                                                "Time it took to idle a scan.")
+            self._lags = metrics.histogram("minion_task_engine_scan_idle_lag_seconds",
+                                           "Time between when a scan was due to be idled and when it was.")
+
+    #
+    # Ask for the scan to be idled after delay seconds. Multiple
+    # wakeups are coalesced; the earliest one wins. If the scan is
+    # being idled right now then the wakeup is remembered and
+    # scheduled when idle() returns.
+    #
+
+    def wakeup(self, session, delay=0):
+        if session.id in self._running:
+            pending = self._running[session.id]
+            if pending is None or delay < pending:
+                self._running[session.id] = delay
+            return
+        now = reactor.seconds()
+        when = now
+        if delay > 0:
+            when = (math.floor(now / delay) + 1) * delay
+        timer = self._timers.get(session.id)
+        if timer is not None:
+            if timer.getTime() <= when:
+                return
+            timer.cancel()
+        self._timers[session.id] = reactor.callLater(when - now, self._idle, session, when)
+
+    def cancel(self, session):
+        timer = self._timers.pop(session.id, None)
+        if timer is not None:
+            timer.cancel()
+
+    @inlineCallbacks
+    def _idle(self, session, when):
+        self._timers.pop(session.id, None)
+        self._running[session.id] = None
+        started = reactor.seconds()
+        if self._lags is not None:
+            self._lags.observe(max(started - when, 0))
+        done = False
+        deferred = session.idle()
+        timer = reactor.callLater(self._deadline, deferred.cancel)
+        try:
+            logging.debug("Idling session {}".format(session.id))
+            done = yield deferred
+        finally:
+            if timer.active():
+                timer.cancel()
+            delay = self._running.pop(session.id)
+            if self._durations is not None:
+                self._durations.observe(reactor.seconds() - started)
+        if done:
+            self._finished_callback(session)
+        elif delay is not None:
+            self.wakeup(session, delay)
+
+
+class ScanAdmissionQueue:
+
+    """
+    Decides when started scans actually run. Scans wait in the QUEUED
+    state until their cost fits in what is left of the budget. Queued
+    scans are admitted by priority and in the order in which they were
+    started within a priority. A scan that does not fit holds up the
+    scans behind it, so that big scans are not starved by small ones.
+    A scan that costs more than the whole budget runs on its own.
+
+    To estimate when queued scans will start, we keep a moving average
+    of how long scans of each plan ran.
+    """
+
+    def __init__(self, budget=SCAN_ADMISSION_BUDGET):
+        self._budget = budget
+        self._queues = dict((priority, []) for priority in SCAN_PRIORITIES)
+        self._running = {}
+        self._used = 0
+        self._durations = {}
+
+    def _cost(self, scan):
+        return min(scan.plan.get('cost', SCAN_DEFAULT_COST), self._budget)
+
+    def _queued(self):
+        return [scan for priority in SCAN_PRIORITIES for scan in self._queues[priority]]
+
+    def queued(self):
+        return sum(len(queue) for queue in self._queues.values())
+
+    def enqueue(self, scan):
+        self._queues[scan.priority].append(scan)
+        self._admit()
+
+    # Take a queued scan out of the queue, for when it is stopped before
+    # it was admitted.
+
+    def remove(self, scan):
+        queue = self._queues[scan.priority]
+        if scan in queue:
+            queue.remove(scan)
+            self._admit()
+
+    # Take back a scan that was running before the task engine restarted.
+    # It keeps running, even if that takes more than the budget.
+
+    def readmit(self, scan):
+        cost = self._cost(scan)
+        self._running[scan.id] = (scan, cost, time.time())
+        self._used += cost
+
+    # Give back the budget of a scan that is done.
+
+    def release(self, scan):
+        entry = self._running.pop(scan.id, None)
+        if entry is None:
+            return
+        _, cost, admitted = entry
+        self._used -= cost
+        duration = time.time() - admitted
+        average = self._durations.get(scan.plan['name'])
+        if average is not None:
+            duration = average + SCAN_DURATION_SMOOTHING * (duration - average)
+        self._durations[scan.plan['name']] = duration
+        self._admit()
+
+    def _admit(self):
+        for scan in self._queued():
+            cost = self._cost(scan)
+            if self._used + cost > self._budget:
+                break
+            self._queues[scan.priority].remove(scan)
+            self._running[scan.id] = (scan, cost, time.time())
+            self._used += cost
+            scan.admitted()
+        # The queue positions of the scans that are still waiting changed
+        for scan in self._queued():
+            scan.queue_changed()
+
+    #
+    # Return the position of a queued scan, starting at 1, and when we
+    # expect it to start. We play the queue forward assuming that scans
+    # take as long as earlier scans with the same plan. The estimate is
+    # None as long as we do not know how long a scan will take.
+    #
+
+    def position(self, scan):
+        now = time.time()
+        used = self._used
+        ends = []
+        for running,cost,admitted in self._running.values():
+            duration = self._durations.get(running.plan['name'])
+            if duration is None:
+                heapq.heappush(ends, (True, None, cost))
+            else:
+                heapq.heappush(ends, (False, max(now, admitted + duration), cost))
+        unknown = False
+        for position,queued in enumerate(self._queued()):
+            cost = self._cost(queued)
+            while used + cost > self._budget and ends:
+                unknown_end, end, released = heapq.heappop(ends)
+                if unknown_end:
+                    unknown = True
+                else:
+                    now = max(now, end)
+                used -= released
+            if queued is scan:
+                return position + 1, (None if unknown else int(now))
+            duration = self._durations.get(queued.plan['name'])
+            if duration is None:
+                heapq.heappush(ends, (True, None, cost))
+            else:
+                heapq.heappush(ends, (False, now + duration, cost))
+            used += cost
+        return None, None
+
+
+class PluginServiceBatcher:
+
+    """
+    Collects the plugin session status, state change and delete requests
+    that all scans make in the same reactor turn and sends them to the
+    plugin service as batch requests. Each caller still gets a Deferred
+    with the result for its own session, in the same form that the
+    single session API would have returned it. Older plugin services
+    that do not have the batch API get a request per session.
+    """
+
+    def __init__(self, client, batch_size=PLUGIN_SERVICE_BATCH_SIZE):
+        self._client = client
+        self._batch_size = batch_size
+        self._pending = {}
+        self._flusher = None
+
+    def summary(self, plugin_service_api, session_id):
+        return self._add(plugin_service_api, 'summary', None, session_id)
+
+    def change_state(self, plugin_service_api, session_id, state):
+        return self._add(plugin_service_api, 'state', state, session_id)
+
+    def delete(self, plugin_service_api, session_id):
+        return self._add(plugin_service_api, 'delete', None, session_id)
+
+    def _add(self, plugin_service_api, operation, argument, session_id):
+        d = Deferred()
+        batch = self._pending.setdefault((plugin_service_api, operation, argument), {})
+        batch.setdefault(session_id, []).append(d)
+        if self._flusher is None:
+            self._flusher = reactor.callLater(0, self._flush)
+        return d
+
+    def _flush(self):
+        self._flusher = None
+        pending, self._pending = self._pending, {}
+        for (plugin_service_api, operation, argument),batch in pending.items():
+            session_ids = batch.keys()
+            for i in range(0, len(session_ids), self._batch_size):
+                chunk = dict((session_id, batch[session_id]) for session_id in session_ids[i:i+self._batch_size])
+                self._send(plugin_service_api, operation, argument, chunk)
+
+    def _request(self, plugin_service_api, operation, argument, session_ids):
+        if operation == 'summary':
+            return self._client.request('POST', plugin_service_api + "/sessions/summary", json.dumps(session_ids))
+        if operation == 'state':
+            body = json.dumps({'state': argument, 'sessions': session_ids})
+            return self._client.request('PUT', plugin_service_api + "/sessions/state", body)
+        if operation == 'delete':
+            return self._client.request('POST', plugin_service_api + "/sessions/delete", json.dumps(session_ids))
+
+    def _request_single(self, plugin_service_api, operation, argument, session_id):
+        if operation == 'summary':
+            return self._client.request('GET', plugin_service_api + "/session/%s" % session_id)
+        if operation == 'state':
+            return self._client.request('PUT', plugin_service_api + "/session/%s/state" % session_id, argument)
+        if operation == 'delete':
+            return self._client.request('DELETE', plugin_service_api + "/session/%s" % session_id)
+
+    def _fire(self, deferreds, result):
+        for d in deferreds:
+            # The waiter may have been cancelled while the request was in flight
+            if not d.called:
+                if isinstance(result, Exception):
+                    d.errback(result)
+                else:
+                    d.callback(result)
+
+    #
+    # Send a batch request. If the plugin service does not support that
+    # then we fall back to a request per session. When the batch request
+    # fails, or the answer is not what we expect, everyone who was waiting
+    # for a session in the batch gets the failure.
+    #
+
+    @inlineCallbacks
+    def _send(self, plugin_service_api, operation, argument, batch):
+        try:
+            try:
+                response = yield self._request(plugin_service_api, operation, argument, batch.keys())
+            except PluginServiceError as e:
+                logging.debug("Batch %s request failed, sending single requests: %s" % (operation, str(e)))
+                yield DeferredList([self._send_single(plugin_service_api, operation, argument, session_id, deferreds)
+                                    for session_id,deferreds in batch.items()])
+                return
+            if not response.get('success'):
+                raise Exception(response.get('error', 'Batch %s request failed' % operation))
+            if 'errors' not in response or (operation == 'summary' and 'sessions' not in response):
+                raise Exception("Invalid response to batch %s request" % operation)
+        except Exception as e:
+            for deferreds in batch.values():
+                self._fire(deferreds, e)
+            return
+        for session_id,deferreds in batch.items():
+            error = response['errors'].get(session_id)
+            if operation == 'summary':
+                if not error and session_id not in response['sessions']:
+                    error = 'no-such-session'
+                if error:
+                    result = Exception(error)
+                else:
+                    result = {'success': True, 'session': response['sessions'][session_id]}
+            elif error:
+                result = {'success': False, 'error': error}
+            else:
+                result = {'success': True}
+            self._fire(deferreds, result)
+
+    @inlineCallbacks
+    def _send_single(self, plugin_service_api, operation, argument, session_id, deferreds):
+        try:
+            result = yield self._request_single(plugin_service_api, operation, argument, session_id)
+            if operation == 'summary' and not result['success']:
+                result = Exception(result['error'])
+        except Exception as e:
+            result = e
+        self._fire(deferreds, result)
+
+
+class PluginCatalog:
+
+    """
+    The descriptors of all plugins that the plugin service has, loaded
+    with a single GET /plugins. They rarely change, so they are kept for
+    ttl seconds and after that still used while a fresh copy is loaded
+    in the background. Only an empty catalog or a plugin that we do not
+    know about yet makes a caller wait for the plugin service, and for
+    the latter we do not ask again within min_refresh_interval seconds.
+    """
+
+    def __init__(self, client, plugin_service_api, ttl=PLUGIN_CATALOG_TTL,
+                 min_refresh_interval=PLUGIN_CATALOG_MIN_REFRESH_INTERVAL):
+        self._client = client
+        self._plugin_service_api = plugin_service_api
+        self._ttl = ttl
+        self._min_refresh_interval = min_refresh_interval
+        self._plugins = None
+        self._loaded = 0
+        self._waiters = []
+
+    #
+    # Load the catalog. Concurrent calls share the same request to the
+    # plugin service.
+    #
+
+    def refresh(self):
+        d = Deferred()
+        self._waiters.append(d)
+        if len(self._waiters) == 1:
+            self._load()
+        return d
+
+    @inlineCallbacks
+    def _load(self):
+        try:
+            response = yield self._client.request('GET', self._plugin_service_api + "/plugins")
+            self._plugins = dict((plugin['class'], plugin) for plugin in response['plugins'])
+            self._loaded = time.time()
+            result = self._plugins
+        except Exception:
+            result = Failure()
+        waiters, self._waiters = self._waiters, []
+        for d in waiters:
+            if isinstance(result, Failure):
+                d.errback(result)
+            else:
+                d.callback(result)
+
+    def refresh_in_background(self):
+        def _failed(failure):
+            logging.warning("Failed to refresh the plugin catalog: %s" % failure.getErrorMessage())
+        self.refresh().addErrback(_failed)
+
+    @inlineCallbacks
+    def get(self, plugin_name):
+        age = time.time() - self._loaded
+        if self._plugins is None or (plugin_name not in self._plugins and age > self._min_refresh_interval):
+            yield self.refresh()
+        elif age > self._ttl and not self._waiters:
+            self.refresh_in_background()
+        returnValue(self._plugins.get(plugin_name))
+
+
+class PluginServiceSubscription:
+
+    """
+    Follows the event stream of the plugin service, so that scans hear
+    about state changes, progress and issues of their plugin sessions as
+    they happen instead of at their next poll. Processed events are
+    acknowledged in the background. When the stream breaks we reconnect
+    and ask for the events after the last one that we processed. While
+    we are connected, scans only poll as a safety net. The subscriber
+    id stays the same when the task engine restarts, so that the plugin
+    service does not keep events around for a subscriber that is gone.
+    """
+
+    def __init__(self, client, plugin_service_api, event_callback, catch_up_callback, subscriber):
+        self._client = client
+        self._plugin_service_api = plugin_service_api
+        self._event_callback = event_callback
+        self._catch_up_callback = catch_up_callback
+        self._subscriber = subscriber
+        self._sequence = None
+        self._running = False
+        self._stream = None
+        self._acknowledger = None
+        self.connected = False
+
+    def start(self):
+        self._running = True
+        self._follow()
 
+    def stop(self):
+        self._running = False
+        if self._stream is not None:
+            self._stream.cancel()
 
-class ScanDatabase:
+    @inlineCallbacks
+    def _follow(self):
+        delay = PLUGIN_SERVICE_EVENTS_RECONNECT_DELAY
+        while self._running:
+            url = "%s/events?subscriber=%s" % (self._plugin_service_api, self._subscriber)
+            if self._sequence is not None:
+                url += "&after=%d" % self._sequence
+            self._stream = self._client.stream(url, self._received, PLUGIN_SERVICE_EVENTS_IDLE_TIMEOUT)
+            try:
+                yield self._stream
+            except Exception as e:
+                if self._running:
+                    logging.warning("Lost the event stream of %s: %s" % (self._plugin_service_api, str(e)))
+            finally:
+                self._stream = None
+            if self.connected:
+                delay = PLUGIN_SERVICE_EVENTS_RECONNECT_DELAY
+            self.connected = False
+            if self._running:
+                # Scans poll at their normal rate until we are back
+                self._catch_up_callback()
+                yield deferLater(reactor, delay, lambda: None)
+                delay = min(delay * 2, PLUGIN_SERVICE_EVENTS_MAX_RECONNECT_DELAY)
+
+    def _received(self, event, id, data):
+        data = json.loads(data)
+        if event == 'subscribed':
+            self.connected = True
+            if self._sequence is None:
+                self._sequence = data['sequence']
+            # Anything could have happened while we were not connected
+            self._catch_up_callback()
+        elif event == 'reset':
+            # The plugin service could not give us all events we missed
+            self._sequence = data['sequence']
+            self._catch_up_callback()
+        elif event == 'events':
+            for e in data:
+                self._event_callback(e)
+            self._sequence = int(id)
+            if self._acknowledger is None:
+                self._acknowledger = reactor.callLater(PLUGIN_SERVICE_EVENTS_ACK_INTERVAL, self._acknowledge)
+
+    @inlineCallbacks
+    def _acknowledge(self):
+        self._acknowledger = None
+        try:
+            yield self._client.request('POST', self._plugin_service_api + "/events/ack",
+                                       json.dumps({'subscriber': self._subscriber, 'sequence': self._sequence}))
+        except Exception as e:
+            logging.warning("Failed to acknowledge the events of %s: %s" % (self._plugin_service_api, str(e)))
+
+
+class PluginServiceNode:
+
+    """
+    One of the plugin services that the task engine runs plugin sessions
+    on, with its own plugin catalog and event subscription. The status
+    is what the plugin service last reported about how busy it is.
+    """
+
+    def __init__(self, client, plugin_service_api, plugin_catalog_ttl, event_callback, catch_up_callback, subscriber):
+        self.api = plugin_service_api
+        self.catalog = PluginCatalog(client, plugin_service_api, plugin_catalog_ttl)
+        self.subscription = PluginServiceSubscription(client, plugin_service_api, event_callback, catch_up_callback,
+                                                      subscriber)
+        self.healthy = True
+        self.status = None
+        self.assigned = 0
+
+    # The number of running plugin sessions per CPU, counting the ones
+    # that were created and are about to start and the ones that we
+    # created on this plugin service since it last reported its status.
+    # Finished sessions that have not been deleted yet do not count.
+    # Ties are broken on the load average per CPU.
+
+    def load(self):
+        if self.status is None:
+            return (self.assigned, 0)
+        cpus = float(self.status['cpus'])
+        sessions = self.status['running'] + self.status['created'] + self.assigned
+        return (sessions / cpus, self.status['load'] / cpus)
+
+    def description(self):
+        return { 'api': self.api,
+                 'healthy': self.healthy,
+                 'subscribed': self.subscription.connected,
+                 'status': self.status }
+
+
+class PluginServicePool:
+
+    """
+    The plugin services that the task engine spreads its plugin sessions
+    over. Every plugin session goes to the least loaded healthy plugin
+    service that has its plugin and stays there, so the plugin service
+    is recorded in the session. Plugin services are checked every
+    health_check_interval seconds. One that does not answer is not given
+    new sessions until it answers again. Plugin services are assumed to
+    be healthy until the first check says otherwise.
+    """
+
+    def __init__(self, client, plugin_service_apis, event_callback, catch_up_callback,
+                 plugin_catalog_ttl=PLUGIN_CATALOG_TTL,
+                 health_check_interval=PLUGIN_SERVICE_HEALTH_CHECK_INTERVAL, subscriber=None):
+        self._client = client
+        subscriber = subscriber or socket.gethostname()
+        self.nodes = [PluginServiceNode(client, api, plugin_catalog_ttl, event_callback, catch_up_callback, subscriber)
+                      for api in plugin_service_apis]
+        self._nodes = dict((node.api, node) for node in self.nodes)
+        self._health_check_interval = health_check_interval
+        self._health_check = LoopingCall(self.check_health)
+
+    def start(self):
+        for node in self.nodes:
+            node.catalog.refresh_in_background()
+            node.subscription.start()
+        self._health_check.start(self._health_check_interval)
+
+    def stop(self):
+        for node in self.nodes:
+            node.subscription.stop()
+        if self._health_check.running:
+            self._health_check.stop()
+
+    def node(self, plugin_service_api):
+        return self._nodes.get(plugin_service_api)
+
+    def check_health(self):
+        return DeferredList([self._check_health(node) for node in self.nodes])
+
+    @inlineCallbacks
+    def _check_health(self, node):
+        try:
+            response = yield self._client.request('GET', node.api + "/status")
+            node.status = response['status']
+        except PluginServiceError:
+            # It answered, but it is a plugin service that cannot tell us its status
+            node.status = None
+        except Exception as e:
+            if node.healthy:
+                logging.warning("Plugin service %s is unhealthy: %s" % (node.api, str(e)))
+            node.healthy = False
+            return
+        if not node.healthy:
+            logging.info("Plugin service %s is healthy again" % node.api)
+        node.healthy = True
+        node.assigned = 0
+
+    #
+    # Return the descriptor of a plugin. Plugin services that are up are
+    # asked first.
+    #
+
+    @inlineCallbacks
+    def plugin(self, plugin_name):
+        for node in sorted(self.nodes, key=lambda node: not node.healthy):
+            try:
+                plugin = yield node.catalog.get(plugin_name)
+            except Exception as e:
+                logging.warning("Failed to get the plugins of %s: %s" % (node.api, str(e)))
+                continue
+            if plugin is not None:
+                returnValue(plugin)
+
+    #
+    # Pick the plugin service that a new session of a plugin should run
+    # on. Returns None if no healthy plugin service has the plugin.
+    #
+
+    @inlineCallbacks
+    def choose(self, plugin_name):
+        candidates = []
+        for node in self.nodes:
+            if not node.healthy:
+                continue
+            try:
+                plugin = yield node.catalog.get(plugin_name)
+            except Exception as e:
+                logging.warning("Failed to get the plugins of %s: %s" % (node.api, str(e)))
+                continue
+            if plugin is not None:
+                candidates.append(node)
+        if not candidates:
+            returnValue(None)
+        node = min(candidates, key=lambda node: node.load())
+        node.assigned += 1
+        returnValue(node)
+
+    # True if we follow the events of all the given plugin services. We
+    # do not follow those of plugin services that are not in the pool.
+
+    def subscribed(self, plugin_service_apis):
+        nodes = [self._nodes.get(api) for api in plugin_service_apis]
+        return all(node is not None and node.subscription.connected for node in nodes)
+
+    def description(self):
+        return [node.description() for node in self.nodes]
+
+
+class IssueLog:
+
+    """
+    All the issues of a scan in the order in which they were collected,
+    each with the index of the plugin session that reported it. A
+    position in the log is a cursor: a client that has seen everything
+    before it only needs what comes after it, which is a list slice.
+
+    Only the most recent issues are kept in memory. When the issues in
+    memory take more than max_size bytes, the oldest are moved to the
+    scan database until they take half of that. Entries stay in memory
+    until they have been stored, so readers always find them somewhere.
+    The batches are runs of consecutive issues from the same session;
+    they let us restore the order of the log from a stored scan.
+    """
+
+    def __init__(self, database, scan_id, max_size=SCAN_MAX_ISSUE_MEMORY):
+        self._database = database
+        self._scan_id = scan_id
+        self._max_size = max_size
+        self._entries = []
+        self._sizes = []
+        self._first = 0
+        self._size = 0
+        self._spilling = False
+        self.batches = []
+
+    def __len__(self):
+        return self._first + len(self._entries)
+
+    def append(self, session_index, issues):
+        for issue in issues:
+            self._entries.append((session_index, issue))
+            self._sizes.append(len(json.dumps(issue)))
+            self._size += self._sizes[-1]
+        if self.batches and self.batches[-1][0] == session_index:
+            self.batches[-1][1] += len(issues)
+        else:
+            self.batches.append([session_index, len(issues)])
+        if self._size > self._max_size:
+            self._spill()
+
+    @inlineCallbacks
+    def _spill(self):
+        if self._spilling:
+            return
+        self._spilling = True
+        try:
+            while self._size > self._max_size:
+                count, size = 0, 0
+                while self._size - size > self._max_size / 2:
+                    size += self._sizes[count]
+                    count += 1
+                yield self._database.store_issues(self._scan_id, self._first, self._entries[:count])
+                del self._entries[:count]
+                del self._sizes[:count]
+                self._first += count
+                self._size -= size
+        except Exception as e:
+            logging.error("Failed to move issues of scan %s to the database: %s" % (self._scan_id, str(e)))
+        finally:
+            self._spilling = False
+
+    #
+    # Return the (session_index, issue) entries after cursor and the
+    # cursor to use next time. Entries that are no longer in memory are
+    # loaded from the scan database.
+    #
+
+    def since(self, cursor):
+        if cursor >= self._first:
+            return succeed((self._entries[cursor - self._first:], len(self)))
+        return self._since(cursor)
+
+    @inlineCallbacks
+    def _since(self, cursor):
+        entries = []
+        while cursor < self._first:
+            loaded = yield self._database.load_issues(self._scan_id, cursor, self._first)
+            if not loaded:
+                logging.error("Issues %d-%d of scan %s are missing" % (cursor, self._first, self._scan_id))
+                break
+            entries += loaded
+            cursor += len(loaded)
+        entries += self._entries[max(cursor - self._first, 0):]
+        returnValue((entries, len(self)))
+
+    @property
+    def spilled(self):
+        return self._first > 0
+
+    def memory(self):
+        return { 'issues': len(self._entries),
+                 'spilled_issues': self._first,
+                 'size': self._size }
+
+
+#
+# Return the fingerprint of an issue. Issues with the same fingerprint
+# are the same finding: they have the same summary, ignoring case and
+# whitespace, the same severity and are about the same sites. Only the
+# sites of the URLs count, so that a finding that is reported for many
+# URLs of a site is one finding.
+#
+
+def issue_fingerprint(issue):
+    summary = u" ".join(unicode(issue.get('Summary', '')).lower().split())
+    severity = unicode(issue.get('Severity', '')).lower()
+    sites = set()
+    for url in issue.get('URLs') or []:
+        url = urlparse.urlparse(unicode(url))
+        sites.add(u"%s://%s" % (url.scheme.lower(), url.netloc.lower()))
+    return hashlib.sha1(json.dumps([summary, severity, sorted(sites)])).hexdigest()
+
+
+class IssueIndex:
+
+    """
+    The distinct issues of a scan by fingerprint. An issue that was
+    reported more than once, by different plugins, for different URLs
+    or again by the same plugin, is kept once with how often it was
+    reported, all the URLs (up to max_urls) and the plugins that
+    reported it. The other fields are those of the first report.
+
+    The distinct issues stay in memory while the scan is in progress,
+    size is about how many bytes they take as JSON.
+    """
+
+    def __init__(self, max_urls=SCAN_DISTINCT_ISSUE_MAX_URLS):
+        self._max_urls = max_urls
+        self._issues = OrderedDict()
+        self.size = 0
+
+    def __len__(self):
+        return len(self._issues)
+
+    def __contains__(self, fingerprint):
+        return fingerprint in self._issues
+
+    def get(self, fingerprint):
+        return self._issues.get(fingerprint)
+
+    # Add a reported issue and return the distinct issue that it is part of
+
+    def add(self, plugin_name, issue):
+        fingerprint = issue_fingerprint(issue)
+        distinct = self._issues.get(fingerprint)
+        if distinct is None:
+            distinct = dict(issue, Fingerprint=fingerprint, Count=0, URLs=[], Plugins=[])
+            distinct.pop('Sequence', None)
+            self._issues[fingerprint] = distinct
+            self.size += len(json.dumps(distinct))
+        distinct['Count'] += 1
+        for url in issue.get('URLs') or []:
+            if len(distinct['URLs']) < self._max_urls and url not in distinct['URLs']:
+                distinct['URLs'].append(url)
+                self.size += len(json.dumps(url)) + 2
+        if plugin_name not in distinct['Plugins']:
+            distinct['Plugins'].append(plugin_name)
+            self.size += len(json.dumps(plugin_name)) + 2
+        return distinct
+
+    def issues(self):
+        return self._issues.values()
+
+
+class ScanDiff:
+
+    """
+    How the distinct issues of a scan compare to those of its baseline,
+    the scan that it is compared with. Distinct issues are sorted into
+    new and unchanged as they come in. The issues of the baseline that
+    have not been reported are resolved, which is only final once the
+    scan is done.
+    """
+
+    def __init__(self, baseline_id=None, baseline_issues=()):
+        self.baseline = baseline_id
+        self._baseline = OrderedDict((issue['Fingerprint'], issue) for issue in baseline_issues)
+        self._new = []
+        self._unchanged = []
+
+    def add(self, fingerprint):
+        if fingerprint in self._baseline:
+            self._unchanged.append(fingerprint)
+        else:
+            self._new.append(fingerprint)
+
+    def describe(self, index):
+        return { 'baseline': self.baseline,
+                 'new': [index.get(fingerprint) for fingerprint in self._new],
+                 'unchanged': [index.get(fingerprint) for fingerprint in self._unchanged],
+                 'resolved': [issue for fingerprint,issue in self._baseline.items() if fingerprint not in index] }
+
+
+class ScanBaselines:
+
+    """
+    The distinct issues of the last finished scan of every target and
+    plan, which is what a new scan of that target with that plan is
+    compared with. They are loaded from the scan database the first
+    time that they are needed and replaced when a scan finishes. Only
+    the max_size most recently used are kept.
+    """
+
+    def __init__(self, database, max_size=SCAN_BASELINE_CACHE_SIZE):
+        self._database = database
+        self._max_size = max_size
+        self._baselines = OrderedDict()
+
+    def _put(self, key, baseline):
+        self._baselines.pop(key, None)
+        self._baselines[key] = baseline
+        while len(self._baselines) > self._max_size:
+            self._baselines.popitem(last=False)
+
+    #
+    # Return the baseline for a new scan as the id of the scan and its
+    # distinct issues, or None if there is no finished scan to compare
+    # with.
+    #
+
+    @inlineCallbacks
+    def get(self, target, plan_name):
+        key = (target, plan_name)
+        if key in self._baselines:
+            baseline = self._baselines[key]
+        else:
+            baseline = None
+            scans = yield self._database.find(target=target, plan=plan_name, state='FINISHED', limit=1)
+            if scans:
+                baseline = yield self.load(scans[0]['id'])
+            # A scan may have finished while we were loading
+            if key in self._baselines:
+                baseline = self._baselines[key]
+        self._put(key, baseline)
+        returnValue(baseline)
+
+    # Load the baseline of a scan that was compared with the given scan
+
+    @inlineCallbacks
     def load(self, scan_id):
-        pass
-    def store(self, scan):
-        pass
-    def delete(self, scan_id):
-        pass
+        scan = yield self._database.load(scan_id)
+        if scan is None:
+            returnValue(None)
+        returnValue((scan_id, stored_scan_issues(scan)))
+
+    def finished(self, scan):
+        self._put((scan.configuration.get('target'), scan.plan['name']), (scan.id, scan.distinct_issues.issues()))
+
+
+class PluginResultCache:
+
+    """
+    The results of plugin sessions that finished, so that a scan that
+    runs a plugin with the same configuration again does not have to
+    run it. Results are keyed by the class and version of the plugin and
+    the configuration of the session, which has the target in it. They
+    are fresh for ttl seconds, or for the number of seconds in ttls for
+    the plugin classes that are in it. A TTL of 0 turns caching off for
+    a plugin. Only the max_size most recently used results are kept.
+    """
 
-class MemoryScanDatabase(ScanDatabase):
+    def __init__(self, ttl=PLUGIN_RESULT_CACHE_TTL, ttls=None, max_size=PLUGIN_RESULT_CACHE_SIZE, metrics=None):
+        self._ttl = ttl
+        self._ttls = ttls or {}
+        self._max_size = max_size
+        self._results = OrderedDict()
+        metrics = metrics or MetricsRegistry()
+        self._hits = metrics.counter("minion_task_engine_plugin_result_cache_hits_total",
+                                     "Workflow steps that were answered from the plugin result cache.", ('plugin',))
+        self._misses = metrics.counter("minion_task_engine_plugin_result_cache_misses_total",
+                                       "Workflow steps that had to run their plugin.", ('plugin',))
 
-    def __init__(self, path):
+    def _plugin_ttl(self, plugin_class):
+        return self._ttls.get(plugin_class, self._ttl)
+
+    #
+    # Return the key under which the results of a plugin with the given
+    # configuration are cached, or None if that plugin is not cached.
+    #
+
+    def key(self, plugin, configuration):
+        if plugin is None or self._plugin_ttl(plugin['class']) <= 0:
+            return None
+        return hashlib.sha1(json.dumps([plugin['class'], plugin.get('version'), configuration],
+                                       sort_keys=True)).hexdigest()
+
+    # Return the fresh result under key, or None. Forced lookups always
+    # miss, the result that they produce replaces the cached one.
+
+    def get(self, key, plugin, force=False):
+        result = self._results.pop(key, None)
+        if result is not None and result['expires'] > time.time():
+            self._results[key] = result
+            if not force:
+                self._hits.inc(plugin=plugin['class'])
+                return result
+        self._misses.inc(plugin=plugin['class'])
+        return None
+
+    def put(self, key, scan_id, session, issues):
+        now = time.time()
+        self._results.pop(key, None)
+        self._results[key] = { 'scan': scan_id,
+                               'session': session,
+                               'issues': issues,
+                               'finished': int(now),
+                               'expires': now + self._plugin_ttl(session['plugin']['class']) }
+        while len(self._results) > self._max_size:
+            self._results.popitem(last=False)
+
+    # Cache the results of the plugin sessions of a scan that are done,
+    # from its summary. keys has the cache keys of the sessions by index.
+    # Sessions that failed or were stopped did not produce all their
+    # results and are not cached.
+
+    def finished(self, summary, keys):
+        for index,key in keys.items():
+            session = summary['sessions'][index]
+            if session['state'] == 'FINISHED':
+                cached = dict((k, v) for k,v in session.items() if k != 'issues')
+                self.put(key, summary['id'], cached, session['issues'])
+
+
+#
+# Return the issues of a stored scan after cursor in the same form as
+# TaskEngineSession.results(). The issue batches of the scan give the
+# order in which the issues were collected. Scans stored without them
+# have their issues in session order.
+#
+
+def stored_scan_results(scan, cursor=0):
+    sessions = scan['sessions']
+    batches = scan.get('_issue_batches')
+    if batches is None:
+        batches = [[index, len(session['issues'])] for index,session in enumerate(sessions)]
+    issues = [[] for session in sessions]
+    positions = [0 for session in sessions]
+    position = 0
+    for session_index,count in batches:
+        start = positions[session_index]
+        positions[session_index] += count
+        if position + count > cursor:
+            skip = max(cursor - position, 0)
+            issues[session_index] += sessions[session_index]['issues'][start + skip:start + count]
+        position += count
+    results = { 'id': scan['id'],
+                'state': scan['state'],
+                'sessions': [{ 'id': session['id'],
+                               'plugin': session['plugin'],
+                               'state': session['state'],
+                               'progress': session['progress'],
+                               'issues': session_issues } for session,session_issues in zip(sessions, issues)] }
+    return results, max(position, cursor)
+
+
+#
+# Return the issue index of a stored scan. The issues are indexed in the
+# order in which they were collected.
+#
+
+def stored_scan_issue_index(scan):
+    sessions = scan['sessions']
+    batches = scan.get('_issue_batches')
+    if batches is None:
+        batches = [[index, len(session['issues'])] for index,session in enumerate(sessions)]
+    index = IssueIndex()
+    positions = [0 for session in sessions]
+    for session_index,count in batches:
+        session = sessions[session_index]
+        start = positions[session_index]
+        for issue in session['issues'][start:start + count]:
+            index.add(session['plugin']['name'], issue)
+        positions[session_index] += count
+    return index
+
+#
+# Return the distinct issues of a stored scan. A scan stores them with
+# its summary when it is done, those stored before that are indexed.
+#
+
+def stored_scan_issues(scan):
+    issues = scan.get('_distinct_issues')
+    if issues is None:
+        issues = stored_scan_issue_index(scan).issues()
+    return issues
+
+
+class ScanRegistry:
+
+    """
+    The scans that the task engine has in memory: the ones that have not
+    finished yet. A scan is removed as soon as it is done, which is after
+    it has been stored, from then on it is read from the scan database.
+    Also knows which scan each plugin session belongs to.
+    """
+
+    def __init__(self):
         self._scans = {}
+        self._plugin_sessions = {}
+        self._removed_issues = 0
 
-    def load(self, scan_id):
-        def _main():
-            return self._scans.get(scan_id)
-        return deferLater(reactor, 0, _main)
+    def add(self, scan):
+        self._scans[scan.id] = scan
+        for session_id in scan.plugin_session_indexes:
+            self._plugin_sessions[session_id] = scan
 
-    def store(self, scan):
-        def _main():
-            self._scans[scan['id']] = scan
-        return deferLater(reactor, 0, _main)
+    def remove(self, scan_id):
+        scan = self._scans.pop(scan_id, None)
+        if scan is not None:
+            for session_id in scan.plugin_session_indexes:
+                self._plugin_sessions.pop(session_id, None)
+            self._removed_issues += len(scan.issues)
 
-    def delete(self, scan_id):
-        def _main():
-            if scan_id in self._scans:
-                del self._scans[scan_id]
-        return deferLater(reactor, 0, _main)
+    def get(self, scan_id):
+        return self._scans.get(scan_id)
 
-class FileScanDatabase(ScanDatabase):
+    def get_by_plugin_session(self, session_id):
+        return self._plugin_sessions.get(session_id)
 
-    def __init__(self, path):
-        self._path = os.path.expanduser(path)
-        if not os.path.exists(self._path):
-            logging.info("Creating scan database directory %s" % self._path)
-            os.mkdir(self._path)
+    def scans(self):
+        return self._scans.values()
 
-    def load(self, scan_id):
-        def _main():
-            path = os.path.join(self._path, scan_id)
-            if os.path.isfile(path):
-                with open(path) as file:
-                    return json.load(file)
-        return deferToThread(_main)
-
-    def store(self, scan):
-        def _main():
-            path = os.path.join(self._path, scan['id'])
-            with open(path, "w") as file:
-                json.dump(scan, file, indent=4)
-        return deferToThread(_main)
-
-    def delete(self, scan_id):
-        def _main():
-            path = os.path.join(self._path, scan_id)
-            if os.path.isfile(path):
-                os.remove(path)
-        return deferToThread(_main)
-
-SCAN_DATABASE_CLASSES = { 'files': FileScanDatabase, 'memory': MemoryScanDatabase }
+    # The size of a scan is that of its issues in memory and that of its
+    # distinct issues
+
+    def memory(self):
+        scans = []
+        for scan in self._scans.values():
+            memory = scan.issues.memory()
+            memory.update(id=scan.id, state=scan.state, distinct_issues=len(scan.distinct_issues),
+                          distinct_issues_size=scan.distinct_issues.size,
+                          size=memory['size'] + scan.distinct_issues.size)
+            scans.append(memory)
+        return { 'scans': scans, 'size': sum(scan['size'] for scan in scans) }
+
+    # The number of issues collected by all the scans that we ever had
+
+    def issues_collected(self):
+        return self._removed_issues + sum(len(scan.issues) for scan in self._scans.values())
 
 
 class TaskEngineSession:
 
-    def __init__(self, plan, configuration, database, plugin_service_api, artifacts_path):
+    def __init__(self, plan, configuration, database, pool, artifacts_path, scheduler, client,
+                 batcher, max_parallel=SCAN_MAX_PARALLEL_SESSIONS, admission=None,
+                 priority=SCAN_DEFAULT_PRIORITY, max_issue_memory=SCAN_MAX_ISSUE_MEMORY,
+                 journal=None, scan_id=None, baseline=None, results_cache=None, force=False):
         self.plan = plan
         self.configuration = configuration
         self.database = database
-        self.plugin_service_api = plugin_service_api
+        self.pool = pool
         self.artifacts_path = artifacts_path
-        self.id = str(uuid.uuid4())
+        self.scheduler = scheduler
+        self.client = client
+        self.batcher = batcher
+        self.admission = admission
+        self.priority = priority
+        self.journal = journal
+        self.results_cache = results_cache
+        self.force = force
+        self.max_parallel = min(plan.get('max_parallel', max_parallel), max_parallel)
+        self.id = scan_id or str(uuid.uuid4())
         self.state = 'CREATED'
+        self.created = int(time.time())
+        self.finished = None
         self.plugin_configurations = []
-        self.semaphore = DeferredSemaphore(1)
         self.plugin_sessions = []
+        self.plugin_session_indexes = {}
+        self.issues = IssueLog(database, self.id, max_issue_memory)
+        self.distinct_issues = IssueIndex()
+        self.diff = ScanDiff(*(baseline or ()))
+        self.dependencies = self._workflow_dependencies()
         self.delete_when_stopped = False
+        self.stored = False
+        self.cache_hits = 0
+        self.cache_misses = 0
+        self.cache_keys = {}
+        self._downloads = {}
+        self._change_waiters = []
+        self._journaled_sessions = []
+
+    #
+    # Figure out the indexes of the workflow steps that each step
+    # depends on. Only earlier steps can be depended on, so there can
+    # be no cycles. The plugin sessions are created in workflow order
+    # so these indexes also apply to self.plugin_sessions.
+    #
+
+    def _workflow_dependencies(self):
+        workflow = self.plan['workflow']
+        dependencies = []
+        for n,step in enumerate(workflow):
+            indexes = set()
+            for dependency in step.get('depends_on', []):
+                if isinstance(dependency, int):
+                    if 0 <= dependency < n:
+                        indexes.add(dependency)
+                    continue
+                steps = [i for i in range(n) if workflow[i].get('id') == dependency]
+                if not steps:
+                    steps = [i for i in range(n) if workflow[i]['plugin_name'] == dependency]
+                indexes.update(steps)
+            dependencies.append(sorted(indexes))
+        return dependencies
+
+    #
+    # Ask the scheduler to idle this scan after delay seconds.
+    #
+
+    def wakeup(self, delay=0):
+        self.scheduler.wakeup(self, delay)
+
+    # How long to wait before we look at our plugin sessions again when
+    # nothing is happening. If the plugin service tells us about changes
+    # then we do not have to look often.
+
+    def _poll_interval(self):
+        if self.pool.subscribed(set(s['plugin_service'] for s in self.plugin_sessions if s.get('cached') is None)):
+            return PLUGIN_SERVICE_EVENTS_POLL_INTERVAL
+        return PLUGIN_SERVICE_POLL_INTERVAL
+
+    #
+    # Return a deferred that fires the next time that this scan changes:
+    # when its state changes or after it has looked at its plugin
+    # sessions, which is when it picks up new issues and progress.
+    #
+
+    def wait_for_change(self):
+        d = Deferred(lambda d: self._change_waiters.remove(d))
+        self._change_waiters.append(d)
+        return d
+
+    def _notify_change(self):
+        waiters, self._change_waiters = self._change_waiters, []
+        for d in waiters:
+            d.callback(None)
+
+    #
+    # Write a record about this scan to the journal, from which the scan
+    # is recovered when the task engine restarts.
+    #
+
+    def _journal(self, type, **record):
+        if self.journal is not None:
+            record.update(type=type, scan=self.id)
+            self.journal.append(record)
+
+    # Journal the plugin sessions of which the state changed since we
+    # last journaled them.
+
+    def _journal_sessions(self):
+        for index,session in enumerate(self.plugin_sessions):
+            state = (session['state'], session.get('_done') == True)
+            if self._journaled_sessions[index] != state:
+                self._journaled_sessions[index] = state
+                self._journal('session', session=index, state=state[0], done=state[1])
 
     #
     # Return True if all plugins have completed.
@@ -252,158 +1415,606 @@ class TaskEngineSession:
         for session in self.plugin_sessions:
             if session['state'] in ('CREATED', 'STARTED', 'STOPPING'):
                 return False
+            # A session that has finished is only done once we have collected its final results
+            if self.state == 'STARTED' and session['state'] == 'FINISHED' and session.get('_done') != True:
+                return False
+        # Artifacts that are being downloaded are kept, unless the scan is deleted
+        if self._downloads and not (self.state == 'STOPPING' and self.delete_when_stopped):
+            return False
         return True
 
+    #
+    # Make a request to a plugin service. The requests of all scans go
+    # through the same client, which keeps connections alive and bounds
+    # the number of requests in flight to each plugin service.
+    #
+
+    def _request(self, plugin_service_api, path, method='GET', postdata=None):
+        return self.client.request(method, plugin_service_api + path, postdata)
+
+    #
+    # Call function for all the given plugin sessions in parallel. A
+    # session for which it fails is marked as FAILED so that we won't
+    # look at it again. Unless the plugin service simply did not answer
+    # in time, in which case we will try again next time.
+    #
+
     @inlineCallbacks
-    def _stop_sessions(self):
-        for session in self.plugin_sessions:
-            # We are only interested in those sessions that are 
-            if session['state'] not in ('FINISHED', 'FAILED', 'STOPPED', 'STOPPING'):
-                try:
-                    # Get the latest session state
-                    url = "%s/session/%s" % (self.plugin_service_api, session['id'])
-                    response = yield getPage(url.encode('ascii')).addCallback(json.loads)
-                    session.update(response['session'])
-                    # If this session is not already STOPPING then we stop it
-                    if session['state'] != 'STOPPING':
-                        logging.debug("TaskEngineSession._periodic_session_task - Going to stop " + session['plugin']['class'])
-                        url = self.plugin_service_api + "/session/%s/state" % session['id']
-                        result = yield getPage(url.encode('ascii'), method='PUT', postdata='STOP').addCallback(json.loads)
-                except Exception as e:
-                    logging.exception("Failed to stop session %s: %s" % (session['id'], str(e)))
-                    # Mark the session as FAILED so that we won't look at it again
+    def _for_each_session(self, sessions, function, description):
+        results = yield DeferredList([maybeDeferred(function, session) for session in sessions], consumeErrors=True)
+        for session,(success,result) in zip(sessions, results):
+            if not success:
+                if result.check(CancelledError):
+                    result.raiseException()
+                if result.check(TimeoutError):
+                    logging.warning("Timed out trying to %s session %s" % (description, session['id']))
+                else:
+                    logging.error("Failed to %s session %s: %s" % (description, session['id'], result.getErrorMessage()))
                     session['state'] = 'FAILED'
-    
+
+    @inlineCallbacks
+    def _update_session(self, session):
+        response = yield self.batcher.summary(session['plugin_service'], session['id'])
+        summary = response['session']
+        # The summary does not contain issues, those we collect incrementally
+        summary.pop('issues', None)
+        # We may have heard that the session is done while this request was in flight
+        if session['state'] in ('FINISHED', 'FAILED', 'STOPPED'):
+            summary.pop('state', None)
+        session.update(summary)
+
     #
-    # Periodically decide what to do in our workflow. We simply walk
-    # over all the plugin sessions part of this scan and see what
-    # needs to happen based on their status.
+    # Add issues of a plugin session. Issues can reach us both through the
+    # plugin service events and through polling, so we only add the ones
+    # with a sequence number that we have not seen yet.
+    #
+
+    def _add_issues(self, session, issues):
+        issues = [issue for issue in issues if issue['Sequence'] > session.get('_sequence', 0)]
+        if issues:
+            session['_sequence'] = issues[-1]['Sequence']
+            self.issues.append(self.plugin_session_indexes[session['id']], issues)
+            for issue in issues:
+                distinct = self.distinct_issues.add(session['plugin']['name'], issue)
+                if distinct['Count'] == 1:
+                    self.diff.add(distinct['Fingerprint'])
+            self._journal('issues', session=self.plugin_session_indexes[session['id']],
+                          count=len(issues), sequence=session['_sequence'])
+
+    @inlineCallbacks
+    def _stop_session(self, session):
+        # Get the latest session state
+        yield self._update_session(session)
+        # If this session is not already STOPPING then we stop it
+        if session['state'] in ('CREATED', 'STARTED'):
+            logging.debug("TaskEngineSession._periodic_session_task - Going to stop " + session['plugin']['class'])
+            yield self.batcher.change_state(session['plugin_service'], session['id'], 'STOP')
+
+    @inlineCallbacks
+    def _start_session(self, session):
+        logging.debug("TaskEngineSession._periodic_session_task - Going to start " + session['plugin']['class'])
+        result = yield self.batcher.change_state(session['plugin_service'], session['id'], 'START')
+        if not result['success']:
+            raise Exception(result['error'])
+        session['state'] = 'STARTED'
+
+    @inlineCallbacks
+    def _collect_results(self, session):
+        logging.debug("TaskEngineSession._periodic_session_task - Going to get results from " + session['plugin']['class'])
+        # We only ask for the issues that were reported after the last ones we received
+        result = yield self._request(session['plugin_service'],
+                                     "/session/%s/results?after=%d" % (session['id'], session.get('_sequence', 0)))
+        self._add_issues(session, result['issues'])
+        # If the task is finished, and we just grabbed the final results, then mark it as done
+        if session['state'] == 'FINISHED':
+            # If the session has artifacts it is done once they are stored
+            if not session['artifacts']:
+                session['_done'] = True
+            elif session['id'] not in self._downloads:
+                self._download_artifacts(session)
+
+    #
+    # Download the artifacts of a finished plugin session and store them.
+    # This runs apart from idle(), so that the idle deadline does not cut
+    # off large downloads. When it is done, whether it worked or not, the
+    # session is done and we wake up to carry on with the workflow, or to
+    # finish stopping. A download is only cancelled by _clean_up().
+    #
+
+    def _download_artifacts(self, session):
+        url = session['plugin_service'] + "/session/%s/artifacts" % session['id']
+        d = self.client.download(url, "%s/%s.zip" % (self.artifacts_path, session['id']))
+        self._downloads[session['id']] = d
+        def _failed(failure):
+            if not failure.check(CancelledError):
+                logging.error("Unable to store scan artifacts: " + failure.getErrorMessage())
+        def _stored(_):
+            del self._downloads[session['id']]
+            session['_done'] = True
+            if self.state in ('STARTED', 'STOPPING'):
+                self.wakeup()
+        d.addErrback(_failed)
+        d.addCallback(_stored)
+
+    def _session_is_finished(self, session):
+        return session['state'] == 'FINISHED' and session.get('_done') == True
+
+    #
+    # Skip the plugin sessions of which a dependency failed or was stopped,
+    # they will not run and are STOPPED. Dependencies come earlier in the
+    # workflow, so this carries on to the sessions that depend on skipped
+    # ones. Returns True if any sessions were skipped.
+    #
+
+    def _skip_sessions(self):
+        skipped = False
+        for session,dependencies in zip(self.plugin_sessions, self.dependencies):
+            if session['state'] != 'CREATED':
+                continue
+            if any(self.plugin_sessions[i]['state'] in ('FAILED', 'STOPPED') for i in dependencies):
+                logging.info("Skipping plugin session %s of scan %s, a step it depends on did not finish"
+                             % (session['id'], self.id))
+                session['state'] = 'STOPPED'
+                skipped = True
+        return skipped
+
+    #
+    # Return the plugin sessions that can be started now: those that
+    # are CREATED and of which all dependencies have finished. No more
+    # are returned than our parallelism cap allows.
+    #
+
+    def _startable_sessions(self):
+        running = len([s for s in self.plugin_sessions if s['state'] in ('STARTED', 'STOPPING')])
+        startable = []
+        for session,dependencies in zip(self.plugin_sessions, self.dependencies):
+            if running + len(startable) >= self.max_parallel:
+                break
+            if session['state'] == 'CREATED':
+                if all(self._session_is_finished(self.plugin_sessions[i]) for i in dependencies):
+                    startable.append(session)
+        return startable
+
+    def _stop_sessions(self):
+        sessions = [s for s in self.plugin_sessions if s['state'] not in ('FINISHED', 'FAILED', 'STOPPED')]
+        return self._for_each_session(sessions, self._stop_session, "stop")
+
+    # Delete plugin sessions on their plugin services. Failures are only
+    # logged, there is nothing else that we can do about them.
+
+    @inlineCallbacks
+    def _delete_sessions(self, sessions):
+        requests = [self.batcher.delete(s['plugin_service'], s['id']) for s in sessions]
+        results = yield DeferredList(requests, consumeErrors=True)
+        for session,(success,result) in zip(sessions, results):
+            if not success:
+                logging.error("Unable to delete plugin session %s: %s" % (session['id'], result.getErrorMessage()))
+            elif not result['success']:
+                logging.error("Failed to delete plugin session %s: %s" % (session['id'], result['error']))
+
+    #
+    # Clean up after the scan has been stored. The stored scan has all
+    # the issues, so we can forget about the ones that we moved to the
+    # database. Always delete all the plugin sessions, since they are
+    # not needed anymore.
+    #
+
+    @inlineCallbacks
+    def _clean_up(self):
+        # Do not download from plugin sessions that we are about to delete
+        for d in self._downloads.values():
+            d.cancel()
+        if self.issues.spilled:
+            yield self.database.delete_issues(self.id)
+        yield self._delete_sessions([s for s in self.plugin_sessions if s.get('cached') is None])
+
+    #
+    # Decide what to do in our workflow. We simply walk over all the
+    # plugin sessions part of this scan and see what needs to happen
+    # based on their status. This is called by the scheduler whenever
+    # this scan was woken up. If there is more work to do then we ask
+    # to be woken up again: immediately when we made progress or
+    # after the poll interval when we are waiting for plugins.
     #
 
     @inlineCallbacks
     def idle(self):
         logging.debug("TaskEngineSession._periodic_session_task")
 
+        progress = False
+
         try:
-            # Skip sessions that are in their final finished state
-            if self.state in ('FINISHED', 'FAILED', 'STOPPED'):
-                return
+            # We were stored already, but did not get to clean up
+            if self.stored:
+                yield self._clean_up()
+                returnValue(True)
 
             if self.state == 'STOPPING':
                 # Loop over all sessions and stop them if they are not already stopped.
                 yield self._stop_sessions()
 
             if self.state == 'STARTED':
-                # Loop over all sessions and figure out what to do next for them. We do only one thing
-                # at a time to minimize calls down to the plugin service.
-                for session in self.plugin_sessions:
-                    try:
-                        # Update the session so that we have the most recent info
-                        if session['state'] not in ('FINISHED', 'STOPPED', 'FAILED'):
-                            url = "%s/session/%s" % (self.plugin_service_api, session['id'])
-                            response = yield getPage(url.encode('ascii')).addCallback(json.loads)
-                            session.update(response['session'])
-                        # Now decide what to do based on the session state
-                        if session['state'] == 'CREATED':
-                            # Start this plugin session
-                            logging.debug("TaskEngineSession._periodic_session_task - Going to start " + session['plugin']['class'])
-                            url = self.plugin_service_api + "/session/%s/state" % session['id']
-                            result = yield getPage(url.encode('ascii'), method='PUT', postdata='START').addCallback(json.loads)
-                            break
-                        elif session['state'] in ('STARTED', 'FINISHED') and session.get('_done') != True:
-                            # If the status is STARTED or FINISHED then collect the results periodically
-                            logging.debug("TaskEngineSession._periodic_session_task - Going to get results from " + session['plugin']['class'])
-                            url = self.plugin_service_api + "/session/%s/results" % session['id']
-                            result = yield getPage(url.encode('ascii')).addCallback(json.loads)
-                            session['issues'] = result['issues']
-                            # If the task is finished, and we just grabbed the final results, then mark it as done
-                            if session['state'] == 'FINISHED':
-                                # If the session has artifacts, download them and store them
-                                if session['artifacts']:
-                                    try:
-                                        url = self.plugin_service_api + "/session/%s/artifacts" % session['id']
-                                        response = yield cyclone.httpclient.fetch(url)
-                                        with open("%s/%s.zip" % (self.artifacts_path, session['id']), "w") as f:
-                                            f.write(response.body)
-                                    except Exception as e:
-                                        logging.exception("Unable to store scan artifacts: " + str(e))
-                                session['_done'] = True
-                            break
-                    except Exception as e:
-                        logging.exception("Failed to idle session %s: %s" % (session['id'], str(e)))
-                        # Mark the session as FAILED so that we won't look at it again
-                        session['state'] = 'FAILED'
+                # Update all the sessions in parallel so that we have the most recent info
+                sessions = [s for s in self.plugin_sessions if s['state'] not in ('FINISHED', 'STOPPED', 'FAILED')]
+                yield self._for_each_session(sessions, self._update_session, "update")
+                # Collect the results of all sessions that are running or that have just finished
+                sessions = [s for s in self.plugin_sessions if s['state'] in ('STARTED', 'FINISHED') and s.get('_done') != True]
+                yield self._for_each_session(sessions, self._collect_results, "collect results from")
+                if [s for s in sessions if s.get('_done') == True]:
+                    progress = True
+                # Start all the sessions of which the dependencies have finished
+                if self._skip_sessions():
+                    progress = True
+                sessions = self._startable_sessions()
+                yield self._for_each_session(sessions, self._start_session, "start")
+                if sessions:
+                    progress = True
 
             # If we have more work to do then we schedule ourself again.
 
             if not self._all_sessions_are_done():
+                if self.state in ('STARTED', 'STOPPING'):
+                    self.wakeup(0 if progress else self._poll_interval())
                 returnValue(False)
             else:
+                # We only move to our final state once we have been stored.
+                # If storing fails we stay where we are and try again.
+                finished = int(time.time())
                 if self.state == 'STARTED':
                     # We have finished executing all plugins so we
                     # transition to the FINISHED state. We store our
                     # session in the database.
-                    self.state = 'FINISHED'
+                    state = 'FINISHED'
                     # If any of the sessions failed, then we also set our scan to failed
                     for session in self.plugin_sessions:
                         if session['state'] == 'FAILED':
-                            self.state = 'FAILED'
+                            state = 'FAILED'
                             break
-                    result = yield self.database.store(self.summary())
+                    summary = yield self.summary()
+                    summary.update(state=state, finished=finished, _distinct_issues=self.distinct_issues.issues())
+                    yield self.database.store(summary)
+                    self.state, self.finished, self.stored = state, finished, True
+                    if self.results_cache is not None:
+                        self.results_cache.finished(summary, self.cache_keys)
                 elif self.state == 'STOPPING':
                     # We have finished stopping so we transition to
                     # STOPPED. If we were asked to delete this session
                     # then simply do not store it in the database.
-                    self.state = 'STOPPED'
                     if not self.delete_when_stopped:
-                        result = yield self.database.store(self.summary())
-                # Always delete all the plugin sessions, since they are
-                # not needed anymore.
-                for session in self.plugin_sessions:
-                    url = self.plugin_service_api + "/session/%s" % session['id']
-                    try:
-                        result = yield getPage(url.encode('ascii'), method='DELETE').addCallback(json.loads)
-                        if not result['success']:
-                            logging.error("Failed to delete plugin session %s: %s" % (session['id'], result['error']))
-                    except Exception as e:
-                        logging.exception("Unable to delete plugin session %s: %s" % (session['id'], str(e)))
+                        summary = yield self.summary()
+                        summary.update(state='STOPPED', finished=finished, _distinct_issues=self.distinct_issues.issues())
+                        yield self.database.store(summary)
+                    self.state, self.finished, self.stored = 'STOPPED', finished, True
+                yield self._clean_up()
                 returnValue(True)
+        except CancelledError:
+            logging.warning("Idling scan %s took too long and was cancelled" % self.id)
+            if self.state in ('STARTED', 'STOPPING') or self.stored:
+                self.wakeup(PLUGIN_SERVICE_POLL_INTERVAL)
+            returnValue(False)
         except Exception as e:
             logging.exception("Uncaught exception in _idle_tasks: " + str(e))
+            if self.state in ('STARTED', 'STOPPING') or self.stored:
+                self.wakeup(PLUGIN_SERVICE_POLL_INTERVAL)
             returnValue(False)
+        finally:
+            self._journal_sessions()
+            self._notify_change()
             
     
     #
-    # Start the scan. We change the status to STARTED and call our periodic
-    # poller which will be responsible for starting the plugins in the right
-    # order and determining wether are done executing.
+    # Handle an event from the plugin service about one of our plugin
+    # sessions. When a session is done we wake up right away, so that we
+    # collect its final results and start the sessions that depend on it.
+    #
+
+    def plugin_service_event(self, event):
+        session = self.plugin_sessions[self.plugin_session_indexes[event['session']]]
+        if event['type'] == 'state':
+            if session['state'] not in ('FINISHED', 'FAILED', 'STOPPED'):
+                session['state'] = event['state']
+            if event['state'] in ('FINISHED', 'FAILED', 'STOPPED') and self.state in ('STARTED', 'STOPPING'):
+                self.wakeup()
+        elif event['type'] == 'progress':
+            session['progress'] = event['progress']
+        elif event['type'] == 'issues':
+            # Events can skip issues, after a reset or when the plugin service
+            # dropped events. Then we leave it to polling to fetch the gap.
+            sequence = session.get('_sequence', 0)
+            issues = [issue for issue in event['issues'] if issue['Sequence'] > sequence]
+            if issues and issues[0]['Sequence'] != sequence + 1:
+                if self.state == 'STARTED':
+                    self.wakeup()
+            else:
+                self._add_issues(session, issues)
+        self._journal_sessions()
+        self._notify_change()
+
+    #
+    # Start the scan. We change the status to QUEUED and wait until the
+    # admission queue lets us run. Without an admission queue we run
+    # right away.
     #
 
     def start(self):
         if self.state != 'CREATED':
             return deferLater(reactor, 0, lambda: False)
-        self.state = 'STARTED'
+        if self.admission is None:
+            self.admitted()
+        else:
+            self.state = 'QUEUED'
+            self._journal('state', state=self.state)
+            self._notify_change()
+            self.admission.enqueue(self)
         return deferLater(reactor, 0, lambda: True)
 
     #
-    # Create a new scan.
+    # Run the scan. We change the status to STARTED and wake up the
+    # scheduler which will be responsible for starting the plugins in
+    # the right order and determining wether are done executing.
+    #
+
+    def admitted(self):
+        self.state = 'STARTED'
+        self._journal('state', state=self.state)
+        self._notify_change()
+        self.wakeup()
+
+    def queue_changed(self):
+        self._notify_change()
+
+    #
+    # Create plugin sessions on one plugin service in one bulk request.
+    # If the plugin service does not support that then we fall back to
+    # creating them with concurrent single requests. Returns the sessions
+    # in the order of the requests. If a single request fails then the
+    # sessions that the others created are deleted again.
+    #
+
+    @inlineCallbacks
+    def _create_sessions_on(self, plugin_service_api, requests):
+        try:
+            response = yield self._request(plugin_service_api, "/sessions/create", method='PUT',
+                                           postdata=json.dumps(requests))
+            if not response['success']:
+                raise Exception(response['error'])
+            returnValue(response['sessions'])
+        except PluginServiceError as e:
+            logging.debug("Bulk session create failed, creating sessions one by one: %s" % str(e))
+        results = yield DeferredList([self._request(plugin_service_api, "/session/create/%s" % request['plugin'],
+                                                    method='PUT', postdata=json.dumps(request['configuration']))
+                                      for request in requests], consumeErrors=True)
+        sessions = [dict(result['session'], plugin_service=plugin_service_api)
+                    for success,result in results if success and result['success']]
+        if len(sessions) < len(requests):
+            yield self._delete_sessions(sessions)
+            for success,result in results:
+                if not success:
+                    result.raiseException()
+                if not result['success']:
+                    raise Exception(result['error'])
+        returnValue(sessions)
+
+    #
+    # Create the plugin sessions for all workflow steps. Every session
+    # goes to the plugin service that the pool picks for it and the
+    # sessions for the same plugin service are created together. The
+    # plugin service is recorded in the session, all later requests for
+    # the session go there. Returns the sessions in the order of the
+    # requests. If creating them fails on one plugin service then the
+    # sessions that were created on the others are deleted again.
+    #
+
+    @inlineCallbacks
+    def _create_sessions(self, requests):
+        indexes = {}
+        for index,request in enumerate(requests):
+            node = yield self.pool.choose(request['plugin'])
+            if node is None:
+                raise Exception("No plugin service available for %s" % request['plugin'])
+            indexes.setdefault(node.api, []).append(index)
+        apis = indexes.keys()
+        results = yield DeferredList([self._create_sessions_on(api, [requests[i] for i in indexes[api]])
+                                      for api in apis], consumeErrors=True)
+        sessions = [None] * len(requests)
+        for api,(success,created) in zip(apis, results):
+            if success:
+                for index,session in zip(indexes[api], created):
+                    session['plugin_service'] = api
+                    sessions[index] = session
+        failures = [result for success,result in results if not success]
+        if failures:
+            yield self._delete_sessions([session for session in sessions if session is not None])
+            failures[0].raiseException()
+        returnValue(sessions)
+
+    #
+    # Make a plugin session out of a cached result. It is done already and
+    # has a new id, its issues are added after the scan is journaled. Its
+    # artifacts are those of the session that produced the result, which
+    # we link to under the new id.
+    #
+
+    def _cached_session(self, result):
+        session = copy.deepcopy(result['session'])
+        session_id = str(uuid.uuid4())
+        if session.get('artifacts'):
+            try:
+                os.link("%s/%s.zip" % (self.artifacts_path, session['id']),
+                        "%s/%s.zip" % (self.artifacts_path, session_id))
+            except OSError as e:
+                logging.warning("Unable to link the artifacts of cached plugin session %s: %s"
+                                % (session['id'], str(e)))
+                session['artifacts'] = {}
+        session.pop('_sequence', None)
+        session.update(id=session_id, plugin_service=None, _done=True, cached={ 'scan': result['scan'],
+                                                                   'session': result['session']['id'],
+                                                                   'finished': result['finished'] })
+        return session
+
+    #
+    # Create a new scan. Workflow steps of which the results are in the
+    # cache do not get a plugin session on a plugin service, unless the
+    # scan was forced to run everything.
     #
     
     @inlineCallbacks
     def create(self):
-        # Create plugin sessions
-        for step in self.plan['workflow']:
+        requests, keys, cached = [], [], {}
+        for index,step in enumerate(self.plan['workflow']):
             # Create the plugin configuration by overlaying the default configuration with the given configuration
             configuration = step['configuration']
             configuration.update(self.configuration)
-            # Create the pligin session
-            url = self.plugin_service_api + "/session/create/%s" % step['plugin_name']
-            response = yield getPage(url.encode('ascii'), method='PUT', postdata=json.dumps(configuration)).addCallback(json.loads)
-            self.plugin_sessions.append(response['session'])
+            key = None
+            if self.results_cache is not None:
+                key = self.results_cache.key(step.get('plugin'), configuration)
+            if key is not None:
+                result = self.results_cache.get(key, step['plugin'], self.force)
+                if result is not None:
+                    cached[index] = result
+                    continue
+            requests.append({'plugin': step['plugin_name'], 'configuration': configuration})
+            keys.append(key)
+        self.cache_hits = len(cached)
+        self.cache_misses = sum(1 for k in keys if k is not None)
+        # Create the plugin sessions
+        created = yield self._create_sessions(requests)
+        created = iter(zip(created, keys))
+        for index in range(len(self.plan['workflow'])):
+            if index in cached:
+                session = self._cached_session(cached[index])
+            else:
+                session, key = next(created)
+                if key is not None:
+                    self.cache_keys[index] = key
+            # The issues are kept in our issue log
+            session.pop('issues', None)
+            self.plugin_session_indexes[session['id']] = len(self.plugin_sessions)
+            self.plugin_sessions.append(session)
+            self._journaled_sessions.append((session['state'], index in cached))
+        # The journal keeps its records, so it gets the sessions as they are now
+        self._journal('scan', plan=self.plan, configuration=self.configuration, priority=self.priority,
+                      created=self.created, baseline=self.diff.baseline, sessions=copy.deepcopy(self.plugin_sessions),
+                      force=self.force, cache_hits=self.cache_hits, cache_misses=self.cache_misses,
+                      cache_keys=dict((str(index), key) for index,key in self.cache_keys.items()),
+                      cached_issues=dict((str(index), result['issues']) for index,result in cached.items()))
+        for index,result in cached.items():
+            self._add_issues(self.plugin_sessions[index], result['issues'])
         summary = { 'id': self.id, 'state': self.state, 'plan': self.plan, 'configuration': self.configuration,
                     'sessions': self.plugin_sessions }
         returnValue(summary)
 
+    #
+    # Recover this scan from its journal records after the task engine
+    # restarted. The plugin sessions kept running without us, so we
+    # take them up where they are and get the issues that they reported
+    # again. The issue log is rebuilt in the order in which the issues
+    # were journaled, so the cursors that clients got before the restart
+    # still point at the same issues. Sessions that the plugin service
+    # does not know anymore are marked as FAILED. The journal must be
+    # set after this, so that the recovered records are not written
+    # again.
+    #
+
+    @inlineCallbacks
+    def restore(self, records):
+        scan = records[0]
+        self.priority = scan['priority']
+        self.created = scan['created']
+        self.force = scan.get('force', False)
+        self.cache_hits = scan.get('cache_hits', 0)
+        self.cache_misses = scan.get('cache_misses', 0)
+        self.cache_keys = dict((int(index), key) for index,key in scan.get('cache_keys', {}).items())
+        for session in scan['sessions']:
+            self.plugin_session_indexes[session['id']] = len(self.plugin_sessions)
+            self.plugin_sessions.append(session)
+        batches = []
+        for record in records[1:]:
+            if record['type'] == 'state':
+                self.state = record['state']
+                self.delete_when_stopped = record.get('delete', False)
+            elif record['type'] == 'session':
+                session = self.plugin_sessions[record['session']]
+                session['state'] = record['state']
+                session['_done'] = record['done']
+            elif record['type'] == 'issues':
+                batches.append(record)
+        self._journaled_sessions = [(s['state'], s.get('_done') == True) for s in self.plugin_sessions]
+        # Get the current state and all the issues of every plugin session.
+        # Those of cached sessions are in the journal.
+        sessions = [s for s in self.plugin_sessions if s.get('cached') is None]
+        results = yield DeferredList([self._recover_session(s) for s in sessions])
+        results = iter(results)
+        issues = []
+        for index,session in enumerate(self.plugin_sessions):
+            if session.get('cached') is not None:
+                issues.append(scan.get('cached_issues', {}).get(str(index), []))
+                continue
+            _,result = next(results)
+            if result is None:
+                # Keep what the journal says, we look at the session
+                # again like at any other and collect all its issues then
+                logging.warning("Unable to reach plugin session %s of scan %s, will try again later"
+                                % (session['id'], self.id))
+                issues.append(None)
+            elif result['success']:
+                summary = result['session']
+                summary.pop('issues', None)
+                if session['state'] in ('FINISHED', 'FAILED', 'STOPPED'):
+                    summary.pop('state', None)
+                session.update(summary)
+                issues.append(result['issues'])
+            else:
+                # The plugin service does not know the session, there
+                # is nothing left to collect
+                logging.error("Unable to recover plugin session %s of scan %s: %s"
+                              % (session['id'], self.id, result['error']))
+                if session['state'] not in ('FINISHED', 'FAILED', 'STOPPED'):
+                    session['state'] = 'FAILED'
+                else:
+                    session['_done'] = True
+                issues.append([])
+        for record in batches:
+            session = self.plugin_sessions[record['session']]
+            if issues[record['session']] is None:
+                continue
+            count = len(self.issues)
+            self._add_issues(session, [i for i in issues[record['session']] if i['Sequence'] <= record['sequence']])
+            if len(self.issues) - count != record['count']:
+                logging.warning("Recovered %d of %d issues of plugin session %s of scan %s"
+                                % (len(self.issues) - count, record['count'], session['id'], self.id))
+                session['_sequence'] = record['sequence']
+
+    #
+    # Get the state and all the issues of a plugin session of a scan that
+    # we recover. The plugin service may be restarting along with us, so
+    # when it does not answer we try again a few times, waiting longer
+    # every time. Returns None if it never answered. A session that the
+    # plugin service does not know, or that is on a plugin service that
+    # is no longer in the pool, gets an error answer.
+    #
+
+    @inlineCallbacks
+    def _recover_session(self, session):
+        if self.pool.node(session['plugin_service']) is None:
+            returnValue({'success': False, 'error': 'unknown-plugin-service'})
+        delay = SCAN_RECOVERY_RETRY_DELAY
+        for attempt in range(SCAN_RECOVERY_RETRIES + 1):
+            if attempt > 0:
+                yield deferLater(reactor, delay, lambda: None)
+                delay *= 2
+            try:
+                result = yield self._request(session['plugin_service'],
+                                             "/session/%s/results?after=0" % session['id'])
+            except Exception as e:
+                logging.warning("Unable to get plugin session %s of scan %s: %s" % (session['id'], self.id, str(e)))
+                continue
+            if result['success'] or result['error'] == 'no-such-session':
+                returnValue(result)
+            logging.warning("Unable to get plugin session %s of scan %s: %s"
+                            % (session['id'], self.id, result['error']))
+        returnValue(None)
+
     #
     # Stop the current scan - Stop all plugin sessions that are in the
     # CREATED state. Set our own state to STOPPING.
@@ -415,67 +2026,156 @@ class TaskEngineSession:
 
         # Don't do anything if we are already STOPPING or STOPPED
         if self.state in ('STOPPING', 'STOPPED'):
-            returnValue(True)
+            return deferLater(reactor, 0, lambda: True)
 
-        # We can only be stopped in STARTED state
-        if self.state not in ('STARTED'):
-            returnValue(False)
-            
-        # Set our state to STOPPING. The periodic task will pick this
-        # up and stop all the sessions and move us to the STOPPED
-        # state when they are all done.
+        # We can only be stopped in QUEUED or STARTED state
+        if self.state not in ('QUEUED', 'STARTED'):
+            return deferLater(reactor, 0, lambda: False)
+
+        if self.state == 'QUEUED':
+            self.admission.remove(self)
+
+        # Set our state to STOPPING and wake up the scheduler. It will
+        # stop all the sessions and move us to the STOPPED state when
+        # they are all done.
         self.state = 'STOPPING'
-        returnValue(True)
+        self._journal('state', state=self.state, delete=delete)
+        self._notify_change()
+        self.wakeup()
+        return deferLater(reactor, 0, lambda: True)
+
+    #
+    # Return the status of the scan: the summary without the issues.
+    #
+
+    def status(self):
+        status = { 'id': self.id,
+                   'state': self.state,
+                   'priority': self.priority,
+                   'baseline': self.diff.baseline,
+                   'cache': { 'hits': self.cache_hits, 'misses': self.cache_misses, 'forced': self.force },
+                   'created': self.created,
+                   'finished': self.finished,
+                   'plan': self.plan,
+                   'configuration': self.configuration,
+                   'sessions': self.plugin_sessions }
+        if self.state == 'QUEUED':
+            position, estimated_start = self.admission.position(self)
+            status['queue'] = { 'position': position, 'estimated_start': estimated_start }
+        return status
 
     #
     # Return a summary of the current plugin. Contains its state,
     # plan, configuration and sessions (including results). So it
-    # really is not a summary :-/
+    # really is not a summary :-/ Returns a deferred since older
+    # issues may have to be loaded from the database.
     #
-    
+
+    @inlineCallbacks
     def summary(self):
-        return { 'id': self.id,
-                 'state': self.state,
-                 'plan': self.plan,
-                 'configuration': self.configuration,
-                 'sessions': self.plugin_sessions }
+        entries, _ = yield self.issues.since(0)
+        issues = [[] for session in self.plugin_sessions]
+        for session_index,issue in entries:
+            issues[session_index].append(issue)
+        summary = self.status()
+        summary['sessions'] = [dict(session, issues=session_issues)
+                               for session,session_issues in zip(self.plugin_sessions, issues)]
+        summary['_issue_batches'] = self.issues.batches
+        returnValue(summary)
 
     #
     # Return just the results of the scan. Condensed form of summary()
-    # that has an optional since parameter that will let you specify
-    # incremental results.
+    # that only contains the issues collected after the given cursor.
+    # Also returns the cursor to pass next time to get incremental
+    # results. Returns a deferred.
     #
 
-    def results(self, since = "1975-09-23T00:00:00.000000Z"):
+    @inlineCallbacks
+    def results(self, cursor=0):
+        entries, cursor = yield self.issues.since(cursor)
+        issues = [[] for session in self.plugin_sessions]
+        for session_index,issue in entries:
+            issues[session_index].append(issue)
         sessions = []
-        for session in self.plugin_sessions:
-            issues = []
-            for i in session['issues']:
-                if i['Date'] > since:
-                    issues.append(i)
+        for session,session_issues in zip(self.plugin_sessions, issues):
             s = { 'id': session['id'],
                   'plugin': session['plugin'],
                   'state': session['state'],
                   'progress': session['progress'],
-                  'issues': issues }
+                  'issues': session_issues }
             sessions.append(s)
-        return { 'id': self.id, 'state': self.state, 'sessions': sessions }
+        returnValue(({ 'id': self.id, 'state': self.state, 'sessions': sessions }, cursor))
 
 
 class TaskEngine:
 
-    def __init__(self, scans_database, plugin_service_api, artifacts_path):
+    def __init__(self, scans_database, plugin_service_apis, artifacts_path,
+                 plugin_service_max_concurrency=PLUGIN_SERVICE_MAX_CONCURRENCY,
+                 scan_max_parallel_sessions=SCAN_MAX_PARALLEL_SESSIONS,
+                 plugin_catalog_ttl=PLUGIN_CATALOG_TTL,
+                 scan_admission_budget=SCAN_ADMISSION_BUDGET,
+                 plugin_service_health_check_interval=PLUGIN_SERVICE_HEALTH_CHECK_INTERVAL,
+                 scan_max_issue_memory=SCAN_MAX_ISSUE_MEMORY,
+                 scan_journal_path=None,
+                 metrics=None,
+                 scan_schedules_path=None,
+                 plugin_result_cache_ttl=PLUGIN_RESULT_CACHE_TTL,
+                 plugin_result_cache_ttls=None,
+                 plugin_result_cache_size=PLUGIN_RESULT_CACHE_SIZE,
+                 task_engine_id=None):
         self._scans_database = scans_database
-        self._plugin_service_api = plugin_service_api
         self._artifacts_path = artifacts_path
-        self._sessions = {}
-        self._looper = None
+        self._scan_max_parallel_sessions = scan_max_parallel_sessions
+        self._scan_max_issue_memory = scan_max_issue_memory
+        self._metrics = metrics or MetricsRegistry()
+        self._plugin_service_client = PluginServiceClient(timeout=PLUGIN_SERVICE_TIMEOUT,
+                                                          max_connections_per_host=plugin_service_max_concurrency,
+                                                          metrics=self._metrics)
+        self._registry = ScanRegistry()
+        self._baselines = ScanBaselines(scans_database)
+        self._results_cache = PluginResultCache(plugin_result_cache_ttl, plugin_result_cache_ttls,
+                                                plugin_result_cache_size, self._metrics)
+        self._plugin_service_batcher = PluginServiceBatcher(self._plugin_service_client)
+        self._scheduler = TaskEngineScheduler(self._session_finished, metrics=self._metrics)
+        self._scans_metric = self._metrics.gauge("minion_task_engine_scans",
+                                                 "Scans in memory by state.", ('state',))
+        self._issues_metric = self._metrics.counter("minion_task_engine_issues_collected_total",
+                                                    "Issues collected from plugin sessions.")
+        self._issue_memory_metric = self._metrics.gauge("minion_task_engine_issue_memory_bytes",
+                                                        "Size of the issues and distinct issues of the scans in memory.")
+        self._queued_metric = self._metrics.gauge("minion_task_engine_admission_queue_length",
+                                                  "Scans waiting to be admitted.")
+        self._admission = ScanAdmissionQueue(scan_admission_budget)
+        self._pool = PluginServicePool(self._plugin_service_client, plugin_service_apis,
+                                       self._plugin_service_event, self._wakeup_sessions,
+                                       plugin_catalog_ttl, plugin_service_health_check_interval, task_engine_id)
+        reactor.callWhenRunning(self._pool.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', self._pool.stop)
+
+        # Scans that were in progress when we went down are recovered from
+        # the journal once the reactor runs
+        self._journal = None
+        self._recovered = {}
+        if scan_journal_path is not None:
+            self._journal = ScanJournal(scan_journal_path)
+            self._recovered = self._journal.replay()
+            reactor.callWhenRunning(self._recover)
+            reactor.addSystemEventTrigger('after', 'shutdown', self._journal.close)
+
+        # Recurring scans start once the reactor runs
+        self._schedules = RecurringScans(scan_schedules_path, self._start_scheduled_scan)
+        reactor.callWhenRunning(self._schedules.start)
+        reactor.addSystemEventTrigger('before', 'shutdown', self._schedules.stop)
 
         self._artifacts_path = os.path.expanduser(self._artifacts_path)
         if not os.path.exists(self._artifacts_path):
             logging.info("Creating scan artifacts directory %s" % self._artifacts_path)
             os.mkdir(self._artifacts_path)
 
+    def get_plugin_services(self):
+        plugin_services = self._pool.description()
+        return deferLater(reactor, 0, lambda: plugin_services)
+
     def get_plan_descriptions(self):
         plans = [{'name': plan['name'], 'description': plan['description']} for plan in PLANS.values()]
         return deferLater(reactor, 0, lambda: plans)
@@ -484,46 +2184,169 @@ class TaskEngine:
     def get_plan(self, plan_name):
         plan = PLANS.get(plan_name)
         if plan is not None:
-            # Loop over all the plugins part of this plan and get their extended info
+            # Work on a copy so that the global plans stay untouched. Add the
+            # extended info of all the plugins part of this plan.
+            plan = copy.deepcopy(plan)
             for w in plan['workflow']:
-                url = "%s/plugin/%s" % (self._plugin_service_api, w['plugin_name'])
-                response = yield getPage(url.encode('ascii')).addCallback(json.loads)
-                w['plugin'] = response['plugin']
+                w['plugin'] = yield self._pool.plugin(w['plugin_name'])
         returnValue(plan)
 
     @inlineCallbacks
-    def create_session(self, plan, configuration):
+    def create_session(self, plan, configuration, priority=SCAN_DEFAULT_PRIORITY, force=False):
         plan = copy.deepcopy(plan)
         configuration = copy.deepcopy(configuration)
-        scan = TaskEngineSession(plan, configuration, self._scans_database, self._plugin_service_api, self._artifacts_path)
+        baseline = yield self._baselines.get(configuration.get('target'), plan['name'])
+        scan = TaskEngineSession(plan, configuration, self._scans_database, self._pool,
+                                 self._artifacts_path, self._scheduler, self._plugin_service_client,
+                                 self._plugin_service_batcher,
+                                 self._scan_max_parallel_sessions, self._admission, priority,
+                                 self._scan_max_issue_memory, self._journal, baseline=baseline,
+                                 results_cache=self._results_cache, force=force)
         yield scan.create()
-        self._sessions[scan.id] = scan
-
-        # If we have not yet started a looping call to idle the sessions, do that now
-        if self._looper is None:
-            self._looper = LoopingCall(self._idleSessions)
-            self._looper.start(2.0)
-        
+        self._registry.add(scan)
         returnValue(scan)
 
+    # Only scans that are not done are in memory. Finished scans have to
+    # be loaded from the database.
+
     def get_session(self, scan_id):
-        # If this scan is still running then we grab it from in-memory
-        # else we load it from the database.
-        session = self._sessions.get(scan_id)
+        session = self._registry.get(scan_id)
         return deferLater(reactor, 0, lambda: session)
-    
-    def delete_session(self, scan_id):
-        if scan_id in self._sessions:
-            del self._sessions[scan_id]
-
-    @inlineCallbacks
-    def _idleSessions(self):
-        for scan_id,session in self._sessions.items():
-            logging.debug("Idling session {}".format(scan_id))
-            done = yield session.idle()
-            # We delete the session after a minute. This gives web clients who are polling
-            # enough time to poll the final results. This is not the best solution but it
-            # will do until we have changed the persistence code in the task engine.
-            if done:
-                deferLater(reactor, 60, self.delete_session, scan_id)
-                
+
+    def get_memory(self):
+        memory = self._registry.memory()
+        return deferLater(reactor, 0, lambda: memory)
+
+    # Return all metrics in the Prometheus text format. The ones that
+    # describe the scans in memory are brought up to date first.
+
+    def get_metrics(self):
+        states = dict((state, 0) for state in SCAN_STATES)
+        for scan in self._registry.scans():
+            states[scan.state] += 1
+        for state,count in states.items():
+            self._scans_metric.set(count, state=state)
+        self._issues_metric.set(self._registry.issues_collected())
+        self._issue_memory_metric.set(self._registry.memory()['size'])
+        self._queued_metric.set(self._admission.queued())
+        metrics = self._metrics.render()
+        return deferLater(reactor, 0, lambda: metrics)
+
+    def get_schedules(self):
+        schedules = self._schedules.schedules()
+        return deferLater(reactor, 0, lambda: schedules)
+
+    def get_schedule(self, schedule_id):
+        schedule = self._schedules.get(schedule_id)
+        return deferLater(reactor, 0, lambda: schedule)
+
+    def create_schedule(self, target, plan_name, cron, priority, **options):
+        schedule = self._schedules.create(target, plan_name, cron, priority, **options)
+        return deferLater(reactor, 0, lambda: schedule)
+
+    def delete_schedule(self, schedule_id):
+        deleted = self._schedules.delete(schedule_id)
+        return deferLater(reactor, 0, lambda: deleted)
+
+    #
+    # Create and start the scan of a schedule that is due. Returns the id
+    # of the scan, or None if the scan that the schedule started the
+    # last time is still in progress or the plan is gone.
+    #
+
+    @inlineCallbacks
+    def _start_scheduled_scan(self, schedule):
+        if schedule['last_scan'] is not None and self._registry.get(schedule['last_scan']) is not None:
+            logging.info("Skipping run of schedule %s, scan %s is still in progress"
+                         % (schedule['id'], schedule['last_scan']))
+            returnValue(None)
+        plan = yield self.get_plan(schedule['plan'])
+        if plan is None:
+            logging.error("Schedule %s has unknown plan %s" % (schedule['id'], schedule['plan']))
+            returnValue(None)
+        scan = yield self.create_session(plan, {'target': schedule['target']}, schedule['priority'])
+        yield scan.start()
+        returnValue(scan.id)
+
+    # Events about plugin sessions that are not part of a scan we are
+    # running are from other task engines or from scans that we are
+    # done with. Those are ignored.
+
+    def _plugin_service_event(self, event):
+        scan = self._registry.get_by_plugin_session(event['session'])
+        if scan is not None:
+            scan.plugin_service_event(event)
+
+    # We may have missed events, so let all running scans look at their
+    # plugin sessions.
+
+    def _wakeup_sessions(self):
+        for scan in self._registry.scans():
+            if scan.state in ('STARTED', 'STOPPING'):
+                scan.wakeup()
+
+    def _session_finished(self, session):
+        # Let the next queued scans run
+        self._admission.release(session)
+        # Scans of the same target are compared with this one from now on
+        if session.state == 'FINISHED':
+            self._baselines.finished(session)
+        # The scan has been stored by now, from here on it is read from the database
+        self._registry.remove(session.id)
+        if self._journal is not None:
+            self._journal.done(session.id)
+
+    #
+    # Pick up the scans that were in progress when the task engine went
+    # down. The ones that were running continue right away, even if
+    # that takes more than the admission budget, and the queued ones
+    # go back in the queue.
+    #
+
+    @inlineCallbacks
+    def _recover(self):
+        recovered, self._recovered = self._recovered, {}
+        results = yield DeferredList([self._recover_scan(scan_id, records)
+                                      for scan_id,records in recovered.items()])
+        scans = [scan for _,scan in results if scan is not None]
+        for scan in scans:
+            if scan.state in ('STARTED', 'STOPPING'):
+                self._admission.readmit(scan)
+                scan.wakeup()
+        for scan in scans:
+            if scan.state == 'QUEUED':
+                self._admission.enqueue(scan)
+
+    @inlineCallbacks
+    def _recover_scan(self, scan_id, records):
+        try:
+            # We may have gone down right after the scan was stored
+            stored = yield self._scans_database.load(scan_id)
+            if stored is not None:
+                self._journal.done(scan_id)
+                returnValue(None)
+            record = records[0]
+            baseline = None
+            if record.get('baseline'):
+                baseline = yield self._baselines.load(record['baseline'])
+            scan = TaskEngineSession(record['plan'], record['configuration'], self._scans_database, self._pool,
+                                     self._artifacts_path, self._scheduler, self._plugin_service_client,
+                                     self._plugin_service_batcher,
+                                     self._scan_max_parallel_sessions, self._admission, record['priority'],
+                                     self._scan_max_issue_memory, scan_id=scan_id, baseline=baseline,
+                                     results_cache=self._results_cache)
+            yield scan.restore(records)
+            scan.journal = self._journal
+            self._registry.add(scan)
+            logging.info("Recovered scan %s in state %s" % (scan_id, scan.state))
+            returnValue(scan)
+        except Exception as e:
+            logging.exception("Failed to recover scan %s: %s" % (scan_id, str(e)))
+            self._journal.done(scan_id)
+            # Do not leave its plugin sessions behind
+            for session in records[0].get('sessions', []):
+                if session.get('cached') is not None:
+                    continue
+                d = self._plugin_service_batcher.delete(session['plugin_service'], session['id'])
+                d.addErrback(lambda failure: logging.error("Unable to delete plugin session: %s"
+                                                           % failure.getErrorMessage()))
@@ -0,0 +1,166 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import copy
+import json
+import logging
+import os
+from collections import OrderedDict
+
+from twisted.internet import reactor
+from twisted.internet.threads import deferToThread
+
+
+SCAN_JOURNAL_FILE_NAME = "minion-task-engine.journal"
+SCAN_JOURNAL_SYNC_INTERVAL = 1.0
+SCAN_JOURNAL_COMPACT_THRESHOLD = 10000
+
+
+class ScanJournal:
+
+    """
+    Write-ahead journal of the scans that are in progress, so that the
+    task engine can pick them up again after a restart. Every record is
+    a line of JSON that belongs to one scan: the scan with its plugin
+    sessions when it is created, its state changes, the state changes
+    of its plugin sessions and which issues were collected from them.
+    When a scan is done and stored, all its records become garbage.
+
+    Records are written to the file right away, so they survive the
+    task engine going down. They are synced to disk at most every
+    sync_interval seconds, so that the reactor does not wait for the
+    disk on every record. The journal is rewritten with only the records
+    of the scans in progress at startup and when there is a lot of
+    garbage. That happens in a thread; records that come in meanwhile
+    go to the old journal and are added to the new one before it
+    replaces the old one.
+    """
+
+    def __init__(self, path, sync_interval=SCAN_JOURNAL_SYNC_INTERVAL,
+                 compact_threshold=SCAN_JOURNAL_COMPACT_THRESHOLD):
+        self._path = os.path.expanduser(path)
+        self._sync_interval = sync_interval
+        self._compact_threshold = compact_threshold
+        self._records = OrderedDict()
+        self._garbage = 0
+        self._syncer = None
+        self._file = None
+        self._pending = None
+
+    #
+    # Read the journal and return the records of the scans that were in
+    # progress, by scan id in the order in which the scans were created.
+    # The records are copies, the caller can change them. This has to be
+    # called before anything is added to the journal.
+    #
+
+    def replay(self):
+        records = OrderedDict()
+        if os.path.exists(self._path):
+            with open(self._path, "r+") as file:
+                while True:
+                    offset = file.tell()
+                    line = file.readline()
+                    if not line:
+                        break
+                    try:
+                        if not line.endswith("\n"):
+                            raise ValueError("No end of line")
+                        record = json.loads(line)
+                    except ValueError:
+                        # We went down while writing this record. Cut it
+                        # off so that new records do not end up after it.
+                        logging.warning("Ignoring incomplete record at the end of scan journal %s" % self._path)
+                        file.truncate(offset)
+                        break
+                    if record['type'] == 'done':
+                        self._garbage += len(records.pop(record['scan'], [])) + 1
+                    else:
+                        records.setdefault(record['scan'], []).append(record)
+        self._records = records
+        self._file = open(self._path, "a")
+        if self._garbage > 0:
+            self._compact()
+        return copy.deepcopy(records)
+
+    def append(self, record):
+        self._records.setdefault(record['scan'], []).append(record)
+        self._write(record)
+
+    def done(self, scan_id):
+        records = self._records.pop(scan_id, [])
+        self._write({'type': 'done', 'scan': scan_id})
+        self._garbage += len(records) + 1
+        if self._garbage > self._compact_threshold:
+            self._compact()
+
+    def _write(self, record):
+        line = json.dumps(record) + "\n"
+        self._file.write(line)
+        self._file.flush()
+        if self._pending is not None:
+            self._pending.append(line)
+        if self._syncer is None:
+            self._syncer = reactor.callLater(self._sync_interval, self._sync)
+
+    def _sync(self):
+        self._syncer = None
+        os.fsync(self._file.fileno())
+
+    #
+    # Write the records of the scans in progress to a new journal and
+    # replace the old one with it. The new journal is written in a
+    # thread. Records are never changed once they are in the journal,
+    # so the thread can read the ones that we have now while we go on.
+    #
+
+    def _compact(self):
+        if self._pending is not None:
+            return
+        self._pending = []
+        self._garbage = 0
+        records = [record for records in self._records.values() for record in records]
+        temporary_path = self._path + ".tmp"
+        d = deferToThread(self._write_journal, temporary_path, records)
+        d.addCallback(self._compacted, temporary_path)
+        d.addErrback(self._compact_failed, temporary_path)
+        return d
+
+    def _write_journal(self, path, records):
+        with open(path, "w") as file:
+            for record in records:
+                file.write(json.dumps(record) + "\n")
+            file.flush()
+            os.fsync(file.fileno())
+
+    # Add the records that came in while the new journal was written and
+    # put it in place of the old one, which has them all until then.
+
+    def _compacted(self, _, temporary_path):
+        pending, self._pending = self._pending, None
+        if self._file is None:
+            os.remove(temporary_path)
+            return
+        with open(temporary_path, "a") as file:
+            file.writelines(pending)
+        os.rename(temporary_path, self._path)
+        self._file.close()
+        self._file = open(self._path, "a")
+        if pending and self._syncer is None:
+            self._syncer = reactor.callLater(self._sync_interval, self._sync)
+
+    def _compact_failed(self, failure, temporary_path):
+        self._pending = None
+        logging.error("Failed to compact scan journal %s: %s" % (self._path, failure.getErrorMessage()))
+        if os.path.exists(temporary_path):
+            os.remove(temporary_path)
+
+    def close(self):
+        if self._syncer is not None:
+            self._syncer.cancel()
+            self._syncer = None
+        if self._file is not None:
+            os.fsync(self._file.fileno())
+            self._file.close()
+            self._file = None
@@ -0,0 +1,144 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import bisect
+
+
+METRICS_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join('%s="%s"' % (name, _escape(value)) for name,value in zip(names, values)) + '}'
+
+
+def _format_value(value):
+    if value == float('inf'):
+        return '+Inf'
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+
+class Metric:
+
+    """
+    A metric with a value for every combination of label values that it
+    has seen. Values are keyed by the tuple of label values in the order
+    of label_names.
+    """
+
+    type = None
+
+    def __init__(self, name, description, label_names=()):
+        self.name = name
+        self.description = description
+        self.label_names = tuple(label_names)
+        self._values = {}
+
+    def _key(self, labels):
+        return tuple(labels[name] for name in self.label_names)
+
+    def render(self):
+        lines = ["# HELP %s %s" % (self.name, self.description),
+                 "# TYPE %s %s" % (self.name, self.type)]
+        for key in sorted(self._values):
+            lines += self._render(key, self._values[key])
+        return lines
+
+    def _render(self, key, value):
+        return ["%s%s %s" % (self.name, _format_labels(self.label_names, key), _format_value(value))]
+
+
+class Counter(Metric):
+
+    type = 'counter'
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        self._values[key] = self._values.get(key, 0) + amount
+
+    # For counters that are kept as a running total elsewhere
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Gauge(Metric):
+
+    type = 'gauge'
+
+    def set(self, value, **labels):
+        self._values[self._key(labels)] = value
+
+
+class Histogram(Metric):
+
+    """
+    Counts observations in cumulative buckets, as Prometheus expects
+    them, and keeps their sum and count.
+    """
+
+    type = 'histogram'
+
+    def __init__(self, name, description, label_names=(), buckets=METRICS_LATENCY_BUCKETS):
+        Metric.__init__(self, name, description, label_names)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        counts = self._values.get(key)
+        if counts is None:
+            # One count per bucket, one for +Inf, then the sum
+            counts = self._values[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        counts[-1] += value
+
+    def _render(self, key, counts):
+        lines = []
+        total = 0
+        for bound,count in zip(self.buckets + (float('inf'),), counts):
+            total += count
+            labels = _format_labels(self.label_names + ('le',), key + (_format_value(float(bound)),))
+            lines.append("%s_bucket%s %d" % (self.name, labels, total))
+        labels = _format_labels(self.label_names, key)
+        lines.append("%s_sum%s %s" % (self.name, labels, _format_value(counts[-1])))
+        lines.append("%s_count%s %d" % (self.name, labels, total))
+        return lines
+
+
+class MetricsRegistry:
+
+    """
+    The metrics of the task engine, rendered in the Prometheus text
+    exposition format. Metrics are registered once and then updated in
+    place by the code that they measure.
+    """
+
+    def __init__(self):
+        self._metrics = []
+
+    def _register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name, description, label_names=()):
+        return self._register(Counter(name, description, label_names))
+
+    def gauge(self, name, description, label_names=()):
+        return self._register(Gauge(name, description, label_names))
+
+    def histogram(self, name, description, label_names=(), buckets=METRICS_LATENCY_BUCKETS):
+        return self._register(Histogram(name, description, label_names, buckets))
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
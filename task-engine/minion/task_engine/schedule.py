@@ -0,0 +1,276 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import calendar
+import datetime
+import hashlib
+import json
+import logging
+import math
+import os
+import random
+import time
+import uuid
+from collections import OrderedDict
+
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import LoopingCall
+
+
+SCAN_SCHEDULES_FILE_NAME = "minion-task-engine.schedules"
+SCAN_SCHEDULE_DEFAULT_SPREAD = 300
+SCAN_SCHEDULE_DEFAULT_JITTER = 30
+SCAN_SCHEDULE_WHEEL_RESOLUTION = 1.0
+SCAN_SCHEDULE_WHEEL_SLOTS = 3600
+
+# The fields of a cron expression with their ranges
+CRON_FIELDS = (('minute', 0, 59), ('hour', 0, 23), ('day', 1, 31), ('month', 1, 12), ('weekday', 0, 6))
+CRON_MAX_DAYS = 5 * 366
+
+
+class CronExpression:
+
+    """
+    A cron expression with the usual five fields: minute, hour, day of
+    the month, month and day of the week, with 0 being Sunday. A field
+    is *, a number, a range like 1-5 or a list of those, each of which
+    can have a step like */15. Times are in UTC.
+
+    A field can also be H, which stands for one value in its range that
+    is picked with the seed, or H/step for every step starting at such
+    a value. Schedules that use their id as the seed spread over the
+    range instead of all running at the same time.
+    """
+
+    def __init__(self, expression, seed=''):
+        fields = expression.split()
+        if len(fields) != len(CRON_FIELDS):
+            raise ValueError("A cron expression has %d fields" % len(CRON_FIELDS))
+        self.expression = expression
+        self._values = []
+        for field,(name,low,high) in zip(fields, CRON_FIELDS):
+            self._values.append(self._parse(field, name, low, high, seed))
+        self._any_day = fields[2] == '*'
+        self._any_weekday = fields[4] == '*'
+
+    def _parse(self, field, name, low, high, seed):
+        values = set()
+        for part in field.split(','):
+            part, _, step = part.partition('/')
+            step = int(step) if step else 1
+            if step < 1:
+                raise ValueError("Invalid step in the %s field" % name)
+            if part == '*':
+                first, last = low, high
+            elif part == 'H':
+                hashed = int(hashlib.sha1("%s/%s" % (seed, name)).hexdigest(), 16)
+                first = low + hashed % (min(step, high - low + 1) if step > 1 else high - low + 1)
+                last = high if step > 1 else first
+            elif '-' in part:
+                first, last = [int(value) for value in part.split('-', 1)]
+            else:
+                first = last = int(part)
+            if first < low or last > high or first > last:
+                raise ValueError("Invalid value in the %s field" % name)
+            values.update(range(first, last + 1, step))
+        return values
+
+    def _day_matches(self, day):
+        # Like cron, if both day fields are restricted either one matches
+        weekday = (day.weekday() + 1) % 7
+        if not self._any_day and not self._any_weekday:
+            return day.day in self._values[2] or weekday in self._values[4]
+        return day.day in self._values[2] and weekday in self._values[4]
+
+    #
+    # Return the first time after the given time, in seconds since the
+    # epoch, that matches the expression. Returns None if there is no
+    # such time within a few years, like for February 30.
+    #
+
+    def next(self, after):
+        minutes, hours, days, months, weekdays = self._values
+        t = datetime.datetime.utcfromtimestamp(int(after) // 60 * 60 + 60)
+        limit = t + datetime.timedelta(days=CRON_MAX_DAYS)
+        while t < limit:
+            if t.month not in months:
+                t = (t.replace(day=1, hour=0, minute=0) + datetime.timedelta(days=32)).replace(day=1)
+            elif not self._day_matches(t):
+                t = t.replace(hour=0, minute=0) + datetime.timedelta(days=1)
+            elif t.hour not in hours:
+                t = t.replace(minute=0) + datetime.timedelta(hours=1)
+            elif t.minute not in minutes:
+                t += datetime.timedelta(minutes=1)
+            else:
+                return calendar.timegm(t.timetuple())
+
+
+class TimingWheel:
+
+    """
+    Timers for many keys with a coarse resolution. Time is divided in
+    ticks of resolution seconds and a timer goes in the slot of the tick
+    in which it is due. Every tick a single LoopingCall looks at one
+    slot and calls callback(key) for the timers in it that are due, the
+    others are due in a later turn of the wheel. However many timers
+    there are, the reactor only has one.
+    """
+
+    def __init__(self, callback, resolution=SCAN_SCHEDULE_WHEEL_RESOLUTION, slots=SCAN_SCHEDULE_WHEEL_SLOTS):
+        self._callback = callback
+        self._resolution = resolution
+        self._slots = [[] for n in range(slots)]
+        self._due = {}
+        self._tick = 0
+        self._started = None
+        self._loop = LoopingCall.withCount(self._advance)
+
+    def start(self):
+        self._started = time.time()
+        self._loop.start(self._resolution, now=False)
+
+    def stop(self):
+        if self._loop.running:
+            self._loop.stop()
+
+    def add(self, key, when):
+        tick = max(self._tick + 1, int(math.ceil((when - self._started) / self._resolution)))
+        self._due[key] = tick
+        self._slots[tick % len(self._slots)].append((tick, key))
+
+    # Removed timers stay in their slot until it comes around
+
+    def remove(self, key):
+        self._due.pop(key, None)
+
+    def _advance(self, count):
+        # When the reactor was busy we may have missed ticks
+        for n in range(count):
+            self._tick += 1
+            slot = self._slots[self._tick % len(self._slots)]
+            due = [key for tick,key in slot if tick <= self._tick and self._due.get(key) == tick]
+            slot[:] = [(tick, key) for tick,key in slot if tick > self._tick and self._due.get(key) == tick]
+            for key in due:
+                del self._due[key]
+                try:
+                    self._callback(key)
+                except Exception as e:
+                    logging.exception("Timer for %s failed: %s" % (key, str(e)))
+
+
+class RecurringScans:
+
+    """
+    Scans that run periodically, each of a target with a plan on a cron
+    expression, between an optional start and end time. When a schedule
+    is due start_scan(schedule) is called, which returns a deferred that
+    fires with the id of the scan that it started.
+
+    A schedule does not run exactly on its cron times. It runs a fixed
+    number of seconds, below spread, after them that is picked with its
+    id, and then a random number of seconds, below jitter, later. So
+    the many schedules that run at the top of the hour are spread out
+    over the first minutes of the hour.
+
+    A schedule does not start a scan while the scan that it started the
+    last time is still in progress, start_scan returns None then.
+
+    The schedules are saved in a JSON file at path, if there is one.
+    """
+
+    def __init__(self, path, start_scan, resolution=SCAN_SCHEDULE_WHEEL_RESOLUTION,
+                 slots=SCAN_SCHEDULE_WHEEL_SLOTS):
+        self._path = os.path.expanduser(path) if path else None
+        self._start_scan = start_scan
+        self._schedules = OrderedDict()
+        self._wheel = TimingWheel(self._due, resolution, slots)
+        if self._path is not None and os.path.exists(self._path):
+            with open(self._path) as file:
+                for schedule in json.load(file):
+                    self._add(schedule)
+
+    def _add(self, schedule):
+        schedule.update(next_run=None, last_run=None, last_scan=None)
+        self._schedules[schedule['id']] = (schedule, CronExpression(schedule['cron'], schedule['id']))
+
+    def _save(self):
+        if self._path is None:
+            return
+        keys = ('id', 'target', 'plan', 'cron', 'priority', 'spread', 'jitter', 'start', 'end', 'created')
+        schedules = [dict((key, schedule[key]) for key in keys) for schedule,_ in self._schedules.values()]
+        temporary_path = self._path + ".tmp"
+        with open(temporary_path, "w") as file:
+            json.dump(schedules, file, indent=4)
+        os.rename(temporary_path, self._path)
+
+    def start(self):
+        self._wheel.start()
+        for schedule_id in self._schedules:
+            self._plan(schedule_id, time.time())
+
+    def stop(self):
+        self._wheel.stop()
+
+    #
+    # Put the next run of a schedule after the given time in the wheel.
+    # The offset within the spread is the same for every run, the jitter
+    # is not.
+    #
+
+    def _plan(self, schedule_id, after):
+        schedule, cron = self._schedules[schedule_id]
+        offset = int(hashlib.sha1(schedule_id).hexdigest(), 16) % max(int(schedule['spread']), 1)
+        when = cron.next(max(after - offset, schedule['start'] or 0))
+        if when is None or (schedule['end'] and when + offset > schedule['end']):
+            schedule['next_run'] = None
+            return
+        schedule['next_run'] = int(when + offset + random.uniform(0, schedule['jitter']))
+        self._wheel.add(schedule_id, schedule['next_run'])
+
+    @inlineCallbacks
+    def _due(self, schedule_id):
+        if schedule_id not in self._schedules:
+            return
+        schedule, cron = self._schedules[schedule_id]
+        self._plan(schedule_id, time.time())
+        try:
+            scan_id = yield self._start_scan(schedule)
+        except Exception as e:
+            logging.error("Failed to start the scan of schedule %s: %s" % (schedule_id, str(e)))
+            return
+        if scan_id is not None:
+            schedule['last_run'] = int(time.time())
+            schedule['last_scan'] = scan_id
+
+    def create(self, target, plan_name, cron, priority, spread=SCAN_SCHEDULE_DEFAULT_SPREAD,
+               jitter=SCAN_SCHEDULE_DEFAULT_JITTER, start=None, end=None):
+        schedule = { 'id': str(uuid.uuid4()),
+                     'target': target,
+                     'plan': plan_name,
+                     'cron': cron,
+                     'priority': priority,
+                     'spread': spread,
+                     'jitter': jitter,
+                     'start': start,
+                     'end': end,
+                     'created': int(time.time()) }
+        self._add(schedule)
+        self._save()
+        if self._wheel._started is not None:
+            self._plan(schedule['id'], time.time())
+        return schedule
+
+    def delete(self, schedule_id):
+        if self._schedules.pop(schedule_id, None) is None:
+            return False
+        self._wheel.remove(schedule_id)
+        self._save()
+        return True
+
+    def get(self, schedule_id):
+        entry = self._schedules.get(schedule_id)
+        return entry[0] if entry else None
+
+    def schedules(self):
+        return [schedule for schedule,_ in self._schedules.values()]
@@ -0,0 +1,110 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+
+from twisted.trial import unittest
+
+from minion.task_engine.engine import ScanAdmissionQueue
+
+
+class FakeScan:
+
+    def __init__(self, scan_id, cost=1, priority='normal', plan_name='test'):
+        self.id = scan_id
+        self.plan = {'name': plan_name, 'cost': cost}
+        self.priority = priority
+        self.running = False
+        self.queue_changes = 0
+
+    def admitted(self):
+        self.running = True
+
+    def queue_changed(self):
+        self.queue_changes += 1
+
+
+class ScanAdmissionQueueTest(unittest.TestCase):
+
+    def test_scans_are_admitted_within_the_budget(self):
+        queue = ScanAdmissionQueue(budget=3)
+        scans = [FakeScan(str(n)) for n in range(5)]
+        for scan in scans:
+            queue.enqueue(scan)
+        self.assertEqual([scan.running for scan in scans], [True, True, True, False, False])
+        self.assertEqual(queue.queued(), 2)
+        queue.release(scans[0])
+        self.assertEqual([scan.running for scan in scans], [True, True, True, True, False])
+        # When it was queued and when the queue moved
+        self.assertEqual(scans[4].queue_changes, 2)
+
+    def test_scans_are_admitted_by_priority(self):
+        queue = ScanAdmissionQueue(budget=1)
+        running, low, normal, high = FakeScan('r'), FakeScan('l', priority='low'), FakeScan('n'), FakeScan('h', priority='high')
+        for scan in (running, low, normal, high):
+            queue.enqueue(scan)
+        queue.release(running)
+        self.assertTrue(high.running)
+        queue.release(high)
+        self.assertTrue(normal.running)
+        self.assertFalse(low.running)
+
+    def test_big_scan_holds_up_the_scans_behind_it(self):
+        queue = ScanAdmissionQueue(budget=4)
+        running, big, small = FakeScan('r', cost=3), FakeScan('b', cost=2), FakeScan('s', cost=1)
+        for scan in (running, big, small):
+            queue.enqueue(scan)
+        self.assertFalse(big.running)
+        self.assertFalse(small.running)
+        queue.release(running)
+        self.assertTrue(big.running)
+        self.assertTrue(small.running)
+
+    def test_scan_that_costs_more_than_the_budget_runs_on_its_own(self):
+        queue = ScanAdmissionQueue(budget=4)
+        huge, small = FakeScan('h', cost=10), FakeScan('s')
+        queue.enqueue(huge)
+        queue.enqueue(small)
+        self.assertTrue(huge.running)
+        self.assertFalse(small.running)
+        queue.release(huge)
+        self.assertTrue(small.running)
+
+    def test_remove_queued_scan(self):
+        queue = ScanAdmissionQueue(budget=1)
+        running, removed, waiting = FakeScan('r'), FakeScan('x'), FakeScan('w')
+        for scan in (running, removed, waiting):
+            queue.enqueue(scan)
+        queue.remove(removed)
+        self.assertEqual(queue.position(waiting)[0], 1)
+        queue.release(running)
+        self.assertFalse(removed.running)
+        self.assertTrue(waiting.running)
+
+    def test_readmitted_scans_count_against_the_budget(self):
+        queue = ScanAdmissionQueue(budget=2)
+        recovered = [FakeScan(str(n)) for n in range(3)]
+        for scan in recovered:
+            queue.readmit(scan)
+        scan = FakeScan('new')
+        queue.enqueue(scan)
+        self.assertFalse(scan.running)
+        queue.release(recovered[0])
+        self.assertFalse(scan.running)
+        queue.release(recovered[1])
+        self.assertTrue(scan.running)
+
+    def test_position_and_estimate(self):
+        queue = ScanAdmissionQueue(budget=1)
+        first, second, third = FakeScan('1'), FakeScan('2'), FakeScan('3')
+        for scan in (first, second, third):
+            queue.enqueue(scan)
+        self.assertEqual(queue.position(second), (1, None))
+        self.assertEqual(queue.position(third), (2, None))
+        self.assertEqual(queue.position(first), (None, None))
+        # Once we know how long scans of the plan take we can estimate
+        queue.release(first)
+        position, estimate = queue.position(third)
+        self.assertEqual(position, 1)
+        self.assertTrue(abs(estimate - time.time()) < 5)
@@ -0,0 +1,151 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+
+import cyclone.web
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed
+from twisted.trial import unittest
+from twisted.web.client import Agent, readBody
+from twisted.web.http_headers import Headers
+
+from minion.task_engine.web import ScanArtifactsHandler
+
+
+SCAN_ID = "3c0883e2-c22f-47a8-932a-958a7846c2ad"
+SESSION_ID = "b8f4a5a0-77a5-4a5c-9d53-3b0c3a4d7d3e"
+OTHER_SESSION_ID = "c0a3e2f1-5d1e-4f1a-8c0b-2a1b3c4d5e6f"
+
+# More than one chunk of the producer
+ARTIFACTS = ''.join(chr(n % 251) for n in range(150 * 1024))
+
+
+class FakeScanDatabase:
+
+    def load(self, scan_id):
+        if scan_id == SCAN_ID:
+            return succeed({'id': SCAN_ID, 'sessions': [{'id': SESSION_ID}, {'id': OTHER_SESSION_ID}]})
+        return succeed(None)
+
+
+class FakeTaskEngine:
+
+    def get_session(self, scan_id):
+        return succeed(None)
+
+
+class ScanArtifactsHandlerTest(unittest.TestCase):
+
+    def setUp(self):
+        artifacts_path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, artifacts_path)
+        with open(os.path.join(artifacts_path, SESSION_ID + ".zip"), "wb") as file:
+            file.write(ARTIFACTS)
+        application = cyclone.web.Application([(r"/scan/([a-f0-9-]+)/artifacts/([a-f0-9-]+)", ScanArtifactsHandler)],
+                                              task_engine={'artifacts_path': artifacts_path})
+        application.scan_database = FakeScanDatabase()
+        application.task_engine = FakeTaskEngine()
+        self.port = reactor.listenTCP(0, application, interface="127.0.0.1")
+        self.addCleanup(self.port.stopListening)
+
+    @inlineCallbacks
+    def request(self, headers={}, method='GET', session_id=SESSION_ID):
+        url = "http://127.0.0.1:%d/scan/%s/artifacts/%s" % (self.port.getHost().port, SCAN_ID, session_id)
+        headers = Headers(dict((name, [value]) for name,value in headers.items()))
+        response = yield Agent(reactor).request(method, url, headers)
+        body = yield readBody(response)
+        returnValue((response.code, response.headers, body))
+
+    @inlineCallbacks
+    def etag(self):
+        code, headers, body = yield self.request(method='HEAD')
+        returnValue(headers.getRawHeaders('ETag')[0])
+
+    @inlineCallbacks
+    def test_whole_file(self):
+        code, headers, body = yield self.request()
+        self.assertEqual(code, 200)
+        self.assertEqual(body, ARTIFACTS)
+        self.assertEqual(headers.getRawHeaders('Accept-Ranges'), ['bytes'])
+        self.assertEqual(headers.getRawHeaders('Content-Type'), ['application/zip'])
+
+    @inlineCallbacks
+    def test_head(self):
+        code, headers, body = yield self.request(method='HEAD')
+        self.assertEqual(code, 200)
+        self.assertEqual(body, '')
+        self.assertEqual(headers.getRawHeaders('Content-Length'), [str(len(ARTIFACTS))])
+        self.assertTrue(headers.getRawHeaders('ETag'))
+
+    @inlineCallbacks
+    def test_range(self):
+        code, headers, body = yield self.request({'Range': 'bytes=100-199'})
+        self.assertEqual(code, 206)
+        self.assertEqual(body, ARTIFACTS[100:200])
+        self.assertEqual(headers.getRawHeaders('Content-Range'), ['bytes 100-199/%d' % len(ARTIFACTS)])
+
+    @inlineCallbacks
+    def test_open_ended_range(self):
+        code, headers, body = yield self.request({'Range': 'bytes=70000-'})
+        self.assertEqual(code, 206)
+        self.assertEqual(body, ARTIFACTS[70000:])
+
+    @inlineCallbacks
+    def test_range_past_the_end_is_cut_off(self):
+        code, headers, body = yield self.request({'Range': 'bytes=10-%d' % (len(ARTIFACTS) * 2)})
+        self.assertEqual(code, 206)
+        self.assertEqual(body, ARTIFACTS[10:])
+        self.assertEqual(headers.getRawHeaders('Content-Range'), ['bytes 10-%d/%d' % (len(ARTIFACTS) - 1, len(ARTIFACTS))])
+
+    @inlineCallbacks
+    def test_suffix_range(self):
+        code, headers, body = yield self.request({'Range': 'bytes=-10'})
+        self.assertEqual(code, 206)
+        self.assertEqual(body, ARTIFACTS[-10:])
+        code, headers, body = yield self.request({'Range': 'bytes=-%d' % (len(ARTIFACTS) * 2)})
+        self.assertEqual(code, 206)
+        self.assertEqual(body, ARTIFACTS)
+
+    @inlineCallbacks
+    def test_unsatisfiable_ranges(self):
+        for value in ('bytes=%d-' % len(ARTIFACTS), 'bytes=20-10', 'bytes=-0'):
+            code, headers, body = yield self.request({'Range': value})
+            self.assertEqual(code, 416)
+            self.assertEqual(headers.getRawHeaders('Content-Range'), ['bytes */%d' % len(ARTIFACTS)])
+
+    @inlineCallbacks
+    def test_malformed_and_multiple_ranges_get_the_whole_file(self):
+        for value in ('bytes=-', 'bytes=a-b', 'lines=1-2', 'bytes=0-1,5-6'):
+            code, headers, body = yield self.request({'Range': value})
+            self.assertEqual(code, 200)
+            self.assertEqual(body, ARTIFACTS)
+
+    @inlineCallbacks
+    def test_if_range(self):
+        etag = yield self.etag()
+        code, headers, body = yield self.request({'Range': 'bytes=0-9', 'If-Range': etag})
+        self.assertEqual(code, 206)
+        self.assertEqual(body, ARTIFACTS[:10])
+        code, headers, body = yield self.request({'Range': 'bytes=0-9', 'If-Range': '"something-else"'})
+        self.assertEqual(code, 200)
+        self.assertEqual(body, ARTIFACTS)
+
+    @inlineCallbacks
+    def test_if_none_match(self):
+        etag = yield self.etag()
+        code, headers, body = yield self.request({'If-None-Match': etag})
+        self.assertEqual(code, 304)
+        self.assertEqual(body, '')
+        code, headers, body = yield self.request({'If-None-Match': '"something-else"'})
+        self.assertEqual(code, 200)
+
+    @inlineCallbacks
+    def test_missing_artifacts(self):
+        code, headers, body = yield self.request(session_id=OTHER_SESSION_ID)
+        self.assertEqual(code, 404)
+        code, headers, body = yield self.request(session_id="00000000-0000-0000-0000-000000000000")
+        self.assertEqual(code, 404)
@@ -0,0 +1,124 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+
+from twisted.internet.defer import fail, gatherResults, inlineCallbacks, succeed
+from twisted.trial import unittest
+
+from minion.task_engine.client import PluginServiceError
+from minion.task_engine.engine import PluginServiceBatcher
+
+
+API = "http://plugin-service"
+
+
+class FakeClient:
+
+    # Answers requests with answer(method, path, body), which returns the
+    # parsed response or raises
+
+    def __init__(self, answer):
+        self.requests = []
+        self._answer = answer
+
+    def request(self, method, url, body=None):
+        path = url[len(API):]
+        self.requests.append((method, path, body))
+        try:
+            return succeed(self._answer(method, path, body))
+        except Exception as e:
+            return fail(e)
+
+
+def summaries(method, path, body):
+    session_ids = json.loads(body)
+    return {'success': True, 'errors': {}, 'sessions': dict((i, {'id': i, 'state': 'STARTED'}) for i in session_ids)}
+
+def no_batch_api(method, path, body):
+    if path.startswith("/sessions/"):
+        raise PluginServiceError("404 Not Found")
+    if method == 'GET':
+        return {'success': True, 'session': {'id': path.split('/')[-1]}}
+    return {'success': True}
+
+
+class PluginServiceBatcherTest(unittest.TestCase):
+
+    @inlineCallbacks
+    def test_requests_in_the_same_turn_are_batched(self):
+        client = FakeClient(summaries)
+        batcher = PluginServiceBatcher(client)
+        results = yield gatherResults([batcher.summary(API, 'a'), batcher.summary(API, 'b')])
+        self.assertEqual(results, [{'success': True, 'session': {'id': 'a', 'state': 'STARTED'}},
+                                   {'success': True, 'session': {'id': 'b', 'state': 'STARTED'}}])
+        self.assertEqual(len(client.requests), 1)
+        method, path, body = client.requests[0]
+        self.assertEqual((method, path, sorted(json.loads(body))), ('POST', '/sessions/summary', ['a', 'b']))
+
+    @inlineCallbacks
+    def test_batches_are_split(self):
+        client = FakeClient(summaries)
+        batcher = PluginServiceBatcher(client, batch_size=2)
+        yield gatherResults([batcher.summary(API, session_id) for session_id in 'abcde'])
+        self.assertEqual([len(json.loads(body)) for _,_,body in client.requests], [2, 2, 1])
+
+    @inlineCallbacks
+    def test_state_changes_are_batched_by_state(self):
+        client = FakeClient(lambda method, path, body: {'success': True, 'errors': {'b': 'no-such-session'}})
+        batcher = PluginServiceBatcher(client)
+        results = yield gatherResults([batcher.change_state(API, 'a', 'START'), batcher.change_state(API, 'b', 'START'),
+                                       batcher.change_state(API, 'c', 'STOP')])
+        self.assertEqual(results, [{'success': True}, {'success': False, 'error': 'no-such-session'}, {'success': True}])
+        bodies = sorted((json.loads(body)['state'], sorted(json.loads(body)['sessions'])) for _,_,body in client.requests)
+        self.assertEqual(bodies, [('START', ['a', 'b']), ('STOP', ['c'])])
+
+    @inlineCallbacks
+    def test_errors_and_missing_sessions_fail_their_waiters(self):
+        def answer(method, path, body):
+            return {'success': True, 'errors': {'b': 'no-such-plugin'}, 'sessions': {'a': {'id': 'a'}}}
+        batcher = PluginServiceBatcher(FakeClient(answer))
+        a, b, c = [batcher.summary(API, session_id) for session_id in 'abc']
+        result = yield a
+        self.assertEqual(result, {'success': True, 'session': {'id': 'a'}})
+        e = yield self.assertFailure(b, Exception)
+        self.assertEqual(str(e), 'no-such-plugin')
+        e = yield self.assertFailure(c, Exception)
+        self.assertEqual(str(e), 'no-such-session')
+
+    @inlineCallbacks
+    def test_failed_batch_fails_every_waiter(self):
+        batcher = PluginServiceBatcher(FakeClient(lambda method, path, body: {'success': False, 'error': 'busy'}))
+        deferreds = [batcher.delete(API, 'a'), batcher.delete(API, 'b')]
+        for d in deferreds:
+            e = yield self.assertFailure(d, Exception)
+            self.assertEqual(str(e), 'busy')
+
+    @inlineCallbacks
+    def test_invalid_answer_fails_every_waiter(self):
+        batcher = PluginServiceBatcher(FakeClient(lambda method, path, body: {'success': True}))
+        deferreds = [batcher.summary(API, 'a'), batcher.summary(API, 'b')]
+        for d in deferreds:
+            yield self.assertFailure(d, Exception)
+
+    @inlineCallbacks
+    def test_fall_back_to_single_requests(self):
+        client = FakeClient(no_batch_api)
+        batcher = PluginServiceBatcher(client)
+        results = yield gatherResults([batcher.summary(API, 'a'), batcher.change_state(API, 'b', 'STOP'),
+                                       batcher.delete(API, 'c')])
+        self.assertEqual(results, [{'success': True, 'session': {'id': 'a'}}, {'success': True}, {'success': True}])
+        single = sorted(request for request in client.requests if not request[1].startswith("/sessions/"))
+        self.assertEqual(single, [('DELETE', '/session/c', None), ('GET', '/session/a', None),
+                                  ('PUT', '/session/b/state', 'STOP')])
+
+    @inlineCallbacks
+    def test_failed_single_summary_fails_its_waiter(self):
+        def answer(method, path, body):
+            if path.startswith("/sessions/"):
+                raise PluginServiceError("404 Not Found")
+            return {'success': False, 'error': 'no-such-session'}
+        batcher = PluginServiceBatcher(FakeClient(answer))
+        e = yield self.assertFailure(batcher.summary(API, 'a'), Exception)
+        self.assertEqual(str(e), 'no-such-session')
@@ -0,0 +1,143 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+
+from twisted.internet.defer import fail, inlineCallbacks, succeed
+from twisted.trial import unittest
+
+from minion.task_engine.client import PluginServiceError
+from minion.task_engine.engine import TaskEngineSession
+
+
+class FakeClient:
+
+    # Answers requests with answer(api, method, path, body), which
+    # returns the parsed response or raises
+
+    def __init__(self, answer):
+        self.requests = []
+        self._answer = answer
+
+    def request(self, method, url, body=None):
+        split = url.index("/", len("http://"))
+        api, path = url[:split], url[split:]
+        self.requests.append((api, method, path))
+        try:
+            return succeed(self._answer(api, method, path, body))
+        except Exception as e:
+            return fail(e)
+
+
+class FakeBatcher:
+
+    def __init__(self):
+        self.deleted = []
+
+    def delete(self, plugin_service_api, session_id):
+        self.deleted.append((plugin_service_api, session_id))
+        return succeed({'success': True})
+
+
+class FakeNode:
+
+    def __init__(self, api):
+        self.api = api
+
+
+class FakePool:
+
+    # Plugins go to the plugin service that is in plugins for them
+
+    def __init__(self, plugins):
+        self._plugins = plugins
+
+    def choose(self, plugin_name):
+        api = self._plugins.get(plugin_name)
+        return succeed(FakeNode(api) if api else None)
+
+
+def bulk_create(api, method, path, body):
+    if path == "/sessions/create":
+        requests = json.loads(body)
+        return {'success': True, 'sessions': [{'id': '%s-%s' % (api, r['plugin'])} for r in requests]}
+    raise PluginServiceError("Unexpected request %s %s" % (method, path))
+
+def single_create(failing=()):
+    def answer(api, method, path, body):
+        if path == "/sessions/create":
+            raise PluginServiceError("404 Not Found")
+        plugin = path.split("/")[-1]
+        if plugin in failing:
+            return {'success': False, 'error': 'no-such-plugin'}
+        return {'success': True, 'session': {'id': '%s-%s' % (api, plugin)}}
+    return answer
+
+def requests(*plugins):
+    return [{'plugin': plugin, 'configuration': {'target': 'http://example.com'}} for plugin in plugins]
+
+
+class CreateSessionsTest(unittest.TestCase):
+
+    def make_scan(self, answer, plugins=None):
+        self.client = FakeClient(answer)
+        self.batcher = FakeBatcher()
+        plan = {'name': 'test', 'workflow': []}
+        return TaskEngineSession(plan, {}, None, FakePool(plugins or {}), '/tmp', None, self.client, self.batcher)
+
+    @inlineCallbacks
+    def test_bulk_create(self):
+        scan = self.make_scan(bulk_create)
+        sessions = yield scan._create_sessions_on("http://a", requests('x', 'y'))
+        self.assertEqual(sessions, [{'id': 'http://a-x'}, {'id': 'http://a-y'}])
+        self.assertEqual(self.client.requests, [("http://a", 'PUT', "/sessions/create")])
+
+    @inlineCallbacks
+    def test_failed_bulk_create(self):
+        scan = self.make_scan(lambda api, method, path, body: {'success': False, 'error': 'no-such-plugin'})
+        e = yield self.assertFailure(scan._create_sessions_on("http://a", requests('x')), Exception)
+        self.assertEqual(str(e), 'no-such-plugin')
+        self.assertEqual(len(self.client.requests), 1)
+
+    @inlineCallbacks
+    def test_fall_back_to_single_creates(self):
+        scan = self.make_scan(single_create())
+        sessions = yield scan._create_sessions_on("http://a", requests('x', 'y'))
+        self.assertEqual(sessions, [{'id': 'http://a-x', 'plugin_service': "http://a"},
+                                    {'id': 'http://a-y', 'plugin_service': "http://a"}])
+        self.assertEqual(sorted(path for _,_,path in self.client.requests),
+                         ["/session/create/x", "/session/create/y", "/sessions/create"])
+
+    @inlineCallbacks
+    def test_failed_single_create_deletes_the_others(self):
+        scan = self.make_scan(single_create(failing=('y',)))
+        e = yield self.assertFailure(scan._create_sessions_on("http://a", requests('x', 'y', 'z')), Exception)
+        self.assertEqual(str(e), 'no-such-plugin')
+        self.assertEqual(sorted(self.batcher.deleted), [("http://a", 'http://a-x'), ("http://a", 'http://a-z')])
+
+    @inlineCallbacks
+    def test_sessions_are_created_on_their_plugin_services(self):
+        scan = self.make_scan(bulk_create, {'x': "http://a", 'y': "http://b", 'z': "http://a"})
+        sessions = yield scan._create_sessions(requests('x', 'y', 'z'))
+        self.assertEqual(sessions, [{'id': 'http://a-x', 'plugin_service': "http://a"},
+                                    {'id': 'http://b-y', 'plugin_service': "http://b"},
+                                    {'id': 'http://a-z', 'plugin_service': "http://a"}])
+        self.assertEqual(sorted(api for api,_,_ in self.client.requests), ["http://a", "http://b"])
+
+    @inlineCallbacks
+    def test_failure_on_one_plugin_service_deletes_sessions_on_the_others(self):
+        def answer(api, method, path, body):
+            if api == "http://b":
+                return {'success': False, 'error': 'no-such-plugin'}
+            return bulk_create(api, method, path, body)
+        scan = self.make_scan(answer, {'x': "http://a", 'y': "http://b", 'z': "http://a"})
+        e = yield self.assertFailure(scan._create_sessions(requests('x', 'y', 'z')), Exception)
+        self.assertEqual(str(e), 'no-such-plugin')
+        self.assertEqual(sorted(self.batcher.deleted), [("http://a", 'http://a-x'), ("http://a", 'http://a-z')])
+
+    @inlineCallbacks
+    def test_no_plugin_service_for_a_plugin(self):
+        scan = self.make_scan(bulk_create, {'x': "http://a"})
+        yield self.assertFailure(scan._create_sessions(requests('x', 'y')), Exception)
+        self.assertEqual(self.client.requests, [])
@@ -0,0 +1,188 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+
+from twisted.internet.defer import gatherResults, inlineCallbacks
+from twisted.trial import unittest
+
+from minion.task_engine.database import FileScanDatabase, MemoryScanDatabase, _scan_description
+from minion.task_engine.engine import IssueIndex, ScanBaselines, ScanDiff
+
+
+def distinct_issues(*summaries):
+    index = IssueIndex()
+    for summary in summaries:
+        index.add('Plugin', {'Summary': summary, 'Severity': 'High'})
+    return index
+
+def stored_scan(scan_id, target, plan_name='basic', state='FINISHED', finished=None, summaries=()):
+    return {'id': scan_id,
+            'state': state,
+            'plan': {'name': plan_name},
+            'configuration': {'target': target},
+            'created': finished,
+            'finished': finished,
+            'sessions': [{'plugin': {'name': 'Plugin'},
+                          'issues': [{'Summary': summary, 'Severity': 'High'} for summary in summaries]}]}
+
+
+class ScanDiffTest(unittest.TestCase):
+
+    def summaries(self, issues):
+        return [issue['Summary'] for issue in issues]
+
+    def test_without_baseline_everything_is_new(self):
+        index = distinct_issues('A', 'B')
+        diff = ScanDiff()
+        for issue in index.issues():
+            diff.add(issue['Fingerprint'])
+        description = diff.describe(index)
+        self.assertEqual(description['baseline'], None)
+        self.assertEqual(self.summaries(description['new']), ['A', 'B'])
+        self.assertEqual(description['unchanged'], [])
+        self.assertEqual(description['resolved'], [])
+
+    def test_new_unchanged_and_resolved(self):
+        baseline = distinct_issues('A', 'B', 'C')
+        index = distinct_issues('B', 'D')
+        diff = ScanDiff('baseline-id', baseline.issues())
+        for issue in index.issues():
+            diff.add(issue['Fingerprint'])
+        description = diff.describe(index)
+        self.assertEqual(description['baseline'], 'baseline-id')
+        self.assertEqual(self.summaries(description['new']), ['D'])
+        self.assertEqual(self.summaries(description['unchanged']), ['B'])
+        self.assertEqual(self.summaries(description['resolved']), ['A', 'C'])
+
+    def test_new_issues_are_those_of_the_index(self):
+        # The index has the latest counts, URLs and plugins of an issue
+        index = distinct_issues('A')
+        diff = ScanDiff()
+        diff.add(index.issues()[0]['Fingerprint'])
+        index.add('Other', {'Summary': 'A', 'Severity': 'High'})
+        self.assertEqual(diff.describe(index)['new'][0]['Count'], 2)
+
+
+class FakeScan:
+
+    def __init__(self, scan_id, target, plan_name, summaries):
+        self.id = scan_id
+        self.configuration = {'target': target}
+        self.plan = {'name': plan_name}
+        self.distinct_issues = distinct_issues(*summaries)
+
+
+class ScanBaselinesTest(unittest.TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        self.database = MemoryScanDatabase(None)
+        yield self.database.store(stored_scan('old', 'http://a', finished=1, summaries=['A']))
+        yield self.database.store(stored_scan('last', 'http://a', finished=2, summaries=['A', 'B']))
+        yield self.database.store(stored_scan('failed', 'http://a', state='FAILED', finished=3))
+        yield self.database.store(stored_scan('other', 'http://a', plan_name='other', finished=4))
+
+    @inlineCallbacks
+    def test_baseline_is_the_last_finished_scan(self):
+        baselines = ScanBaselines(self.database)
+        scan_id, issues = yield baselines.get('http://a', 'basic')
+        self.assertEqual(scan_id, 'last')
+        self.assertEqual([issue['Summary'] for issue in issues], ['A', 'B'])
+
+    @inlineCallbacks
+    def test_no_baseline(self):
+        baselines = ScanBaselines(self.database)
+        baseline = yield baselines.get('http://b', 'basic')
+        self.assertEqual(baseline, None)
+
+    @inlineCallbacks
+    def test_finished_scan_is_the_new_baseline(self):
+        baselines = ScanBaselines(self.database)
+        yield baselines.get('http://a', 'basic')
+        baselines.finished(FakeScan('new', 'http://a', 'basic', ['C']))
+        scan_id, issues = yield baselines.get('http://a', 'basic')
+        self.assertEqual(scan_id, 'new')
+        self.assertEqual([issue['Summary'] for issue in issues], ['C'])
+
+    @inlineCallbacks
+    def test_only_the_most_recently_used_are_kept(self):
+        baselines = ScanBaselines(self.database, max_size=2)
+        baselines.finished(FakeScan('1', 'http://1', 'basic', []))
+        baselines.finished(FakeScan('2', 'http://2', 'basic', []))
+        yield baselines.get('http://1', 'basic')
+        baselines.finished(FakeScan('3', 'http://3', 'basic', []))
+        self.assertEqual(sorted(baselines._baselines.keys()), [('http://1', 'basic'), ('http://3', 'basic')])
+
+
+class FileScanDatabaseTest(unittest.TestCase):
+
+    @inlineCallbacks
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'scans')
+        database = FileScanDatabase(self.path)
+        for n in range(5):
+            yield database.store(stored_scan('a%d' % n, 'http://a', finished=n))
+        yield database.store(stored_scan('b', 'http://b', state='FAILED', finished=10))
+        yield database.store_issues('running', 0, [(0, {'Summary': 'X'})])
+        self.database = FileScanDatabase(self.path)
+
+    def ids(self, found):
+        return [description['id'] for description in found]
+
+    @inlineCallbacks
+    def test_find(self):
+        found = yield self.database.find(target='http://a')
+        self.assertEqual(self.ids(found), ['a4', 'a3', 'a2', 'a1', 'a0'])
+        self.assertEqual(found[0], {'id': 'a4', 'state': 'FINISHED', 'plan': 'basic', 'target': 'http://a',
+                                    'created': 4, 'finished': 4})
+        found = yield self.database.find(target='http://a', limit=2)
+        self.assertEqual(self.ids(found), ['a4', 'a3'])
+        found = yield self.database.find(state='FAILED')
+        self.assertEqual(self.ids(found), ['b'])
+        found = yield self.database.find(target='http://c')
+        self.assertEqual(found, [])
+        found = yield self.database.find()
+        self.assertEqual(len(found), 6)
+
+    @inlineCallbacks
+    def test_concurrent_finds_read_the_scans_once(self):
+        reads = []
+        read_descriptions = self.database._read_descriptions
+        def _read_descriptions():
+            reads.append(True)
+            return read_descriptions()
+        self.database._read_descriptions = _read_descriptions
+        results = yield gatherResults([self.database.find(target='http://a', limit=1),
+                                       self.database.find(target='http://b')])
+        self.assertEqual([self.ids(found) for found in results], [['a4'], ['b']])
+        self.assertEqual(len(reads), 1)
+
+    @inlineCallbacks
+    def test_stores_and_deletes_update_the_index(self):
+        yield self.database.find()
+        yield self.database.store(stored_scan('a5', 'http://a', finished=5))
+        yield self.database.store(stored_scan('b', 'http://c', finished=10))
+        yield self.database.delete('a4')
+        found = yield self.database.find(target='http://a', limit=2)
+        self.assertEqual(self.ids(found), ['a5', 'a3'])
+        found = yield self.database.find(target='http://b')
+        self.assertEqual(found, [])
+        found = yield self.database.find(target='http://c')
+        self.assertEqual(self.ids(found), ['b'])
+
+    @inlineCallbacks
+    def test_changes_while_reading_are_applied(self):
+        # Stores and deletes that complete while the scans are being read,
+        # which may not see them
+        d = self.database.find(target='http://a')
+        self.database._changed('a9', _scan_description(stored_scan('a9', 'http://a', finished=9)))
+        self.database._changed('a0', None)
+        found = yield d
+        self.assertEqual(self.ids(found), ['a9', 'a4', 'a3', 'a2', 'a1'])
+        self.assertTrue(os.path.exists(os.path.join(self.path, 'running.issues')))
@@ -0,0 +1,157 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, fail, inlineCallbacks, returnValue, succeed
+from twisted.internet.task import deferLater
+from twisted.trial import unittest
+
+from minion.task_engine.database import MemoryScanDatabase
+from minion.task_engine.engine import IssueLog, stored_scan_results
+
+
+def issues(first, count):
+    return [{'Summary': 'Issue %03d' % n} for n in range(first, first + count)]
+
+def entries(session_index, first, count):
+    return [(session_index, issue) for issue in issues(first, count)]
+
+
+class ControlledScanDatabase:
+
+    # store_issues() only completes when the test says so
+
+    def __init__(self):
+        self.stored = []
+        self.storing = []
+        self.failing = False
+
+    def store_issues(self, scan_id, position, entries):
+        if self.failing:
+            return fail(IOError("Disk full"))
+        d = Deferred()
+        self.storing.append(d)
+        def _stored(_):
+            del self.stored[position:]
+            self.stored.extend(entries)
+        return d.addCallback(_stored)
+
+    def load_issues(self, scan_id, start, end):
+        return succeed(self.stored[start:end])
+
+
+class IssueLogTest(unittest.TestCase):
+
+    @inlineCallbacks
+    def spilled_log(self):
+        # 40 issues of 24 bytes, at most 10 of them in memory
+        log = IssueLog(MemoryScanDatabase(None), 'scan', max_size=240)
+        for n in range(0, 40, 5):
+            log.append(n // 10, issues(n, 5))
+            while log._spilling:
+                yield deferLater(reactor, 0, lambda: None)
+        self.assertTrue(log.spilled)
+        self.assertTrue(log.memory()['issues'] <= 10)
+        self.assertEqual(log.memory()['issues'] + log.memory()['spilled_issues'], 40)
+        returnValue(log)
+
+    def all_entries(self):
+        return [entry for n in range(0, 40, 10) for entry in entries(n // 10, n, 10)]
+
+    @inlineCallbacks
+    def test_since_in_memory(self):
+        log = IssueLog(MemoryScanDatabase(None), 'scan')
+        log.append(0, issues(0, 3))
+        log.append(1, issues(3, 2))
+        found, cursor = yield log.since(0)
+        self.assertEqual(found, entries(0, 0, 3) + entries(1, 3, 2))
+        self.assertEqual(cursor, 5)
+        found, cursor = yield log.since(3)
+        self.assertEqual(found, entries(1, 3, 2))
+        found, cursor = yield log.since(5)
+        self.assertEqual((found, cursor), ([], 5))
+        self.assertFalse(log.spilled)
+
+    def test_batches(self):
+        log = IssueLog(MemoryScanDatabase(None), 'scan')
+        log.append(0, issues(0, 3))
+        log.append(0, issues(3, 1))
+        log.append(1, issues(4, 2))
+        log.append(0, issues(6, 1))
+        self.assertEqual(log.batches, [[0, 4], [1, 2], [0, 1]])
+        self.assertEqual(len(log), 7)
+
+    @inlineCallbacks
+    def test_since_across_the_spill_boundary(self):
+        log = yield self.spilled_log()
+        expected = self.all_entries()
+        boundary = log.memory()['spilled_issues']
+        for cursor in (0, 1, boundary - 1, boundary, boundary + 1, 39, 40):
+            found, next_cursor = yield log.since(cursor)
+            self.assertEqual(found, expected[cursor:])
+            self.assertEqual(next_cursor, 40)
+
+    @inlineCallbacks
+    def test_issues_are_found_while_they_are_being_spilled(self):
+        database = ControlledScanDatabase()
+        log = IssueLog(database, 'scan', max_size=240)
+        log.append(0, issues(0, 20))
+        self.assertEqual(len(database.storing), 1)
+        found, cursor = yield log.since(0)
+        self.assertEqual(found, entries(0, 0, 20))
+        # Issues that come in while spilling are not lost either
+        log.append(1, issues(20, 5))
+        database.storing[0].callback(None)
+        while log._spilling:
+            database.storing[-1].callback(None)
+        found, cursor = yield log.since(0)
+        self.assertEqual(found, entries(0, 0, 20) + entries(1, 20, 5))
+        self.assertEqual(cursor, 25)
+        self.assertTrue(log.memory()['spilled_issues'] > 0)
+
+    @inlineCallbacks
+    def test_failed_spill_keeps_the_issues_in_memory(self):
+        database = ControlledScanDatabase()
+        database.failing = True
+        log = IssueLog(database, 'scan', max_size=240)
+        log.append(0, issues(0, 20))
+        self.assertFalse(log.spilled)
+        found, cursor = yield log.since(0)
+        self.assertEqual(found, entries(0, 0, 20))
+
+
+class StoredScanResultsTest(unittest.TestCase):
+
+    # Cursors that were handed out while the scan ran are positions in
+    # its issue log, they must work the same on the stored scan
+
+    def stored_scan(self, batches):
+        a, b, c, d = issues(0, 4)
+        scan = {'id': 'scan', 'state': 'FINISHED',
+                'sessions': [{'id': 's0', 'plugin': {}, 'state': 'FINISHED', 'progress': None, 'issues': [a, b, d]},
+                             {'id': 's1', 'plugin': {}, 'state': 'FINISHED', 'progress': None, 'issues': [c]}]}
+        if batches is not None:
+            scan['_issue_batches'] = batches
+        return scan
+
+    def session_issues(self, results):
+        return [[issue['Summary'] for issue in session['issues']] for session in results['sessions']]
+
+    def test_results_after_cursor(self):
+        scan = self.stored_scan([[0, 2], [1, 1], [0, 1]])
+        results, cursor = stored_scan_results(scan)
+        self.assertEqual(self.session_issues(results), [['Issue 000', 'Issue 001', 'Issue 003'], ['Issue 002']])
+        self.assertEqual(cursor, 4)
+        results, cursor = stored_scan_results(scan, 1)
+        self.assertEqual(self.session_issues(results), [['Issue 001', 'Issue 003'], ['Issue 002']])
+        results, cursor = stored_scan_results(scan, 3)
+        self.assertEqual(self.session_issues(results), [['Issue 003'], []])
+        results, cursor = stored_scan_results(scan, 4)
+        self.assertEqual((self.session_issues(results), cursor), ([[], []], 4))
+
+    def test_scans_without_batches_are_in_session_order(self):
+        scan = self.stored_scan(None)
+        results, cursor = stored_scan_results(scan, 3)
+        self.assertEqual(self.session_issues(results), [[], ['Issue 002']])
+        self.assertEqual(cursor, 4)
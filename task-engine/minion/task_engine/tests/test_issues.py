@@ -0,0 +1,104 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+
+from twisted.trial import unittest
+
+from minion.task_engine.engine import IssueIndex, issue_fingerprint, stored_scan_issue_index, stored_scan_issues
+
+
+class IssueFingerprintTest(unittest.TestCase):
+
+    def test_summary_case_and_whitespace_do_not_matter(self):
+        self.assertEqual(issue_fingerprint({'Summary': 'No  HSTS header', 'Severity': 'High'}),
+                         issue_fingerprint({'Summary': ' no hsts\tHeader ', 'Severity': 'high'}))
+
+    def test_summary_and_severity_matter(self):
+        issue = {'Summary': 'No HSTS header', 'Severity': 'High'}
+        self.assertNotEqual(issue_fingerprint(issue), issue_fingerprint(dict(issue, Summary='No CSP header')))
+        self.assertNotEqual(issue_fingerprint(issue), issue_fingerprint(dict(issue, Severity='Low')))
+
+    def test_only_the_sites_of_urls_matter(self):
+        issue = {'Summary': 'XSS', 'Severity': 'High', 'URLs': ['http://example.com/a?q=1']}
+        self.assertEqual(issue_fingerprint(issue),
+                         issue_fingerprint(dict(issue, URLs=['HTTP://Example.com/b', 'http://example.com/c'])))
+        self.assertNotEqual(issue_fingerprint(issue), issue_fingerprint(dict(issue, URLs=['https://example.com/a'])))
+        self.assertNotEqual(issue_fingerprint(issue), issue_fingerprint(dict(issue, URLs=['http://other.com/a'])))
+        self.assertNotEqual(issue_fingerprint(issue), issue_fingerprint(dict(issue, URLs=[])))
+
+    def test_other_fields_do_not_matter(self):
+        issue = {'Summary': 'XSS', 'Severity': 'High'}
+        self.assertEqual(issue_fingerprint(issue),
+                         issue_fingerprint(dict(issue, Id='1', Date='2012-10-31', Description='Details', URLs=None)))
+
+    def test_missing_fields(self):
+        self.assertEqual(issue_fingerprint({}), issue_fingerprint({'Summary': '', 'Severity': ''}))
+
+
+class IssueIndexTest(unittest.TestCase):
+
+    def test_duplicates_are_merged(self):
+        index = IssueIndex()
+        first = index.add('HSTSPlugin', {'Summary': 'No HSTS header', 'Severity': 'High', 'Id': '1', 'Sequence': 1,
+                                          'URLs': ['http://example.com/']})
+        second = index.add('GarmrPlugin', {'Summary': 'no hsts header', 'Severity': 'High', 'Id': '2',
+                                           'URLs': ['http://example.com/login']})
+        index.add('HSTSPlugin', {'Summary': 'No HSTS header', 'Severity': 'High', 'URLs': ['http://example.com/']})
+        self.assertTrue(first is second)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.issues(), [first])
+        self.assertEqual(first['Id'], '1')
+        self.assertEqual(first['Count'], 3)
+        self.assertEqual(first['URLs'], ['http://example.com/', 'http://example.com/login'])
+        self.assertEqual(first['Plugins'], ['HSTSPlugin', 'GarmrPlugin'])
+        self.assertFalse('Sequence' in first)
+        self.assertTrue(first['Fingerprint'] in index)
+        self.assertTrue(index.get(first['Fingerprint']) is first)
+
+    def test_distinct_issues_are_kept_in_order(self):
+        index = IssueIndex()
+        for summary in ('C', 'A', 'C', 'B'):
+            index.add('Plugin', {'Summary': summary, 'Severity': 'Low'})
+        self.assertEqual([issue['Summary'] for issue in index.issues()], ['C', 'A', 'B'])
+
+    def test_urls_are_limited(self):
+        index = IssueIndex(max_urls=2)
+        for n in range(5):
+            issue = index.add('Plugin', {'Summary': 'XSS', 'Severity': 'High', 'URLs': ['http://example.com/%d' % n]})
+        self.assertEqual(issue['URLs'], ['http://example.com/0', 'http://example.com/1'])
+        self.assertEqual(issue['Count'], 5)
+
+    def test_size_follows_the_distinct_issues(self):
+        index = IssueIndex()
+        self.assertEqual(index.size, 0)
+        issue = index.add('Plugin', {'Summary': 'XSS', 'Severity': 'High', 'URLs': ['http://example.com/a']})
+        size = index.size
+        # About how many bytes it takes as JSON
+        self.assertTrue(abs(size - len(json.dumps(issue))) <= 4)
+        index.add('Plugin', {'Summary': 'XSS', 'Severity': 'High', 'URLs': ['http://example.com/a']})
+        self.assertEqual(index.size, size)
+        index.add('Other', {'Summary': 'XSS', 'Severity': 'High', 'URLs': ['http://example.com/b']})
+        self.assertTrue(index.size > size)
+
+
+class StoredScanIssuesTest(unittest.TestCase):
+
+    def stored_scan(self):
+        return {'sessions': [{'plugin': {'name': 'A'}, 'issues': [{'Summary': 'X', 'Severity': 'Low'},
+                                                                   {'Summary': 'Z', 'Severity': 'Low'}]},
+                             {'plugin': {'name': 'B'}, 'issues': [{'Summary': 'Y', 'Severity': 'Low'},
+                                                                   {'Summary': 'x', 'Severity': 'Low'}]}],
+                '_issue_batches': [[0, 1], [1, 2], [0, 1]]}
+
+    def test_issues_are_indexed_in_the_order_they_were_collected(self):
+        index = stored_scan_issue_index(self.stored_scan())
+        self.assertEqual([issue['Summary'] for issue in index.issues()], ['X', 'Y', 'Z'])
+        self.assertEqual(index.issues()[0]['Plugins'], ['A', 'B'])
+
+    def test_stored_distinct_issues_are_used(self):
+        scan = self.stored_scan()
+        self.assertEqual([issue['Summary'] for issue in stored_scan_issues(scan)], ['X', 'Y', 'Z'])
+        scan['_distinct_issues'] = [{'Summary': 'Stored'}]
+        self.assertEqual(stored_scan_issues(scan), [{'Summary': 'Stored'}])
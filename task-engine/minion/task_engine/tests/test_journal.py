@@ -0,0 +1,122 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import json
+import os
+import shutil
+import tempfile
+
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import deferLater
+from twisted.trial import unittest
+
+from minion.task_engine.journal import ScanJournal
+
+
+def record(scan_id, record_type, **fields):
+    return dict(fields, scan=scan_id, type=record_type)
+
+
+class ScanJournalTest(unittest.TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.path = os.path.join(directory, 'journal')
+
+    def open_journal(self, **kwargs):
+        journal = ScanJournal(self.path, **kwargs)
+        self.addCleanup(journal.close)
+        return journal, journal.replay()
+
+    def lines(self):
+        with open(self.path) as file:
+            return [json.loads(line) for line in file]
+
+    @inlineCallbacks
+    def compacted(self, journal):
+        while journal._pending is not None:
+            yield deferLater(reactor, 0.01, lambda: None)
+
+    def test_replay_of_a_new_journal(self):
+        journal, records = self.open_journal()
+        self.assertEqual(records, {})
+        self.assertTrue(os.path.exists(self.path))
+
+    def test_replay_returns_the_records_of_scans_in_progress(self):
+        journal, _ = self.open_journal()
+        journal.append(record('a', 'created', plan='x'))
+        journal.append(record('b', 'created', plan='y'))
+        journal.append(record('a', 'state', state='STARTED'))
+        journal.append(record('b', 'state', state='STARTED'))
+        journal.done('b')
+        journal.close()
+        journal, records = self.open_journal()
+        self.assertEqual(records.keys(), ['a'])
+        self.assertEqual(records['a'], [record('a', 'created', plan='x'), record('a', 'state', state='STARTED')])
+
+    def test_replayed_records_are_copies(self):
+        journal, _ = self.open_journal()
+        journal.append(record('a', 'created', sessions=[{'id': 's'}]))
+        journal.close()
+        journal, records = self.open_journal()
+        records['a'][0]['sessions'][0]['id'] = 'changed'
+        self.assertEqual(journal._records['a'][0]['sessions'][0]['id'], 's')
+
+    @inlineCallbacks
+    def test_incomplete_last_record_is_cut_off(self):
+        journal, _ = self.open_journal()
+        journal.append(record('a', 'created'))
+        journal.close()
+        with open(self.path, "a") as file:
+            file.write('{"scan": "a", "type": "sta')
+        journal, records = self.open_journal()
+        self.assertEqual(records['a'], [record('a', 'created')])
+        journal.append(record('a', 'state', state='STARTED'))
+        yield self.compacted(journal)
+        journal.close()
+        self.assertEqual(self.lines(), [record('a', 'created'), record('a', 'state', state='STARTED')])
+
+    @inlineCallbacks
+    def test_replay_compacts_the_journal(self):
+        journal, _ = self.open_journal()
+        journal.append(record('a', 'created'))
+        journal.append(record('b', 'created'))
+        journal.append(record('b', 'state', state='STARTED'))
+        journal.done('b')
+        journal.close()
+        journal, records = self.open_journal()
+        yield self.compacted(journal)
+        self.assertEqual(self.lines(), [record('a', 'created')])
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    @inlineCallbacks
+    def test_records_written_while_compacting_are_kept(self):
+        journal, _ = self.open_journal(compact_threshold=1)
+        journal.append(record('a', 'created'))
+        journal.append(record('b', 'created'))
+        journal.done('b')
+        # Compaction is running in a thread now
+        self.assertNotEqual(journal._pending, None)
+        journal.append(record('a', 'state', state='STARTED'))
+        journal.append(record('c', 'created'))
+        yield self.compacted(journal)
+        journal.append(record('c', 'state', state='STARTED'))
+        self.assertEqual(self.lines(), [record('a', 'created'), record('a', 'state', state='STARTED'),
+                                        record('c', 'created'), record('c', 'state', state='STARTED')])
+        journal.close()
+        journal, records = self.open_journal()
+        self.assertEqual(records.keys(), ['a', 'c'])
+        self.assertEqual(len(records['a']), 2)
+        self.assertEqual(len(records['c']), 2)
+
+    @inlineCallbacks
+    def test_compaction_below_the_threshold_waits(self):
+        journal, _ = self.open_journal(compact_threshold=10)
+        journal.append(record('a', 'created'))
+        journal.done('a')
+        self.assertEqual(journal._pending, None)
+        yield self.compacted(journal)
+        self.assertEqual(len(self.lines()), 2)
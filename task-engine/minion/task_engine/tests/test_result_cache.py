@@ -0,0 +1,96 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+
+from twisted.trial import unittest
+
+from minion.task_engine.engine import PluginResultCache
+from minion.task_engine.metrics import MetricsRegistry
+
+
+PLUGIN = {'class': 'minion.plugins.basic.HSTSPlugin', 'name': 'HSTS', 'version': '0.1'}
+OTHER_PLUGIN = {'class': 'minion.plugins.nmap.NMAPPlugin', 'name': 'NMAP', 'version': '0.2'}
+CONFIGURATION = {'target': 'http://example.com', 'ports': [80, 443]}
+
+
+def session(session_id, plugin=PLUGIN, state='FINISHED'):
+    return {'id': session_id, 'plugin': plugin, 'state': state}
+
+
+class PluginResultCacheTest(unittest.TestCase):
+
+    def test_keys(self):
+        cache = PluginResultCache()
+        key = cache.key(PLUGIN, CONFIGURATION)
+        self.assertEqual(key, cache.key(dict(PLUGIN), {'ports': [80, 443], 'target': 'http://example.com'}))
+        self.assertNotEqual(key, cache.key(dict(PLUGIN, version='0.2'), CONFIGURATION))
+        self.assertNotEqual(key, cache.key(PLUGIN, dict(CONFIGURATION, target='http://example.org')))
+        self.assertNotEqual(key, cache.key(OTHER_PLUGIN, CONFIGURATION))
+        self.assertEqual(cache.key(None, CONFIGURATION), None)
+
+    def test_plugins_with_a_ttl_of_zero_are_not_cached(self):
+        cache = PluginResultCache(ttls={OTHER_PLUGIN['class']: 0})
+        self.assertEqual(cache.key(OTHER_PLUGIN, CONFIGURATION), None)
+        self.assertNotEqual(cache.key(PLUGIN, CONFIGURATION), None)
+        cache = PluginResultCache(ttl=0, ttls={PLUGIN['class']: 60})
+        self.assertEqual(cache.key(OTHER_PLUGIN, CONFIGURATION), None)
+        self.assertNotEqual(cache.key(PLUGIN, CONFIGURATION), None)
+
+    def test_hits_and_misses(self):
+        metrics = MetricsRegistry()
+        cache = PluginResultCache(metrics=metrics)
+        key = cache.key(PLUGIN, CONFIGURATION)
+        self.assertEqual(cache.get(key, PLUGIN), None)
+        cache.put(key, 'scan', session('s'), [{'Summary': 'No HSTS header'}])
+        result = cache.get(key, PLUGIN)
+        self.assertEqual(result['scan'], 'scan')
+        self.assertEqual(result['session'], session('s'))
+        self.assertEqual(result['issues'], [{'Summary': 'No HSTS header'}])
+        self.assertEqual(cache._hits._values, {(PLUGIN['class'],): 1})
+        self.assertEqual(cache._misses._values, {(PLUGIN['class'],): 1})
+
+    def test_forced_lookups_miss(self):
+        cache = PluginResultCache()
+        key = cache.key(PLUGIN, CONFIGURATION)
+        cache.put(key, 'scan', session('s'), [])
+        self.assertEqual(cache.get(key, PLUGIN, force=True), None)
+        self.assertNotEqual(cache.get(key, PLUGIN), None)
+
+    def test_results_expire(self):
+        cache = PluginResultCache(ttl=60, ttls={OTHER_PLUGIN['class']: 3600})
+        key = cache.key(PLUGIN, CONFIGURATION)
+        cache.put(key, 'scan', session('s'), [])
+        self.assertTrue(cache._results[key]['expires'] <= time.time() + 60)
+        other_key = cache.key(OTHER_PLUGIN, CONFIGURATION)
+        cache.put(other_key, 'scan', session('o', OTHER_PLUGIN), [])
+        self.assertTrue(cache._results[other_key]['expires'] > time.time() + 60)
+        cache._results[key]['expires'] = time.time() - 1
+        self.assertEqual(cache.get(key, PLUGIN), None)
+        self.assertFalse(key in cache._results)
+
+    def test_only_the_most_recently_used_are_kept(self):
+        cache = PluginResultCache(max_size=2)
+        keys = [cache.key(PLUGIN, dict(CONFIGURATION, target='http://%d.example.com' % n)) for n in range(3)]
+        cache.put(keys[0], 'scan', session('0'), [])
+        cache.put(keys[1], 'scan', session('1'), [])
+        cache.get(keys[0], PLUGIN)
+        cache.put(keys[2], 'scan', session('2'), [])
+        self.assertNotEqual(cache.get(keys[0], PLUGIN), None)
+        self.assertEqual(cache.get(keys[1], PLUGIN), None)
+        self.assertNotEqual(cache.get(keys[2], PLUGIN), None)
+
+    def test_only_finished_sessions_of_a_scan_are_cached(self):
+        cache = PluginResultCache()
+        keys = [cache.key(PLUGIN, dict(CONFIGURATION, target='http://%d.example.com' % n)) for n in range(3)]
+        summary = {'id': 'scan',
+                   'sessions': [dict(session('0'), issues=[{'Summary': 'A'}]),
+                                dict(session('1', state='FAILED'), issues=[]),
+                                dict(session('2', state='STOPPED'), issues=[])]}
+        cache.finished(summary, dict(enumerate(keys)))
+        result = cache.get(keys[0], PLUGIN)
+        self.assertEqual(result['session'], session('0'))
+        self.assertEqual(result['issues'], [{'Summary': 'A'}])
+        self.assertEqual(cache.get(keys[1], PLUGIN), None)
+        self.assertEqual(cache.get(keys[2], PLUGIN), None)
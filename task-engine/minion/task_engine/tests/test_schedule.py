@@ -0,0 +1,209 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import calendar
+import datetime
+import os
+import shutil
+import tempfile
+import time
+
+from twisted.internet.defer import succeed
+from twisted.internet.task import Clock
+from twisted.trial import unittest
+
+from minion.task_engine.schedule import CronExpression, RecurringScans, TimingWheel
+
+
+def timestamp(*args):
+    return calendar.timegm(datetime.datetime(*args).timetuple())
+
+
+class CronExpressionTest(unittest.TestCase):
+
+    def assertNext(self, expression, after, expected, seed=''):
+        self.assertEqual(CronExpression(expression, seed).next(timestamp(*after)),
+                         timestamp(*expected) if expected else None)
+
+    def test_invalid_expressions(self):
+        for expression in ('* * * *', '* * * * * *', '60 * * * *', '* 24 * * *', '* * 0 * *', '* * * 13 *',
+                           '* * * * 7', '5-1 * * * *', '*/0 * * * *', 'x * * * *'):
+            self.assertRaises(ValueError, CronExpression, expression)
+
+    def test_next_is_after_the_given_time(self):
+        self.assertNext('0 3 * * *', (2023, 5, 10, 2, 59, 59), (2023, 5, 10, 3, 0))
+        self.assertNext('0 3 * * *', (2023, 5, 10, 3, 0), (2023, 5, 11, 3, 0))
+        self.assertNext('0 3 * * *', (2023, 5, 10, 3, 0, 30), (2023, 5, 11, 3, 0))
+
+    def test_steps_ranges_and_lists(self):
+        self.assertNext('*/15 * * * *', (2023, 5, 10, 0, 7), (2023, 5, 10, 0, 15))
+        self.assertNext('*/15 * * * *', (2023, 5, 10, 0, 45), (2023, 5, 10, 1, 0))
+        self.assertNext('0 9-17/4 * * *', (2023, 5, 10, 13, 30), (2023, 5, 10, 17, 0))
+        self.assertNext('0 9-17/4 * * *', (2023, 5, 10, 17, 30), (2023, 5, 11, 9, 0))
+        self.assertNext('5,10 1,2 * * *', (2023, 5, 10, 1, 10), (2023, 5, 10, 2, 5))
+
+    def test_days_months_and_years(self):
+        self.assertNext('0 0 1 * *', (2023, 1, 31, 12, 0), (2023, 2, 1, 0, 0))
+        self.assertNext('0 0 1 1 *', (2023, 6, 15), (2024, 1, 1, 0, 0))
+        self.assertNext('0 0 29 2 *', (2023, 3, 1), (2024, 2, 29, 0, 0))
+        self.assertNext('0 0 31 * *', (2023, 4, 1), (2023, 5, 31, 0, 0))
+
+    def test_weekdays(self):
+        # January 1 2023 was a Sunday
+        self.assertNext('0 0 * * 0', (2023, 1, 1, 0, 0), (2023, 1, 8, 0, 0))
+        self.assertNext('30 8 * * 1-5', (2023, 1, 6, 9, 0), (2023, 1, 9, 8, 30))
+
+    def test_day_or_weekday(self):
+        # Like cron, the 13th or any Friday
+        self.assertNext('0 0 13 * 5', (2023, 1, 1), (2023, 1, 6, 0, 0))
+        self.assertNext('0 0 13 * 5', (2023, 1, 11), (2023, 1, 13, 0, 0))
+        self.assertNext('0 0 13 * 5', (2023, 1, 20, 1, 0), (2023, 1, 27, 0, 0))
+
+    def test_impossible_dates(self):
+        self.assertNext('0 0 30 2 *', (2023, 1, 1), None)
+        self.assertNext('0 0 31 4 *', (2023, 1, 1), None)
+
+    def test_hashed_values(self):
+        expression = CronExpression('H H * * *', 'schedule-1')
+        minute, hour = list(expression._values[0]), list(expression._values[1])
+        self.assertEqual(len(minute), 1)
+        self.assertEqual(len(hour), 1)
+        self.assertTrue(0 <= minute[0] <= 59 and 0 <= hour[0] <= 23)
+        self.assertEqual(CronExpression('H H * * *', 'schedule-1')._values, expression._values)
+        # Different schedules are spread over the range
+        minutes = set(list(CronExpression('H * * * *', 'schedule-%d' % n)._values[0])[0] for n in range(100))
+        self.assertTrue(len(minutes) > 30)
+
+    def test_hashed_steps(self):
+        for n in range(20):
+            minutes = sorted(CronExpression('H/15 * * * *', 'schedule-%d' % n)._values[0])
+            self.assertEqual(len(minutes), 4)
+            self.assertTrue(minutes[0] < 15)
+            self.assertEqual(minutes, range(minutes[0], 60, 15))
+
+    def test_hashed_fields_are_independent(self):
+        expression = CronExpression('H H H * *', 'schedule-1')
+        self.assertTrue(1 <= list(expression._values[2])[0] <= 31)
+
+
+class TimingWheelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.fired = []
+        self.clock = Clock()
+
+    def make_wheel(self, slots=8, callback=None):
+        wheel = TimingWheel(callback or self.fired.append, resolution=1.0, slots=slots)
+        wheel._loop.clock = self.clock
+        wheel.start()
+        self.addCleanup(wheel.stop)
+        return wheel
+
+    def tick(self, count=1):
+        for n in range(count):
+            self.clock.advance(1.0)
+
+    def test_timer_fires_in_its_tick(self):
+        wheel = self.make_wheel()
+        wheel.add('a', wheel._started + 3)
+        wheel.add('b', wheel._started + 2.5)
+        self.tick(2)
+        self.assertEqual(self.fired, [])
+        self.tick()
+        self.assertEqual(sorted(self.fired), ['a', 'b'])
+        self.tick(10)
+        self.assertEqual(len(self.fired), 2)
+
+    def test_timer_in_a_later_turn_of_the_wheel(self):
+        wheel = self.make_wheel(slots=4)
+        wheel.add('a', wheel._started + 6)
+        self.tick(5)
+        self.assertEqual(self.fired, [])
+        self.tick()
+        self.assertEqual(self.fired, ['a'])
+
+    def test_past_timer_fires_on_the_next_tick(self):
+        wheel = self.make_wheel()
+        self.tick(3)
+        wheel.add('a', wheel._started - 100)
+        self.tick()
+        self.assertEqual(self.fired, ['a'])
+
+    def test_removed_timer_does_not_fire(self):
+        wheel = self.make_wheel()
+        wheel.add('a', wheel._started + 2)
+        wheel.remove('a')
+        self.tick(20)
+        self.assertEqual(self.fired, [])
+
+    def test_timer_can_be_moved(self):
+        wheel = self.make_wheel()
+        wheel.add('a', wheel._started + 2)
+        wheel.add('a', wheel._started + 4)
+        self.tick(3)
+        self.assertEqual(self.fired, [])
+        self.tick()
+        self.assertEqual(self.fired, ['a'])
+
+    def test_missed_ticks_are_caught_up(self):
+        wheel = self.make_wheel()
+        wheel.add('a', wheel._started + 2)
+        wheel.add('b', wheel._started + 5)
+        self.clock.advance(6.0)
+        self.assertEqual(self.fired, ['a', 'b'])
+
+    def test_failing_callback_does_not_stop_the_wheel(self):
+        def callback(key):
+            self.fired.append(key)
+            if key == 'a':
+                raise Exception("Failed")
+        wheel = self.make_wheel(callback=callback)
+        wheel.add('a', wheel._started + 1)
+        wheel.add('b', wheel._started + 1)
+        wheel.add('c', wheel._started + 2)
+        self.tick(2)
+        self.assertEqual(sorted(self.fired), ['a', 'b', 'c'])
+
+
+class RecurringScansTest(unittest.TestCase):
+
+    def make_scans(self, path=None):
+        scans = RecurringScans(path, lambda schedule: succeed(None))
+        scans._wheel._loop.clock = Clock()
+        scans.start()
+        self.addCleanup(scans.stop)
+        return scans
+
+    def test_schedules_are_saved(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'schedules')
+        scans = self.make_scans(path)
+        schedule = scans.create('http://example.com', 'basic', 'H 3 * * *', 'low')
+        other = scans.create('http://example.org', 'basic', '0 * * * *', 'normal')
+        scans.delete(other['id'])
+        loaded = self.make_scans(path).schedules()
+        self.assertEqual([s['id'] for s in loaded], [schedule['id']])
+        self.assertEqual(loaded[0]['cron'], 'H 3 * * *')
+        self.assertEqual(loaded[0]['priority'], 'low')
+
+    def test_runs_are_spread_after_the_cron_times(self):
+        scans = self.make_scans()
+        now = time.time()
+        for n in range(20):
+            schedule = scans.create('http://example.com/%d' % n, 'basic', '0 * * * *', 'normal', spread=300, jitter=30)
+            self.assertTrue(schedule['next_run'] > now - 330)
+            self.assertTrue(schedule['next_run'] % 3600 < 330)
+
+    def test_schedule_that_ended_does_not_run(self):
+        scans = self.make_scans()
+        schedule = scans.create('http://example.com', 'basic', '0 * * * *', 'normal', end=time.time() - 3600)
+        self.assertEqual(schedule['next_run'], None)
+        self.assertEqual(scans._wheel._due, {})
+
+    def test_schedule_starts_at_its_start_time(self):
+        scans = self.make_scans()
+        schedule = scans.create('http://example.com', 'basic', '0 * * * *', 'normal', spread=0, jitter=0,
+                                start=timestamp(2100, 1, 1, 0, 30))
+        self.assertEqual(schedule['next_run'], timestamp(2100, 1, 1, 1, 0))
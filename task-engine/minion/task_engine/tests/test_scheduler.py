@@ -0,0 +1,99 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed
+from twisted.internet.task import deferLater
+from twisted.trial import unittest
+
+from minion.task_engine.engine import TaskEngineScheduler
+
+
+def wait(seconds=0.01):
+    return deferLater(reactor, seconds, lambda: None)
+
+
+class FakeScan:
+
+    # idle() returns the next of the given results, which are deferreds
+    # or whether the scan is done
+
+    def __init__(self, results):
+        self.id = 'scan'
+        self.idled = 0
+        self._results = list(results)
+
+    def idle(self):
+        self.idled += 1
+        result = self._results.pop(0)
+        return result if isinstance(result, Deferred) else succeed(result)
+
+
+class TaskEngineSchedulerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.finished = []
+        self.scheduler = TaskEngineScheduler(self.finished.append, deadline=0.05)
+
+    def tearDown(self):
+        for timer in self.scheduler._timers.values():
+            timer.cancel()
+
+    @inlineCallbacks
+    def test_wakeups_are_coalesced(self):
+        scan = FakeScan([False])
+        self.scheduler.wakeup(scan)
+        self.scheduler.wakeup(scan)
+        self.scheduler.wakeup(scan, 10)
+        yield wait()
+        self.assertEqual(scan.idled, 1)
+        self.assertEqual(self.finished, [])
+
+    @inlineCallbacks
+    def test_earliest_wakeup_wins(self):
+        scan = FakeScan([False])
+        self.scheduler.wakeup(scan, 10)
+        self.scheduler.wakeup(scan)
+        yield wait()
+        self.assertEqual(scan.idled, 1)
+        self.assertEqual(self.scheduler._timers, {})
+
+    @inlineCallbacks
+    def test_wakeup_while_idling_runs_again_after(self):
+        idling = Deferred()
+        scan = FakeScan([idling, False])
+        self.scheduler.wakeup(scan)
+        yield wait()
+        self.scheduler.wakeup(scan)
+        self.assertEqual(scan.idled, 1)
+        idling.callback(False)
+        yield wait()
+        self.assertEqual(scan.idled, 2)
+
+    @inlineCallbacks
+    def test_done_scan_is_finished(self):
+        scan = FakeScan([True])
+        self.scheduler.wakeup(scan)
+        yield wait()
+        self.assertEqual(self.finished, [scan])
+
+    @inlineCallbacks
+    def test_slow_idle_is_cancelled(self):
+        cancelled = []
+        def cancel(d):
+            cancelled.append(d)
+            d.callback(False)
+        scan = FakeScan([Deferred(cancel)])
+        self.scheduler.wakeup(scan)
+        yield wait(0.1)
+        self.assertEqual(len(cancelled), 1)
+        self.assertEqual(self.scheduler._running, {})
+
+    @inlineCallbacks
+    def test_cancel(self):
+        scan = FakeScan([False])
+        self.scheduler.wakeup(scan, 0.02)
+        self.scheduler.cancel(scan)
+        yield wait(0.05)
+        self.assertEqual(scan.idled, 0)
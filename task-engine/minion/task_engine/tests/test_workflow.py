@@ -0,0 +1,65 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from twisted.trial import unittest
+
+from minion.task_engine.engine import TaskEngineSession
+
+
+def make_scan(workflow, max_parallel=4):
+    plan = {'name': 'test', 'workflow': workflow}
+    scan = TaskEngineSession(plan, {}, None, None, '/tmp', None, None, None, max_parallel=max_parallel)
+    scan.plugin_sessions = [{'id': str(n), 'state': 'CREATED'} for n in range(len(workflow))]
+    return scan
+
+
+class WorkflowDependenciesTest(unittest.TestCase):
+
+    def test_steps_without_dependencies(self):
+        scan = make_scan([{'plugin_name': 'A'}, {'plugin_name': 'B'}])
+        self.assertEqual(scan.dependencies, [[], []])
+
+    def test_dependencies_by_index_id_and_plugin_name(self):
+        scan = make_scan([{'plugin_name': 'A'},
+                          {'plugin_name': 'A', 'id': 'second'},
+                          {'plugin_name': 'B', 'depends_on': ['second']},
+                          {'plugin_name': 'C', 'depends_on': [0]},
+                          {'plugin_name': 'D', 'depends_on': ['A', 'C']}])
+        self.assertEqual(scan.dependencies, [[], [], [1], [0], [0, 1, 3]])
+
+    def test_only_earlier_steps_are_dependencies(self):
+        scan = make_scan([{'plugin_name': 'A', 'depends_on': [0, 1, 'B']},
+                          {'plugin_name': 'B', 'depends_on': [5, -1]}])
+        self.assertEqual(scan.dependencies, [[], []])
+
+
+class StartableSessionsTest(unittest.TestCase):
+
+    def test_independent_sessions_start_up_to_max_parallel(self):
+        scan = make_scan([{'plugin_name': 'A'}, {'plugin_name': 'B'}, {'plugin_name': 'C'}], max_parallel=2)
+        self.assertEqual([s['id'] for s in scan._startable_sessions()], ['0', '1'])
+
+    def test_session_waits_for_results_of_dependencies(self):
+        scan = make_scan([{'plugin_name': 'A'}, {'plugin_name': 'B', 'depends_on': ['A']}])
+        scan.plugin_sessions[0]['state'] = 'FINISHED'
+        self.assertEqual(scan._startable_sessions(), [])
+        scan.plugin_sessions[0]['_done'] = True
+        self.assertEqual([s['id'] for s in scan._startable_sessions()], ['1'])
+
+    def test_sessions_of_failed_dependencies_are_skipped(self):
+        scan = make_scan([{'plugin_name': 'A'},
+                          {'plugin_name': 'B', 'depends_on': [0]},
+                          {'plugin_name': 'C', 'depends_on': [1]},
+                          {'plugin_name': 'D'}])
+        scan.plugin_sessions[0]['state'] = 'FAILED'
+        self.assertTrue(scan._skip_sessions())
+        self.assertEqual([s['state'] for s in scan.plugin_sessions], ['FAILED', 'STOPPED', 'STOPPED', 'CREATED'])
+        self.assertEqual([s['id'] for s in scan._startable_sessions()], ['3'])
+        self.assertFalse(scan._skip_sessions())
+
+    def test_sessions_of_stopped_dependencies_are_skipped(self):
+        scan = make_scan([{'plugin_name': 'A'}, {'plugin_name': 'B', 'depends_on': [0]}])
+        scan.plugin_sessions[0]['state'] = 'STOPPED'
+        self.assertTrue(scan._skip_sessions())
+        self.assertEqual(scan.plugin_sessions[1]['state'], 'STOPPED')
@@ -3,21 +3,70 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import base64
+import email.utils
 import json
+import logging
 import os
 import re
 import sys
 import urlparse
+from collections import OrderedDict
 
 import cyclone.web
-from twisted.internet.defer import inlineCallbacks
-
-from minion.task_engine.engine import TaskEngine, SCAN_DATABASE_CLASSES
+import zope.interface
+from twisted.internet import reactor
+from twisted.internet.defer import CancelledError, Deferred, inlineCallbacks
+from twisted.internet.error import ConnectionLost
+from twisted.internet.interfaces import IPullProducer
+
+from minion.task_engine.database import CachingScanDatabase, SCAN_DATABASE_CACHE_SIZE, SCAN_DATABASE_CLASSES
+from minion.task_engine.engine import TaskEngine, ScanDiff, stored_scan_issues, stored_scan_results
+from minion.task_engine.engine import PLUGIN_CATALOG_TTL, PLUGIN_SERVICE_MAX_CONCURRENCY, SCAN_MAX_PARALLEL_SESSIONS
+from minion.task_engine.engine import SCAN_ADMISSION_BUDGET, SCAN_DEFAULT_PRIORITY, SCAN_PRIORITIES
+from minion.task_engine.engine import PLUGIN_SERVICE_HEALTH_CHECK_INTERVAL, SCAN_MAX_ISSUE_MEMORY
+from minion.task_engine.engine import PLUGIN_RESULT_CACHE_SIZE, PLUGIN_RESULT_CACHE_TTL
+from minion.task_engine.journal import SCAN_JOURNAL_FILE_NAME
+from minion.task_engine.metrics import MetricsRegistry
+from minion.task_engine.schedule import CronExpression, SCAN_SCHEDULES_FILE_NAME
+from minion.task_engine.schedule import SCAN_SCHEDULE_DEFAULT_JITTER, SCAN_SCHEDULE_DEFAULT_SPREAD
 
 
 TASK_ENGINE_SYSTEM_SETTINGS_PATH = "/etc/minion/task-engine.conf"
 TASK_ENGINE_USER_SETTINGS_PATH = "~/.minion/task-engine.conf"
 
+SCAN_EVENTS_HEARTBEAT_INTERVAL = 15.0
+
+
+#
+# A results token is an opaque cursor into the issues of a scan. It is
+# simply the base64 encoded position of the first issue that the client
+# has not seen yet. Returns None for a malformed token.
+#
+
+def _encode_cursor(cursor):
+    return base64.urlsafe_b64encode(str(cursor))
+
+def _decode_cursor(token):
+    try:
+        decoded = base64.urlsafe_b64decode(token.encode('ascii'))
+    except Exception as e:
+        return None
+    if re.match(r"^\d+$", decoded) is None:
+        return None
+    return int(decoded)
+
+
+def _validate_target(url):
+    """Only accept URLs that are basic. No query, fragment or embedded auth allowed"""
+    if not isinstance(url, str) and not isinstance(url, unicode):
+        return False
+    p = urlparse.urlparse(url)
+    if p.scheme not in ('http', 'https'):
+        return False
+    if p.query or p.fragment or p.username or p.password:
+        return False
+    return True
+
 
 class PlansHandler(cyclone.web.RequestHandler):
 
@@ -28,6 +77,15 @@ class PlansHandler(cyclone.web.RequestHandler):
         self.finish({'success': True, 'plans': plan_descriptions})
 
 
+class PluginServicesHandler(cyclone.web.RequestHandler):
+
+    @inlineCallbacks
+    def get(self):
+        task_engine = self.application.task_engine
+        plugin_services = yield task_engine.get_plugin_services()
+        self.finish({'success': True, 'plugin_services': plugin_services})
+
+
 class PlanHandler(cyclone.web.RequestHandler):
 
     @inlineCallbacks
@@ -49,17 +107,6 @@ class CreateScanHandler(cyclone.web.RequestHandler):
 
     ALLOWED_CONFIGURATION_FIELDS = ('target',)
     
-    def _validate_target(self, url):
-        """Only accept URLs that are basic. No query, fragment or embedded auth allowed"""
-        if not isinstance(url, str) and not isinstance(url, unicode):
-            return False
-        p = urlparse.urlparse(url)
-        if p.scheme not in ('http', 'https'):
-            return False
-        if p.query or p.fragment or p.username or p.password:
-            return False
-        return True
-        
     def _validate_configuration(self, body):
         try:
             cfg = json.loads(body)
@@ -68,7 +115,7 @@ class CreateScanHandler(cyclone.web.RequestHandler):
             for key in cfg.keys():
                 if key not in self.ALLOWED_CONFIGURATION_FIELDS:
                     return False,None
-            if 'target' not in cfg or not self._validate_target(cfg['target']):
+            if 'target' not in cfg or not _validate_target(cfg['target']):
                 return False,None
             return True, cfg
         except Exception as e:
@@ -89,8 +136,17 @@ class CreateScanHandler(cyclone.web.RequestHandler):
             self.finish({'success': False, 'error': 'invalid-configuration'})
             return
 
-        session = yield task_engine.create_session(plan, configuration)
-        self.finish({ 'success': True, 'scan': session.summary() })
+        priority = self.get_argument('priority', SCAN_DEFAULT_PRIORITY)
+        if priority not in SCAN_PRIORITIES:
+            self.finish({'success': False, 'error': 'invalid-priority'})
+            return
+
+        # Plugins run again even if their results are cached when force is set
+        force = self.get_argument('force', 'false') == 'true'
+
+        session = yield task_engine.create_session(plan, configuration, priority, force)
+        summary = yield session.summary()
+        self.finish({ 'success': True, 'scan': summary })
 
 
 class ChangeScanStateHandler(cyclone.web.RequestHandler):
@@ -107,7 +163,12 @@ class ChangeScanStateHandler(cyclone.web.RequestHandler):
 
         session = yield task_engine.get_session(scan_id)
         if session is None:
-            self.finish({'success': False, 'error': 'no-such-scan'})
+            # A scan that is in the database is done and cannot be changed
+            scan = yield self.application.scan_database.load(scan_id)
+            if scan is None:
+                self.finish({'success': False, 'error': 'no-such-scan'})
+            else:
+                self.finish({'success': False, 'error': 'invalid-state-transition'})
             return
         
         if state == 'START':
@@ -131,11 +192,14 @@ class ScanHandler(cyclone.web.RequestHandler):
         task_engine = self.application.task_engine
 
         # Try to load this from the database. If it is not there then the scan
-        # might be still in progress in which case the task engine has it.
+        # might be still in progress in which case the task engine has it. The
+        # database hands us the scan already serialized, so we do not encode
+        # the same finished scan again for every request.
 
-        scan = yield self.application.scan_database.load(scan_id)
+        scan = yield self.application.scan_database.load_serialized(scan_id)
         if scan is not None:
-            self.finish({ 'success': True, 'scan': scan })
+            self.set_header("Content-Type", "application/json")
+            self.finish('{"success": true, "scan": %s}' % scan)
             return
 
         session = yield task_engine.get_session(scan_id)
@@ -143,7 +207,8 @@ class ScanHandler(cyclone.web.RequestHandler):
             self.finish({'success': False, 'error': 'no-such-scan'})
             return
 
-        self.finish({ 'success': True, 'scan': session.summary() })
+        summary = yield session.summary()
+        self.finish({ 'success': True, 'scan': summary })
 
     @inlineCallbacks
     def delete(self, scan_id):
@@ -170,37 +235,187 @@ class ScanHandler(cyclone.web.RequestHandler):
 
         self.finish({'success': False, 'error': 'no-such-scan'})
 
-class ScanResultsHandler(cyclone.web.RequestHandler):
+class ScansHandler(cyclone.web.RequestHandler):
 
-    def _validate_token(self, token):
+    # Find finished scans in the database. Optionally filtered on target,
+    # plan and state. Returns the most recently finished scans first.
+
+    @inlineCallbacks
+    def get(self):
         try:
-            decoded = base64.b64decode(token)
-            if decoded is None or not re.match(r"^\d\d\d\d-\d\d-\d\dT\d\d:\d\d:\d\d\.\d\d\d\d\d\dZ+$", decoded):
-                return False
-            return True
-        except Exception as e:
-            return False
+            limit = int(self.get_argument('limit', 100))
+        except ValueError:
+            self.finish({'success': False, 'error': 'invalid-limit'})
+            return
+        scans = yield self.application.scan_database.find(target=self.get_argument('target', None),
+                                                          plan=self.get_argument('plan', None),
+                                                          state=self.get_argument('state', None),
+                                                          limit=limit)
+        self.finish({'success': True, 'scans': scans})
+
+class ScanDatabaseCacheHandler(cyclone.web.RequestHandler):
+
+    def get(self):
+        self.finish({'success': True, 'cache': self.application.scan_database.stats()})
+
+class ScanMemoryHandler(cyclone.web.RequestHandler):
+
+    # How much memory the issues of the scans in progress take
+
+    @inlineCallbacks
+    def get(self):
+        memory = yield self.application.task_engine.get_memory()
+        self.finish(dict(memory, success=True))
+
+class MetricsHandler(cyclone.web.RequestHandler):
+
+    # Metrics in the Prometheus text format
+
+    @inlineCallbacks
+    def get(self):
+        metrics = yield self.application.task_engine.get_metrics()
+        self.set_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.finish(metrics)
+
+class ScanResultsHandler(cyclone.web.RequestHandler):
 
-    def _parse_token(self, token):
-        return base64.b64decode(token)
-    
     def _all_sessions_done(self, sessions):
         for session in sessions:
             if session['state'] in ('CREATED', 'STARTED'):
                 return False
         return True
 
-    def _generate_token(self, since, sessions):
-        if len(sessions) == 0:
-            return base64.b64encode("1975-09-23Z00:00:00.000000Z")
-        if not self._all_sessions_done(sessions):
-            max_time = since
-            for session in sessions:
-                issues = []
-                for i in session['issues']:
-                    if i['Date'] > max_time:
-                        max_time = i['Date']
-            return base64.b64encode(str(max_time))
+    def _generate_token(self, cursor, sessions):
+        if len(sessions) == 0 or not self._all_sessions_done(sessions):
+            return _encode_cursor(cursor)
+
+    @inlineCallbacks
+    def get(self, scan_id):
+
+        task_engine = self.application.task_engine
+
+        cursor = 0
+        token = self.get_argument('token', None)
+        if token:
+            cursor = _decode_cursor(token)
+            if cursor is None:
+                self.finish({ 'success': False, 'error': 'malformed-token' })
+                return
+
+        # Scans that are done are no longer in memory, their results come
+        # from the database. So do those of a scan that is stored but not
+        # cleaned up yet, it may have dropped the issues that it moved to
+        # the database already.
+
+        session = yield task_engine.get_session(scan_id)
+        if session is not None and not session.stored:
+            scan_results, cursor = yield session.results(cursor)
+        else:
+            scan = yield self.application.scan_database.load(scan_id)
+            if scan is None:
+                self.finish({'success': False, 'error': 'no-such-scan'})
+                return
+            scan_results, cursor = stored_scan_results(scan, cursor)
+        token = self._generate_token(cursor, scan_results['sessions'])
+        self.finish({ 'success': True, 'scan': scan_results, 'token': token })
+
+class ScanIssuesHandler(cyclone.web.RequestHandler):
+
+    # The distinct issues of a scan, with duplicates merged
+
+    @inlineCallbacks
+    def get(self, scan_id):
+        session = yield self.application.task_engine.get_session(scan_id)
+        if session is not None:
+            issues = session.distinct_issues.issues()
+        else:
+            scan = yield self.application.scan_database.load(scan_id)
+            if scan is None:
+                self.finish({'success': False, 'error': 'no-such-scan'})
+                return
+            issues = stored_scan_issues(scan)
+        self.finish({'success': True, 'issues': issues})
+
+class ScanDiffHandler(cyclone.web.RequestHandler):
+
+    # What changed since the scan that this scan is compared with: the
+    # last finished scan of the same target with the same plan.
+
+    @inlineCallbacks
+    def get(self, scan_id):
+        scan_database = self.application.scan_database
+        session = yield self.application.task_engine.get_session(scan_id)
+        if session is not None:
+            diff = session.diff.describe(session.distinct_issues)
+        else:
+            scan = yield scan_database.load(scan_id)
+            if scan is None:
+                self.finish({'success': False, 'error': 'no-such-scan'})
+                return
+            baseline_issues = []
+            if scan.get('baseline'):
+                baseline = yield scan_database.load(scan['baseline'])
+                if baseline is None:
+                    self.finish({'success': False, 'error': 'no-such-baseline'})
+                    return
+                baseline_issues = stored_scan_issues(baseline)
+            index = OrderedDict((issue['Fingerprint'], issue) for issue in stored_scan_issues(scan))
+            scan_diff = ScanDiff(scan.get('baseline'), baseline_issues)
+            for fingerprint in index:
+                scan_diff.add(fingerprint)
+            diff = scan_diff.describe(index)
+        self.finish({'success': True, 'diff': diff})
+
+class ScanEventsHandler(cyclone.web.RequestHandler):
+
+    # Stream the progress of a scan as Server-Sent Events. New issues are
+    # sent as 'issues' events in the same form as /scan/<id>/results, with
+    # the results token as the event id so that a client can resume with
+    # the Last-Event-ID header or the token argument. Changes of the scan
+    # and session states and progress are sent as 'status' events. When
+    # the scan is done we send an 'end' event and close the stream.
+
+    _closed = False
+    _waiting = None
+
+    def _send(self, data):
+        self.write(data)
+        self.flush()
+
+    def _event(self, event, data, id=None):
+        lines = []
+        if id is not None:
+            lines.append("id: %s" % id)
+        lines.append("event: %s" % event)
+        lines.append("data: %s" % json.dumps(data))
+        self._send("\n".join(lines) + "\n\n")
+
+    def _status(self, scan):
+        status = { 'state': scan['state'],
+                   'sessions': [{ 'id': session['id'],
+                                  'state': session['state'],
+                                  'progress': session.get('progress') } for session in scan['sessions']] }
+        if 'queue' in scan:
+            status['queue'] = scan['queue']
+        return status
+
+    # Send the issues of a stored scan that the client has not seen yet
+    # and end the stream.
+
+    def _end(self, scan, cursor):
+        results, next_cursor = stored_scan_results(scan, cursor)
+        if next_cursor != cursor:
+            self._event('issues', results, _encode_cursor(next_cursor))
+        self._event('status', self._status(scan))
+        self._event('end', {'state': scan['state']})
+
+    # Stop waiting when the client goes away. This is called while the
+    # connection is being torn down, so we stop in the next reactor turn.
+
+    def on_connection_close(self, *args):
+        self._closed = True
+        if self._waiting is not None:
+            reactor.callLater(0, self._waiting.cancel)
 
     @inlineCallbacks
     def get(self, scan_id):
@@ -208,26 +423,161 @@ class ScanResultsHandler(cyclone.web.RequestHandler):
         task_engine = self.application.task_engine
 
         session = yield task_engine.get_session(scan_id)
+        scan = None
         if session is None:
-            self.finish({'success': False, 'error': 'no-such-scan'})
-            return
+            scan = yield self.application.scan_database.load(scan_id)
+            if scan is None:
+                self.finish({'success': False, 'error': 'no-such-scan'})
+                return
 
-        since = "1975-09-23T00:00:00.000000Z"
-        token = self.get_argument('token', None)
+        cursor = 0
+        token = self.request.headers.get('Last-Event-ID') or self.get_argument('token', None)
         if token:
-            if not self._validate_token(token):
+            cursor = _decode_cursor(token)
+            if cursor is None:
                 self.finish({ 'success': False, 'error': 'malformed-token' })
                 return
-            since = self._parse_token(token)
-            
-        scan_results = session.results(since=since)
-        token = self._generate_token(since, scan_results['sessions'])
-        self.finish({ 'success': True, 'scan': scan_results, 'token': token })
+
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        self.flush()
+
+        # A scan that is in the database is done. A client that resumes
+        # gets the issues that it missed and then the end of the stream.
+
+        if session is None:
+            self._end(scan, cursor)
+            self.finish()
+            return
+
+        status = None
+        while not self._closed:
+            # Once the scan is stored it drops the issues that it moved to
+            # the database, so the rest comes from the stored scan. A scan
+            # that was deleted when it stopped is not stored at all.
+            if session.stored:
+                scan = yield self.application.scan_database.load(scan_id)
+                if self._closed:
+                    break
+                if scan is not None:
+                    self._end(scan, cursor)
+                else:
+                    self._event('end', {'state': session.state})
+                break
+            results, next_cursor = yield session.results(cursor)
+            if next_cursor != cursor:
+                cursor = next_cursor
+                self._event('issues', results, _encode_cursor(cursor))
+            current_status = self._status(session.status())
+            if current_status != status:
+                status = current_status
+                self._event('status', status)
+            # Wait for the scan to change. If that takes a while then send
+            # a comment to keep the connection alive.
+            self._waiting = session.wait_for_change()
+            heartbeat = reactor.callLater(SCAN_EVENTS_HEARTBEAT_INTERVAL, self._waiting.cancel)
+            try:
+                yield self._waiting
+            except CancelledError:
+                if not self._closed:
+                    self._send(": heartbeat\n\n")
+            finally:
+                self._waiting = None
+                if heartbeat.active():
+                    heartbeat.cancel()
+
+        if not self._closed:
+            self.finish()
+
+class FileRangeProducer(object):
+
+    """
+    Pull producer that writes length bytes of a file, starting at offset,
+    to a transport. The file is read in small chunks and only when the
+    transport asks for more, so memory use does not depend on the size
+    of the file.
+    """
+
+    zope.interface.implements(IPullProducer)
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, file, offset, length):
+        self._file = file
+        self._offset = offset
+        self._remaining = length
+        self._transport = None
+        self._deferred = None
+
+    # Start producing. Returns a deferred that fires when all data has
+    # been written or that fails when the connection was closed.
+
+    def start(self, transport):
+        self._transport = transport
+        self._deferred = Deferred()
+        self._file.seek(self._offset)
+        transport.registerProducer(self, False)
+        return self._deferred
+
+    def resumeProducing(self):
+        data = ''
+        if self._remaining > 0:
+            data = self._file.read(min(self.CHUNK_SIZE, self._remaining))
+        if not data:
+            self._transport.unregisterProducer()
+            self._finish(None)
+            return
+        self._remaining -= len(data)
+        self._transport.write(data)
+
+    def stopProducing(self):
+        self._finish(ConnectionLost())
+
+    def _finish(self, error):
+        self._file.close()
+        d, self._deferred = self._deferred, None
+        if d is not None:
+            if error is None:
+                d.callback(None)
+            else:
+                d.errback(error)
 
 class ScanArtifactsHandler(cyclone.web.RequestHandler):
 
+    # Parse a Range header into an (offset, length) tuple. Returns None
+    # when the whole file should be sent, which is also what we do for
+    # malformed headers and multiple ranges, and raises ValueError when
+    # the range cannot be satisfied.
+
+    def _parse_range(self, value, size):
+        match = re.match(r"^bytes=(\d*)-(\d*)$", (value or '').strip())
+        if match is None:
+            return None
+        first, last = match.groups()
+        if not first and not last:
+            return None
+        if not first:
+            length = min(int(last), size)
+            if length == 0:
+                raise ValueError("Empty suffix range")
+            return size - length, length
+        first = int(first)
+        last = min(int(last), size - 1) if last else size - 1
+        if first > last:
+            raise ValueError("Unsatisfiable range")
+        return first, last - first + 1
+
+    # The ETag is derived from the file metadata so that we do not have
+    # to read the file to generate it. Artifacts are written once and
+    # then renamed into place, so this changes when the file changes.
+
+    def _etag(self, stat):
+        return '"%x-%x-%x"' % (stat.st_ino, stat.st_size, int(stat.st_mtime))
+
     @inlineCallbacks
-    def get(self, scan_id, session_id):
+    def _serve(self, scan_id, session_id, include_body):
+
+        task_engine = self.application.task_engine
 
         # Try to load this from the database. If it is not there then the scan
         # might be still in progress in which case the task engine has it.
@@ -236,45 +586,174 @@ class ScanArtifactsHandler(cyclone.web.RequestHandler):
         if scan is None:
             session = yield task_engine.get_session(scan_id)
             if session is not None:
-                scan = session.summary()
+                scan = session.status()
 
-        if scan is None:
+        if scan is None or session_id not in [s['id'] for s in scan['sessions']]:
             raise cyclone.web.HTTPError(404)
-        
+
         artifacts_path = os.path.expanduser(self.settings['task_engine']['artifacts_path']) + "/" + session_id + ".zip"
-        print "LOOKING AT", artifacts_path
-        if not os.path.exists(artifacts_path):
-            raise cyclone.web.HTTPError(404)            
+        try:
+            file = open(artifacts_path, 'rb')
+        except IOError:
+            raise cyclone.web.HTTPError(404)
+
+        try:
+            stat = os.fstat(file.fileno())
+            etag = self._etag(stat)
 
-        with open(artifacts_path) as f:
-            data = f.read()
             self.set_header("Content-Type", "application/zip")
-            self.set_header("Content-Length", str(len(data)))
-            self.finish(data)        
-        
+            self.set_header("Accept-Ranges", "bytes")
+            self.set_header("ETag", etag)
+            self.set_header("Last-Modified", email.utils.formatdate(stat.st_mtime, usegmt=True))
+
+            if_none_match = self.request.headers.get("If-None-Match")
+            if if_none_match is not None and (if_none_match.strip() == '*' or etag in if_none_match):
+                self.set_status(304)
+                self.finish()
+                return
+
+            # A range is only honored when the client still has the
+            # version of the file that it got the earlier part from
+
+            byte_range = None
+            if_range = self.request.headers.get("If-Range")
+            if if_range is None or if_range.strip() == etag:
+                try:
+                    byte_range = self._parse_range(self.request.headers.get("Range"), stat.st_size)
+                except ValueError:
+                    self.set_status(416)
+                    self.set_header("Content-Range", "bytes */%d" % stat.st_size)
+                    self.finish()
+                    return
+
+            if byte_range is None:
+                offset, length = 0, stat.st_size
+            else:
+                offset, length = byte_range
+                self.set_status(206)
+                self.set_header("Content-Range", "bytes %d-%d/%d" % (offset, offset + length - 1, stat.st_size))
+            self.set_header("Content-Length", str(length))
+
+            # Write the headers and then let the transport pull the body
+            # straight from the file.
+
+            self.flush()
+            if include_body:
+                producer, file = FileRangeProducer(file, offset, length), None
+                try:
+                    yield producer.start(self.request.connection.transport)
+                except ConnectionLost:
+                    logging.info("Connection closed while sending artifacts %s" % artifacts_path)
+                    return
+            self.finish()
+        finally:
+            if file is not None:
+                file.close()
+
+    def get(self, scan_id, session_id):
+        return self._serve(scan_id, session_id, True)
+
+    def head(self, scan_id, session_id):
+        return self._serve(scan_id, session_id, False)
+
+
+class SchedulesHandler(cyclone.web.RequestHandler):
+
+    @inlineCallbacks
+    def get(self):
+        schedules = yield self.application.task_engine.get_schedules()
+        self.finish({'success': True, 'schedules': schedules})
+
+
+class CreateScheduleHandler(cyclone.web.RequestHandler):
+
+    # A schedule is created with { "target": "http://some.site.com",
+    # "plan": "basic", "cron": "H 3 * * *" } and optionally a priority,
+    # the spread and jitter in seconds and a start and end time. The
+    # target is validated like the target of a scan.
+
+    OPTIONAL_FIELDS = ('priority', 'spread', 'jitter', 'start', 'end')
+
+    def _validate_number(self, value):
+        return value is None or (isinstance(value, (int, long, float)) and not isinstance(value, bool) and value >= 0)
+
+    @inlineCallbacks
+    def put(self):
+
+        task_engine = self.application.task_engine
+
+        try:
+            body = json.loads(self.request.body)
+        except Exception as e:
+            body = None
+        if not isinstance(body, dict) or [key for key in body if key not in ('target', 'plan', 'cron') + self.OPTIONAL_FIELDS]:
+            self.finish({'success': False, 'error': 'invalid-schedule'})
+            return
+
+        if not _validate_target(body.get('target')):
+            self.finish({'success': False, 'error': 'invalid-configuration'})
+            return
+
+        plan = yield task_engine.get_plan(body.get('plan'))
+        if plan is None:
+            self.finish({'success': False, 'error': 'no-such-plan'})
+            return
+
+        priority = body.get('priority', SCAN_DEFAULT_PRIORITY)
+        if priority not in SCAN_PRIORITIES:
+            self.finish({'success': False, 'error': 'invalid-priority'})
+            return
+
+        try:
+            CronExpression(body.get('cron'))
+        except Exception as e:
+            self.finish({'success': False, 'error': 'invalid-schedule'})
+            return
+
+        spread = body.get('spread', SCAN_SCHEDULE_DEFAULT_SPREAD)
+        jitter = body.get('jitter', SCAN_SCHEDULE_DEFAULT_JITTER)
+        if spread is None or jitter is None or [value for value in (spread, jitter, body.get('start'), body.get('end'))
+                                                if not self._validate_number(value)]:
+            self.finish({'success': False, 'error': 'invalid-schedule'})
+            return
+
+        schedule = yield task_engine.create_schedule(body['target'], body['plan'], body['cron'], priority,
+                                                     spread=spread, jitter=jitter,
+                                                     start=body.get('start'), end=body.get('end'))
+        self.finish({'success': True, 'schedule': schedule})
+
+
+class ScheduleHandler(cyclone.web.RequestHandler):
+
+    @inlineCallbacks
+    def get(self, schedule_id):
+        schedule = yield self.application.task_engine.get_schedule(schedule_id)
+        if schedule is None:
+            self.finish({'success': False, 'error': 'no-such-schedule'})
+        else:
+            self.finish({'success': True, 'schedule': schedule})
+
+    # Scans that the schedule started are left alone
+
+    @inlineCallbacks
+    def delete(self, schedule_id):
+        deleted = yield self.application.task_engine.delete_schedule(schedule_id)
+        if not deleted:
+            self.finish({'success': False, 'error': 'no-such-schedule'})
+        else:
+            self.finish({'success': True})
+
 
 class TaskEngineApplication(cyclone.web.Application):
 
-    def __init__(self):
+    def __init__(self, task_engine_settings=None):
 
         # Configure our settings. We have basic default settings that just work for development
-        # and then override those with what is defined in either ~/.minion/ or /etc/minion/
-
-        task_engine_settings = dict(plugin_service_api="http://127.0.0.1:8181",
-                                    scan_database_type="memory",
-                                    scan_database_location=None,
-                                    artifacts_path="/tmp")
+        # and then override those with what is defined in either ~/.minion/ or /etc/minion/.
+        # Settings can also be passed in, which is what the benchmarks do.
 
-        for settings_path in (TASK_ENGINE_USER_SETTINGS_PATH, TASK_ENGINE_SYSTEM_SETTINGS_PATH):
-            settings_path = os.path.expanduser(settings_path)
-            if os.path.exists(settings_path):
-                with open(settings_path) as file:
-                    try:
-                        task_engine_settings = json.load(file)
-                        break
-                    except Exception as e:
-                        logging.error("Failed to parse configuration file %s: %s" % (settings_path, str(e)))
-                        sys.exit(1)
+        if task_engine_settings is None:
+            task_engine_settings = self._load_settings()
 
         # Setup the database
 
@@ -285,24 +764,81 @@ class TaskEngineApplication(cyclone.web.Application):
             sys.exit(1)
 
         try:
-            self.scan_database = scan_database_class(task_engine_settings['scan_database_location'])
+            scan_database = scan_database_class(task_engine_settings['scan_database_location'])
         except Exception as e:
             logging.error("Failed to setup the scan database: %s" % str(e))
             sys.exit(1)
-        
-        # Create the Task Engine
 
-        self.task_engine = TaskEngine(self.scan_database, task_engine_settings['plugin_service_api'],
-                                      task_engine_settings['artifacts_path'])
+        scan_database_cache_size = task_engine_settings.get('scan_database_cache_size', SCAN_DATABASE_CACHE_SIZE)
+        self.scan_database = CachingScanDatabase(scan_database, scan_database_cache_size)
+        
+        # Create the Task Engine. It shares its metrics with ours.
+
+        self.metrics = MetricsRegistry()
+        self.request_durations = self.metrics.histogram("minion_task_engine_request_duration_seconds",
+                                                        "Time it took to handle an HTTP request.",
+                                                        ('handler', 'method'))
+        self.requests = self.metrics.counter("minion_task_engine_requests_total",
+                                             "HTTP requests handled.", ('handler', 'method', 'code'))
+
+        plugin_service_max_concurrency = task_engine_settings.get('plugin_service_max_concurrency',
+                                                                  PLUGIN_SERVICE_MAX_CONCURRENCY)
+        scan_max_parallel_sessions = task_engine_settings.get('scan_max_parallel_sessions',
+                                                              SCAN_MAX_PARALLEL_SESSIONS)
+        plugin_catalog_ttl = task_engine_settings.get('plugin_catalog_ttl', PLUGIN_CATALOG_TTL)
+        scan_admission_budget = task_engine_settings.get('scan_admission_budget', SCAN_ADMISSION_BUDGET)
+        scan_max_issue_memory = task_engine_settings.get('scan_max_issue_memory', SCAN_MAX_ISSUE_MEMORY)
+        plugin_service_health_check_interval = task_engine_settings.get('plugin_service_health_check_interval',
+                                                                        PLUGIN_SERVICE_HEALTH_CHECK_INTERVAL)
+        # Scans in progress are journaled unless scan_journal_path is null
+        scan_journal_path = task_engine_settings.get('scan_journal_path',
+                                                     self._instance_path(task_engine_settings, SCAN_JOURNAL_FILE_NAME))
+        # Recurring scans are kept in memory only if scan_schedules_path is null
+        scan_schedules_path = task_engine_settings.get('scan_schedules_path',
+                                                       self._instance_path(task_engine_settings, SCAN_SCHEDULES_FILE_NAME))
+        # Results of plugins are cached for plugin_result_cache_ttl seconds, plugin_result_cache_ttls
+        # has the TTLs of plugin classes that differ from that. A TTL of 0 disables the cache.
+        plugin_result_cache_ttl = task_engine_settings.get('plugin_result_cache_ttl', PLUGIN_RESULT_CACHE_TTL)
+        plugin_result_cache_ttls = task_engine_settings.get('plugin_result_cache_ttls', {})
+        plugin_result_cache_size = task_engine_settings.get('plugin_result_cache_size', PLUGIN_RESULT_CACHE_SIZE)
+        # How we identify ourself to the plugin services, the host name unless configured. Task
+        # engines that run on the same host need one each.
+        task_engine_id = task_engine_settings.get('task_engine_id')
+
+        # Plugin sessions are spread over plugin_service_apis if it is
+        # configured, else they all run on the single plugin_service_api
+
+        plugin_service_apis = task_engine_settings.get('plugin_service_apis')
+        if not plugin_service_apis:
+            plugin_service_apis = [task_engine_settings['plugin_service_api']]
+
+        self.task_engine = TaskEngine(self.scan_database, plugin_service_apis,
+                                      task_engine_settings['artifacts_path'], plugin_service_max_concurrency,
+                                      scan_max_parallel_sessions, plugin_catalog_ttl, scan_admission_budget,
+                                      plugin_service_health_check_interval, scan_max_issue_memory,
+                                      scan_journal_path, self.metrics, scan_schedules_path,
+                                      plugin_result_cache_ttl, plugin_result_cache_ttls, plugin_result_cache_size,
+                                      task_engine_id)
 
         # Setup our routes and initialize the Cyclone application
 
         handlers = [
             (r"/plans", PlansHandler),
+            (r"/plugin-services", PluginServicesHandler),
             (r"/plan/([a-z0-9_-]+)", PlanHandler),
+            (r"/scans", ScansHandler),
+            (r"/scans/cache", ScanDatabaseCacheHandler),
+            (r"/scans/memory", ScanMemoryHandler),
+            (r"/metrics", MetricsHandler),
+            (r"/schedules", SchedulesHandler),
+            (r"/schedules/create", CreateScheduleHandler),
+            (r"/schedule/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})", ScheduleHandler),
             (r"/scan/create/([a-z0-9_-]+)", CreateScanHandler),
             (r"/scan/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/state", ChangeScanStateHandler),
             (r"/scan/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/results", ScanResultsHandler),
+            (r"/scan/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/issues", ScanIssuesHandler),
+            (r"/scan/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/diff", ScanDiffHandler),
+            (r"/scan/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/events", ScanEventsHandler),
             (r"/scan/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})/artifacts/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})", ScanArtifactsHandler),
             (r"/scan/([a-f0-9]{8}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{4}-[a-f0-9]{12})", ScanHandler),
         ]
@@ -314,5 +850,45 @@ class TaskEngineApplication(cyclone.web.Application):
 
         cyclone.web.Application.__init__(self, handlers, **settings)
 
+    def _load_settings(self):
+        task_engine_settings = dict(plugin_service_api="http://127.0.0.1:8181",
+                                    scan_database_type="memory",
+                                    scan_database_location=None,
+                                    artifacts_path="/tmp")
+
+        for settings_path in (TASK_ENGINE_USER_SETTINGS_PATH, TASK_ENGINE_SYSTEM_SETTINGS_PATH):
+            settings_path = os.path.expanduser(settings_path)
+            if os.path.exists(settings_path):
+                with open(settings_path) as file:
+                    try:
+                        task_engine_settings = json.load(file)
+                        break
+                    except Exception as e:
+                        logging.error("Failed to parse configuration file %s: %s" % (settings_path, str(e)))
+                        sys.exit(1)
+
+        return task_engine_settings
+
+    # The files that belong to this task engine go in its artifacts_path
+    # by default, with its task_engine_id in the name if it has one, so
+    # that task engines never share them.
+
+    def _instance_path(self, task_engine_settings, file_name):
+        task_engine_id = task_engine_settings.get('task_engine_id')
+        if task_engine_id:
+            name, extension = os.path.splitext(file_name)
+            file_name = "%s-%s%s" % (name, task_engine_id, extension)
+        return os.path.join(os.path.expanduser(task_engine_settings['artifacts_path']), file_name)
+
+    # Called when a request has been handled. Requests are measured by
+    # handler, since the paths contain ids.
+
+    def log_request(self, handler):
+        name = handler.__class__.__name__
+        method = handler.request.method
+        self.request_durations.observe(handler.request.request_time(), handler=name, method=method)
+        self.requests.inc(handler=name, method=method, code=handler.get_status())
+        cyclone.web.Application.log_request(self, handler)
+
 
 Application = lambda: TaskEngineApplication()
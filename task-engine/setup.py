@@ -19,6 +19,7 @@ setup(name="minion.task_engine",
       namespace_packages=['minion','minion.task_engine'],
       include_package_data=True,
       install_requires = install_requires,
-      test_suite = 'minion.plugin_service.tests',
+      test_suite = 'minion.task_engine.tests',
       scripts=['scripts/minion-task-engine',
-               'scripts/minion-task-client'])
+               'scripts/minion-task-client',
+               'scripts/minion-scan-database-migrate'])